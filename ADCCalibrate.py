@@ -11,6 +11,7 @@ from struct import pack, unpack
 from matplotlib.pyplot import *
 
 import AdcCalLoggingFileHandler
+import fit_cores
 from SPI import SPI
 from MMCM import MMCM
 from GPIB import GPIB
@@ -18,6 +19,7 @@ from INL import INL
 from OGP import OGP
 from ADCConfFile import ADCConfFile
 from AdcSnapshot import AdcSnapshot
+from SnapshotArchive import SnapshotArchive
 
 logger = logging.getLogger('adc5gLogging')
 
@@ -40,7 +42,14 @@ class ADCCalibrate:
                , now = None
                , config = False
                , bof = False
-               , clockrate = None):
+               , clockrate = None
+               , archive = False
+               , prefetch = False
+               , artifacts = 'full'
+               , differential = False
+               , gpib = None
+               , settle = True
+               , prescreen_limits = None):
 
         self.zdok = zdok
         self.test = test
@@ -48,6 +57,11 @@ class ADCCalibrate:
         self.clockrate = clockrate if clockrate is not None else 1500.0
         self.config = 0 #config
         self.bof = bof
+        # which files are written; 'none', 'summary' or 'full' (see
+        # fit_cores.artifact_levels).  The check plots are only saved
+        # at 'full'.
+        assert artifacts in fit_cores.artifact_levels
+        self.artifacts = artifacts
 
         # Removing this check because you may be using ADCCalibrate in a read-only
         # mode where gpib is not needed (since it is write-only, TBF)
@@ -74,9 +88,20 @@ class ADCCalibrate:
 
         #self.set_file_label()
 
+        # keep all the snapshots of the run in one archive, rather than
+        # a file per snapshot
+        if archive:
+            self.archive = SnapshotArchive(self.get_archive_filename())
+        else:
+            self.archive = None
+
+        # wait for the hardware to settle after changing it; there is
+        # nothing to wait for when replaying a recording
+        self.settle = settle
+
         # helper classes
-        self.gpib = GPIB(gpib_addr, test = test)
-        self.spi = SPI(zdok = zdok, test = test, roach = self.roach)
+        self.gpib = gpib if gpib is not None else GPIB(gpib_addr, test = test)
+        self.spi = SPI(zdok = zdok, test = test, roach = self.roach, differential = differential)
         self.adc = AdcSnapshot(zdok = zdok, test = test, roach = self.roach, clockrate = self.clockrate)
 
         # higher-level classes
@@ -86,13 +111,20 @@ class ADCCalibrate:
                      , roach_name = roach_name
                      , clockrate = self.clockrate
                      , now = now
-                     , dir = dir)
+                     , dir = dir
+                     , archive = self.archive
+                     , prefetch = prefetch
+                     , artifacts = artifacts
+                     , settle = settle
+                     , prescreen_limits = prescreen_limits)
         self.inl = INL(zdok = zdok
                      , spi = self.spi
                      , roach_name = roach_name
                      , now = now
-                     , dir = dir)
-        self.mmcm = MMCM(zdok = zdok, spi = self.spi, adc = self.adc) 
+                     , dir = dir
+                     , artifacts = artifacts
+                     , settle = settle)
+        self.mmcm = MMCM(zdok = zdok, spi = self.spi, adc = self.adc, archive = self.archive)
 
         self.configFile = "%s-adc.conf" % roach_name
         self.configPath = "%s/%s" % (dir, self.configFile)
@@ -136,6 +168,11 @@ class ADCCalibrate:
     def set_ampl(self, ampl):
         self.gpib.ampl = ampl
 
+    def get_archive_filename(self):
+        return "%s/snapshots_%s_%s.arc" % (self.dir
+                                         , self.roach_name
+                                         , self.current_time)
+
     def get_check_filename(self, title, zdoks):
         return "%s/%s_%s_zs%d_%s" % (self.dir
                                   , title
@@ -239,11 +276,10 @@ class ADCCalibrate:
         for type in types:
             for zdok in zdoks:
                 if type == 'ogp':
-                    self.ogp.set_zdok(zdok)
-                    self.ogp.spi.set_control()
-                    self.ogp.set_offsets(self.cf.get_ogp_offsets(freq, zdok))
-                    self.ogp.set_gains(  self.cf.get_ogp_gains(freq, zdok))
-                    self.ogp.set_phases(  self.cf.get_ogp_phases(freq, zdok))
+                    self.ogp.set_ogps(self.cf.get_ogp_offsets(freq, zdok)
+                                    , self.cf.get_ogp_gains(freq, zdok)
+                                    , self.cf.get_ogp_phases(freq, zdok)
+                                    , zdok = zdok)
                 elif type == 'inl':
                     self.inl.set_inls(self.cf.get_inls(zdok))
 
@@ -252,31 +288,48 @@ class ADCCalibrate:
 
 
 
-    def do_ogp(self, zdoks, freq, n_trails):
-        "Handles single zdok, or both"
+    def do_ogp(self, zdoks, freq, n_trails, batch = False):
+        """
+        Handles single zdok, or both; for both, returns each zdok's OGP as a
+        dict.  If batch, each zdok's snapshots are all fit in one pass.
+        """
         if zdoks==2:
+           # both zdoks are snapped together
            self.gpib.set_freq(freq)
-           self.do_ogp(0, freq, n_trails)
-           self.do_ogp(1, freq, n_trails)
+           ogps = self.ogp.do_ogp_dual(freq, n_trails, batch = batch)
+           if self.config:
+               for zdok in (0, 1):
+                   self.cf.write_ogps(self.clockrate*1e6, zdok, ogps[zdok])
+               self.cf.write_to_file()
+           return ogps
         elif zdoks!=1 and zdoks!=0:
            logger.error("ZDOK " + str(zdoks) + " is not a valid input, aborting...")
         else:
            self.gpib.set_freq(freq)
-           self.ogp.do_ogp(zdoks, freq, n_trails)
+           self.ogp.do_ogp(zdoks, freq, n_trails, batch = batch)
            if self.config:
                self.cf.write_ogps(self.clockrate*1e6, zdoks, self.ogp.ogps)
                self.cf.write_to_file()
            
 
-    def do_inl(self, zdoks):
-        "Handles single zdok, or both"
+    def do_inl(self, zdoks, hist = None):
+        """
+        Handles single zdok, or both.  If hist is given, the INLs are found
+        from the histogram of that many snapshots (OGP.do_hist) rather than
+        from the residuals of the OGP fits.
+        """
         if zdoks==2:
-           self.do_inl(0)
-           self.do_inl(1)
+           self.do_inl(0, hist)
+           self.do_inl(1, hist)
         elif zdoks!=1 and zdoks!=0:
            logger.error("ZDOK " + str(zdoks) + " is not a valid input, aborting...")
         else:
-           self.inl.do_inl(zdoks)
+           if hist:
+               residuals = self.ogp.do_hist(zdoks, repeat = hist)
+           else:
+               # use the residuals of the OGP fits if we have them in memory
+               residuals = self.ogp.residuals.get(zdoks)
+           self.inl.do_inl(zdoks, residuals = residuals)
            if self.config:
                self.cf.write_inls(zdoks, self.inl.inls)
                self.cf.write_to_file()
@@ -330,10 +383,11 @@ class ADCCalibrate:
         else:
             print "Getting Ramp WITHOUT setting to test mode!"
         snap_name = "adcsnap%s" % zdok #self.get_snap_name(zdok)
-        a, b, c, d = self.adc.get_test_vector([snap_name], man_trig=True, wait_period=2)
+        # a (cores, samples) array; the rows are cores a, c, b, d
+        ramp = self.adc.get_test_vector([snap_name], man_trig=True, wait_period=2)
         if set_mode:
             self.spi.unset_test_mode()
-        return a, b, c, d
+        return ramp
         
     def check_ramp(self, zdok, save=True, view=True, filename=None, set_mode = True): #"ramp"):
         filename = filename if filename is not None else self.get_check_filename(self.post_mmcm_ramp_check_name, zdok)
@@ -342,20 +396,14 @@ class ADCCalibrate:
         logmsg += " filename: " + str(filename) + "\n"
         logger.info(logmsg)
         if zdok==2:
-            a0, b0, c0, d0 = self.get_ramp(0, set_mode = set_mode)
-            a1, b1, c1, d1 = self.get_ramp(1, set_mode = set_mode)
+            ramp0 = self.get_ramp(0, set_mode = set_mode)
+            ramp1 = self.get_ramp(1, set_mode = set_mode)
         elif zdok==0:
-            a0, b0, c0, d0 = self.get_ramp(0, set_mode = set_mode)
-            a1 = np.zeros(len(a0))
-            b1 = np.zeros(len(b0))
-            c1 = np.zeros(len(c0))
-            d1 = np.zeros(len(d0))
+            ramp0 = self.get_ramp(0, set_mode = set_mode)
+            ramp1 = np.zeros(ramp0.shape)
         elif zdok==1:
-            a1, b1, c1, d1 = self.get_ramp(1, set_mode = set_mode)
-            a0 = np.zeros(len(a1))
-            b0 = np.zeros(len(b1))
-            c0 = np.zeros(len(c1))
-            d0 = np.zeros(len(d1))
+            ramp1 = self.get_ramp(1, set_mode = set_mode)
+            ramp0 = np.zeros(ramp1.shape)
         else:
             logmsg = "Invalid input for zdok: "+ str(zdok) + " aborting..."
             logger.error(logmsg)
@@ -364,12 +412,13 @@ class ADCCalibrate:
         f = figure()
         ax0 = f.add_subplot(211)
         ax1 = f.add_subplot(212)
-        ax0.plot(a0, '-o', b0, '-d', c0, '-^', d0, '-s')
-        ax1.plot(a1, '-o', b1, '-d', c1, '-^', d1, '-s')
+        for core0, core1, style in zip(ramp0, ramp1, ['-o', '-d', '-^', '-s']):
+            ax0.plot(core0, style)
+            ax1.plot(core1, style)
         ax0.set_title('ADC0')
         ax1.set_title('ADC1')
         f.suptitle(filename)
-        if save:
+        if save and fit_cores.keep_artifacts(self.artifacts, 'full'):
             logger.debug("Saving file :%s"%(filename+'.png'))
             savefig(filename+'.png', dpi=300)
         if view:
@@ -391,8 +440,7 @@ class ADCCalibrate:
         logmsg += " filename: " + str(filename)
         logger.info(logmsg)
         if zdok == 2:
-            raw0 = self.adc.get_raw(0)
-            raw1 = self.adc.get_raw(1)  
+            raw0, raw1 = self.adc.get_dual_raw()
         elif zdok == 0:
             raw0 = self.adc.get_raw(0)
             raw1 = np.zeros(len(raw0))
@@ -402,8 +450,9 @@ class ADCCalibrate:
         else:
             logmsg = "Invalid input for zdok: "+ str(zdok) + " aborting..."
             logger.error(logmsg)
-        m0 = max(np.abs(raw0))
-        m1 = max(np.abs(raw1))
+        # widen the int8 samples first; abs(-128) overflows an int8
+        m0 = np.abs(np.asarray(raw0, dtype=int)).max()
+        m1 = np.abs(np.asarray(raw1, dtype=int)).max()
         if m0>=128 or m1>=128:
             logger.warning("Power too high, clipping might be occurring...please check")
 
@@ -430,7 +479,7 @@ class ADCCalibrate:
         f.suptitle(filename)
         f.text(0.5, 0.04, 'time', ha='center', va='center')
         f.text(0.06, 0.5, 'amplitude', ha='center', va='center', rotation='vertical')
-        if save:
+        if save and fit_cores.keep_artifacts(self.artifacts, 'full'):
             logger.debug("Saving file :%s"%(filename+'.png'))
             f.set_size_inches(18, 12)
             savefig(filename+'.png', dpi=150)
@@ -447,9 +496,8 @@ class ADCCalibrate:
         logmsg += " filename: " + str(filename) + "\n"
         logger.info(logmsg)
         if zdok == 2:
-            nfr0 = self.adc.get_spec(0)
+            nfr0, nfr1 = self.adc.get_dual_spec()
             spikes0 = self.adc.find_spike(nfr0)
-            nfr1 =self.adc.get_spec(1)
             spikes1 = self.adc.find_spike(nfr1)
         elif zdok == 0:
             nfr0 = self.adc.get_spec(0)
@@ -492,12 +540,21 @@ class ADCCalibrate:
             info_str += "Current input test tone frequency: %.4f"%self.gpib.freq
         if self.gpib.ampl is not None:    
             info_str += "\nCurrent input power level: %.4f"%self.gpib.ampl
+        if self.gpib.freq is not None:
+            for z, nfr in ((0, nfr0), (1, nfr1)):
+                if zdok != 2 and zdok != z:
+                    continue
+                m = self.adc.get_spec_metrics(nfr, self.gpib.freq)
+                logger.info("ADC%d SFDR: %.2f dB SINAD: %.2f dB ENOB: %.2f spur: %.4fMHz" % \
+                    (z, m.sfdr, m.sinad, m.enob, m.spur_freq))
+                info_str += "\nADC%d SFDR: %.2f SINAD: %.2f ENOB: %.2f" % \
+                    (z, m.sfdr, m.sinad, m.enob)
         ax1.text(450, min(ax1y)+20, info_str, bbox={'facecolor':'yellow', 'alpha':0.9})
         ax1.set_title('ADC1')
         f.suptitle(filename)
         f.text(0.5, 0.04, 'frequency (MHz)', ha='center', va='center')
         f.text(0.06, 0.5, 'power (dB)', ha='center', va='center', rotation='vertical')
-        if save:
+        if save and fit_cores.keep_artifacts(self.artifacts, 'full'):
             logger.debug("Saving file :%s"%(filename+'.png'))
             savefig(filename+'.png', dpi=300)
         if view:
@@ -533,7 +590,8 @@ class ADCCalibrate:
         logger.debug(" New ampl is: " + str(new_ampl))
         ampl = new_ampl
         self.gpib.set_ampl(ampl)
-        time.sleep(2)
+        if self.settle:
+            time.sleep(2)
         if manual:
             # Double check?
             tprompt = " Check raw ADC data now?" # (Y/N)"
@@ -576,7 +634,8 @@ class ADCCalibrate:
         logger.debug(" New frequency is: " + str(freq))
         test_freq = freq
         self.gpib.set_freq(test_freq)
-        time.sleep(2)
+        if self.settle:
+            time.sleep(2)
         if manual:
             tprompt = " Check raw ADC data now? (Y/N)"
             to_check = raw_input(tprompt)
@@ -610,10 +669,10 @@ class ADCCalibrate:
             test_freq = i*30+random.random()*30
             logger.debug("freq : " + str(test_freq))
             self.gpib.set_freq(test_freq)
-            time.sleep(2)
-            nfr0 = self.adc.get_spec(0) 
+            if self.settle:
+                time.sleep(2)
+            nfr0, nfr1 = self.adc.get_dual_spec()
             spikes0 = self.adc.find_spike(nfr0)
-            nfr1 = self.adc.get_spec(1)
             spikes1 = self.adc.find_spike(nfr1)
             logger.debug("Found spikes at %.4fMHz for ADC0"%spikes0)
             logger.debug("Found spikes at %.4fMHz for ADC1"%spikes1)
@@ -651,7 +710,7 @@ class ADCCalibrate:
         ax1.text(450, min(f1[0])+20, info_str, bbox={'facecolor':'yellow', 'alpha':0.9})
         f.text(0.5, 0.04, 'frequency (MHz)', ha='center', va='center')
         f.text(0.06, 0.5, 'power (dB)', ha='center', va='center', rotation='vertical')
-        if save:
+        if save and fit_cores.keep_artifacts(self.artifacts, 'full'):
             logger.debug("Saving file :%s"%(filename+'.png'))
             savefig(filename+'.png', dpi=300)
         if view:
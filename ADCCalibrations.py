@@ -12,6 +12,8 @@ from optparse import OptionParser
 import AdcCalLoggingFileHandler
 from ADCCalibrate import ADCCalibrate
 from ADCConfFile import ADCConfFile
+from GPIB import GPIB
+from FpgaRecording import RecordingFpgaClient, ReplayFpgaClient
 from valon_katcp import ValonKATCP
 
 logger = logging.getLogger('adc5gLogging')
@@ -31,7 +33,12 @@ class ADCCalibrations:
                , manual = False
                , do_ogps = True
                , do_mmcms = True
-               , gpib_addr = None):
+               , gpib_addr = None
+               , record = False
+               , replay = False
+               , artifacts = 'full'
+               , differential = False
+               , prescreen_limits = None):
 
         self.test = test
         self.now = now
@@ -41,6 +48,20 @@ class ADCCalibrations:
         self.banks = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H']
         self.manual = manual
 
+        # record all the roach traffic of a run, or replay a recorded
+        # run without any hardware; one recording per roach in data_dir
+        assert not (record and replay)
+        self.record = record
+        self.replay = replay
+        self.recorded_roaches = {}
+
+        # which files the calibrations write; see fit_cores.artifact_levels
+        self.artifacts = artifacts
+        # only write the ADC registers that change
+        self.differential = differential
+        # the limits of the OGP snapshot prescreen; see OGP.screen_snapshot
+        self.prescreen_limits = prescreen_limits
+
         self.do_mmcms = do_mmcms
         self.do_ogps = do_ogps
         if not self.do_ogps and not self.do_mmcms:
@@ -70,6 +91,9 @@ class ADCCalibrations:
             self.find_all_mmcms()
         if self.do_ogps:
             self.find_all_ogps()
+        for roach in self.recorded_roaches.values():
+            roach.close()
+        self.recorded_roaches = {}
 
     def find_all_ogps(self):
         for r in self.roaches:
@@ -102,6 +126,31 @@ class ADCCalibrations:
             roaches.append(cp.get(sec, "roach_host").split('.')[0])
         return roaches    
         
+    def get_recording_filename(self, roach_name):
+        return "%s/%s.rec" % (self.data_dir, roach_name)
+
+    def connect_roach(self, roach_name):
+        """
+        Returns the FpgaClient for the roach: a ReplayFpgaClient of its
+        recording if we are replaying, a RecordingFpgaClient if we are
+        recording, else the plain FpgaClient.  The recording and replay
+        clients are kept for the whole run.
+        """
+        if roach_name in self.recorded_roaches:
+            return self.recorded_roaches[roach_name]
+        if self.replay:
+            roach = ReplayFpgaClient(self.get_recording_filename(roach_name))
+            self.recorded_roaches[roach_name] = roach
+            return roach
+        roach = corr.katcp_wrapper.FpgaClient(roach_name)
+        time.sleep(1)
+        if not roach.is_connected():
+            raise Exception("Cannot connect to %s" % roach_name)
+        if self.record:
+            roach = RecordingFpgaClient(roach, self.get_recording_filename(roach_name))
+            self.recorded_roaches[roach_name] = roach
+        return roach
+
     def get_adc_config_filename(self, roach_name): 
         fn = "%s/%s-adc.conf" % (self.conf_dir, roach_name)
         logger.info("MMCM config file: %s" % fn)
@@ -114,23 +163,28 @@ class ADCCalibrations:
         tmsg = 'Connecting to %s'%roach_name
         logger.info(tmsg)
         if not self.test:
-            self.roach = corr.katcp_wrapper.FpgaClient(roach_name)
-            time.sleep(1)
-            if not self.roach.is_connected():
-                raise Exception("Cannot connect to %s" % roach_name)
+            self.roach = self.connect_roach(roach_name)
     
         # we'll need this to change the frequency
         valonSerial = "/dev/ttyS1" # this should never change
         if not self.test:
             self.valon = ValonKATCP(self.roach, valonSerial) 
     
+        # the synthesizer isn't recorded; don't drive it when replaying
+        gpib = GPIB(self.gpibaddr, test = True) if self.replay else None
+
         # this is the object that will find the MMCM value
         self.cal = ADCCalibrate(dir = self.data_dir 
                          , roach_name = roach_name
                          , gpib_addr = self.gpibaddr
                          , roach = self.roach
                          , now = self.now
-                         , test = self.test)
+                         , test = self.test
+                         , artifacts = self.artifacts
+                         , differential = self.differential
+                         , gpib = gpib
+                         , settle = not self.replay
+                         , prescreen_limits = self.prescreen_limits)
     
         # read the config file and find the mmcm  through each mode
         fn = self.get_adc_config_filename(roach_name)
@@ -167,9 +221,13 @@ class ADCCalibrations:
 
         # switch to the given bof file
         self.roach.progdev(bof)
+        # don't trust what we knew of the ADC registers
+        if hasattr(self, 'cal'):
+            self.cal.spi.invalidate()
         tmsg = "Roach BOF file set to: %s" % bof
         logger.info(tmsg)
-        time.sleep(2)
+        if not self.replay:
+            time.sleep(2)
     
     def change_frequency(self, freq):
         "If necessary, use the Valon Synth to change the Roach board clockrate."
@@ -185,7 +243,8 @@ class ADCCalibrations:
         logger.info(tmsg)
         if abs(current_clkrate - clkrate) > 0.001:
             self.valon.set_frequency(valonSynth, clkrate)
-            time.sleep(1)
+            if not self.replay:
+                time.sleep(1)
             current_clkrate = self.valon.get_frequency(valonSynth)
             tmsg = "Valon Synth changed to frequency: %f MHz" % current_clkrate
             logger.info(tmsg)
@@ -211,13 +270,10 @@ class ADCCalibrations:
             logger.info("canceling find_this_ogp for frequency %s" % freq)
             return None, None
 
-        # now find the ogps
-        self.cal.do_ogp(0, self.testfreq, self.ogp_trials)
-        ogp0 = self.cal.ogp.ogps
-        self.cal.do_ogp(1, self.testfreq, self.ogp_trials)
-        ogp1 = self.cal.ogp.ogps
+        # now find the ogps of both zdoks, snapped together
+        ogps = self.cal.do_ogp(2, self.testfreq, self.ogp_trials)
 
-        return ogp0, ogp1
+        return ogps[0], ogps[1]
 
     def find_mmcms(self, roach_name):
         """
@@ -1,6 +1,52 @@
-from struct import pack, unpack
+import sys
+import os
+import time
+import threading
+import Queue
 import numpy as np
 from numpy.fft import fft
+import fit_cores
+
+class FixtureCache:
+
+    """
+    A cache of the samples of snapshot files, eg. the canned snapshots used
+    in test mode, keyed by (path, mtime, size, dtype).  Each file is parsed
+    with fit_cores.read_snapshot only the first time it is asked for, or
+    after it has changed on disk.  The arrays are shared, so they are read
+    only.
+    """
+
+    def __init__(self):
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def get(self, fname, dtype=int):
+        st = os.stat(fname)
+        path = os.path.abspath(fname)
+        key = (path, st.st_mtime, st.st_size, np.asarray(0, dtype=dtype).dtype.name)
+        self.lock.acquire()
+        try:
+            if key not in self.cache:
+                samples = fit_cores.read_snapshot(fname)[0].astype(dtype)
+                samples.setflags(write=False)
+                # drop any stale copy of the file
+                for k in [k for k in self.cache if k[0] == path]:
+                    del self.cache[k]
+                self.cache[key] = samples
+            return self.cache[key]
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.cache.clear()
+        finally:
+            self.lock.release()
+
+# the canned snapshots of test mode, shared by all the test mode classes
+fixture_cache = FixtureCache()
 
 class AdcSnapshot:
 
@@ -34,20 +80,95 @@ class AdcSnapshot:
     def get_spec(self, zdok=0):
         "Returns the FFT of get_raw"
         raw = self.get_raw(zdok)
-        fr = abs(fft(raw))
-        nfr = fr/max(fr)
-        nfr = nfr[0:len(nfr)/2]
-        return nfr
+        return self.calc_spec(raw)
+
+    def get_dual_spec(self):
+        "Returns the spectra of both zdoks, from one get_dual_raw, as a (2, N) array"
+        return self.calc_spec(self.get_dual_raw())
+
+    def calc_spec(self, raw):
+        """
+        The normalized magnitude of the FFT of raw, positive frequencies only.
+        Each row of a (zdoks, samples) array is done separately.
+        """
+        fr = abs(fft(raw, axis=-1))
+        nfr = fr/fr.max(axis=-1, keepdims=True)
+        return nfr[..., 0:fr.shape[-1]/2]
         
+    def get_spec_freqs(self, nfr):
+        "The frequencies of the channels of a spectrum from get_spec."
+        return np.arange(len(nfr))*self.clockrate*1.0/len(nfr)
+
+    def get_spec_metrics(self, nfr, sig_freq):
+        """
+        Given a spectrum from get_spec and the test tone frequency, return
+        the SFDR, SINAD etc. as a fit_cores.SpectralMetrics.
+        """
+        return fit_cores.spectral_metrics(self.get_spec_freqs(nfr)
+                                        , np.asarray(nfr)**2
+                                        , sig_freq)
+
     def get_raw(self, zdok):
         self.set_zdok(zdok)
         raw = self.get_adc_snapshot(self.get_snap_name(zdok))
         return raw
 
+    def get_dual_raw(self):
+        "Returns the raw snapshots of both zdoks as a (2, N) array"
+        return self.get_dual_snapshot()
+
+    def get_dual_snapshot(self, snap_names = None, man_trig=True, wait_period=2):
+        """
+        Arms the snapshot blocks of both zdoks together, waits for both to
+        finish, then reads them both, so the two captures share one trigger
+        and one wait.  Returns the time-ordered samples as a (2, N) np.int8
+        array, one row per zdok.
+        """
+        if snap_names is None:
+            snap_names = [self.get_snap_name(zdok) for zdok in (0, 1)]
+
+        if self.test:
+            return np.array([self.get_adc_snapshot(name) for name in snap_names])
+
+        # arm both, as snapshot_get does for one
+        ctrl = man_trig << 1
+        for name in snap_names:
+            self.roach.write_int(name + '_ctrl', ctrl)
+        for name in snap_names:
+            self.roach.write_int(name + '_ctrl', ctrl + 1)
+
+        lengths = self.wait_for_snapshots(snap_names, wait_period)
+        if lengths[0] != lengths[1]:
+            raise RuntimeError("Snapshots %s captured different lengths: %s" % (snap_names, lengths))
+        return np.array([np.frombuffer(self.roach.read(name + '_bram', length), dtype=np.int8)
+                         for name, length in zip(snap_names, lengths)])
+
+    def wait_for_snapshots(self, snap_names, wait_period=2):
+        """
+        Polls the status of the armed snapshot blocks until they are all
+        done, and returns the number of bytes each captured.
+        """
+        lengths = {}
+        start_time = time.time()
+        while len(lengths) < len(snap_names) and ((time.time() - start_time) < wait_period or wait_period < 0):
+            for name in snap_names:
+                if name not in lengths:
+                    addr = self.roach.read_uint(name + '_status')
+                    if not addr & 0x80000000:
+                        lengths[name] = addr & 0x7fffffff
+            if len(lengths) < len(snap_names):
+                time.sleep(0.05)
+        for name in snap_names:
+            if lengths.get(name, 0) == 0:
+                raise RuntimeError("Snap block %s didn't finish capturing in the allotted %2.2f seconds." % (name, wait_period))
+        return [lengths[name] for name in snap_names]
+
     def get_adc_snapshot(self, snap_name = None, bitwidth=8, man_trig=True, wait_period=2):
         """
         Reads a one-channel snapshot off the given 
-        ROACH and returns the time-ordered samples.
+        ROACH and returns the time-ordered samples as an np.int8 array.
+        The array is a read-only view of the received bytes; copy it or
+        convert it (eg. with tolist) if you need to change it.
         """
         
         snap_name = "adcsnap%d" % self.zdok if snap_name is None else snap_name
@@ -55,13 +176,61 @@ class AdcSnapshot:
         # if this is a unit test, return some canned data
         if self.test:
             fn = "testdata/adc_snapshots/snapshot_%s_1" % snap_name
-            return np.genfromtxt(fn, dtype=int)
+            return fixture_cache.get(fn, np.int8)
 
         grab = self.roach.snapshot_get(snap_name, man_trig=man_trig, wait_period=wait_period)
         
-        data = unpack('%ib' %grab['length'], grab['data'])
-    
-        return list(d for d in data) 
+        return np.frombuffer(grab['data'], dtype=np.int8, count=grab['length'])
+
+    def prefetch_snapshots(self, repeat, snap_name = None, man_trig=True, wait_period=2, depth=2, dual=False):
+        """
+        A generator of repeat snapshots that are captured on a background
+        thread, so the next snapshot is being taken while the caller works
+        on the last one.  At most depth snapshots wait in the queue.  An
+        error in the capture is raised in the caller.  If dual, each
+        snapshot is of both zdoks, from get_dual_snapshot.
+        """
+        if dual:
+            snap_name = "dual"
+            grab = lambda: self.get_dual_snapshot(man_trig=man_trig, wait_period=wait_period)
+        else:
+            snap_name = self.get_snap_name(self.zdok) if snap_name is None else snap_name
+            grab = lambda: self.get_adc_snapshot(snap_name, man_trig=man_trig, wait_period=wait_period)
+        queue = Queue.Queue(maxsize = depth)
+        stop = threading.Event()
+
+        def put(item):
+            # give up if the caller has stopped reading
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout = 0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def capture():
+            try:
+                for i in range(repeat):
+                    snap = grab()
+                    if not put((True, snap)):
+                        return
+            except Exception:
+                put((False, sys.exc_info()))
+
+        thread = threading.Thread(target = capture, name = "prefetch %s" % snap_name)
+        thread.daemon = True
+        thread.start()
+        try:
+            for i in range(repeat):
+                ok, item = queue.get()
+                if not ok:
+                    raise item[0], item[1], item[2]
+                yield item
+        finally:
+            # let a capture in progress finish rather than leave it running
+            stop.set()
+            thread.join()
 
     def get_test_vector(self, snap_names, bitwidth=8, man_trig=True, wait_period=2, iteration = None):
         """
@@ -70,6 +239,8 @@ class AdcSnapshot:
         phase parameter to reduce bit errors.
     
         core_a, core_c, core_b, core_d = get_test_vector(roach, snap_names)
+
+        The ramps are returned as a (cores, samples) np.uint8 array.
     
         NOTE: This function requires the ADC to be in "test" mode, please use 
         set_spi_control(roach, zdok_n, test=1) before-hand to be in the correct 
@@ -85,8 +256,18 @@ class AdcSnapshot:
                 # get the data from saved files; set up specifially for the unit test
                 i = iteration if iteration is not None else 1
                 fn = "testdata/adc_snapshots/snapshot_%s_%i" % (snap, i) 
-                data = np.genfromtxt(fn, dtype=int)
-            data_bin = list(((p+128)>>1) ^ (p+128) for p in data)
-            for i in range(cores_per_snap):
-                data_out.append(data_bin[i::cores_per_snap])
-        return data_out          
+                data = fixture_cache.get(fn, np.int8)
+            data_bin = self.decode_ramp(data)
+            n = len(data_bin) // cores_per_snap
+            # de-interleave: row i holds every cores_per_snap'th sample from i
+            data_out.append(data_bin[:n*cores_per_snap].reshape(n, cores_per_snap).T)
+        return np.concatenate(data_out)
+
+    def decode_ramp(self, data):
+        """
+        Decode the samples of a test ramp snapshot to codes, as a np.uint8
+        array.  The samples are made offset binary by flipping the sign bit,
+        (ie. p+128) and then x ^ (x >> 1) is applied to every sample at once.
+        """
+        x = np.asarray(data, dtype=np.int8).view(np.uint8) ^ np.uint8(0x80)
+        return x ^ (x >> 1)          
@@ -0,0 +1,104 @@
+import logging
+import cPickle as pickle
+
+logger = logging.getLogger('adc5gLogging')
+
+# the FpgaClient calls that change the roach, and those that read it back
+WRITES = ['blindwrite', 'write_int', 'progdev']
+READS = ['read', 'read_uint', 'snapshot_get', '_request', 'is_connected']
+
+def call_key(method, args, kwargs):
+    "The key that a read is recorded and replayed under."
+    if method == 'snapshot_get':
+        # the trigger and wait options don't change what is read
+        return (method, args[0] if args else kwargs.get('dev_name'))
+    return (method,) + tuple(args) + tuple(sorted(kwargs.items()))
+
+class RecordingFpgaClient:
+
+    """
+    Wraps a corr.katcp_wrapper.FpgaClient and records every blindwrite,
+    write_int, progdev, read, read_uint, snapshot_get and katcp _request
+    (eg. from ValonKATCP) made through it, with its result.  Each call is
+    pickled to the recording file as it is made, so a recording survives
+    a failed run.  Anything else is passed to the FpgaClient unrecorded.
+    """
+
+    def __init__(self, roach, filename):
+        self.roach = roach
+        self.filename = filename
+        self.file = open(filename, 'wb')
+        self.n_calls = 0
+
+    def record(self, method, args, kwargs):
+        result = getattr(self.roach, method)(*args, **kwargs)
+        pickle.dump((method, args, kwargs, result), self.file, pickle.HIGHEST_PROTOCOL)
+        self.file.flush()
+        self.n_calls += 1
+        return result
+
+    def close(self):
+        self.file.close()
+        logger.info("recorded %d roach calls to %s" % (self.n_calls, self.filename))
+
+    def __getattr__(self, name):
+        if name in WRITES or name in READS:
+            return lambda *args, **kwargs: self.record(name, args, kwargs)
+        return getattr(self.roach, name)
+
+def read_recording(filename):
+    "Returns the (method, args, kwargs, result) of every call in a recording."
+    calls = []
+    f = open(filename, 'rb')
+    try:
+        while True:
+            calls.append(pickle.load(f))
+    except EOFError:
+        pass
+    f.close()
+    return calls
+
+class ReplayFpgaClient:
+
+    """
+    Stands in for a corr.katcp_wrapper.FpgaClient, serving back the reads
+    of a recording made with RecordingFpgaClient, without any hardware.
+    The results of each distinct read (method and arguments) are served in
+    the order they were recorded; a read that was never recorded raises a
+    KeyError, and one more than were recorded raises an Exception, since
+    the run has gone past its recording.  Writes are not checked against
+    the recording, just kept in self.writes.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.replies = {}
+        self.next_reply = {}
+        self.writes = []
+        for method, args, kwargs, result in read_recording(filename):
+            if method in READS:
+                key = call_key(method, args, kwargs)
+                self.replies.setdefault(key, []).append(result)
+        logger.info("replaying %d distinct roach reads from %s" % (len(self.replies), filename))
+
+    def replay(self, method, args, kwargs):
+        if method in WRITES:
+            self.writes.append((method, args, kwargs))
+            return None
+        key = call_key(method, args, kwargs)
+        if key not in self.replies:
+            raise KeyError("%s was not recorded in %s" % (str(key), self.filename))
+        replies = self.replies[key]
+        i = self.next_reply.get(key, 0)
+        if i >= len(replies):
+            raise Exception("%s was only recorded %d times in %s" % (str(key), len(replies), self.filename))
+        self.next_reply[key] = i + 1
+        return replies[i]
+
+    def close(self):
+        pass
+
+    def __getattr__(self, name):
+        if name in WRITES or name in READS:
+            return lambda *args, **kwargs: self.replay(name, args, kwargs)
+        raise AttributeError(name)
@@ -9,7 +9,7 @@ logger = logging.getLogger('adc5gLogging')
 
 class INL:
 
-    def __init__(self, zdok = 0, dir = None, spi = None, now = None, roach_name = None, test = False):
+    def __init__(self, zdok = 0, dir = None, spi = None, now = None, roach_name = None, test = False, artifacts = 'full', settle = True):
 
         self.dir = dir
         self.test = test
@@ -18,6 +18,11 @@ class INL:
 
         self.spi = spi
 
+        # which files are written; see fit_cores.artifact_levels
+        self.artifacts = artifacts
+        # wait for the ADC to settle after changing it
+        self.settle = settle
+
         self.now = datetime.now() if now is None else now
 
         self.time_frmt = '%Y-%m-%d-%H%M%S'
@@ -65,12 +70,17 @@ class INL:
         self.set_inls(c)
 
     def set_inls(self, inls, zdok = None):
+        "Set the INL registers of all four cores from a 4x17 array of corrections."
         if zdok is not None:
             self.set_zdok(zdok)
-        for i in range(self.n_cores):
-            self.spi.set_inl_registers(self.cores[i], inls[i])
+        self.spi.set_all_inl_registers(inls)
 
-    def do_inl(self, zdok):
+    def do_inl(self, zdok, residuals = None):
+        """
+        Compute and set the INL corrections for zdok.  The residuals are
+        read from the snapshot .res file unless a 256x4 array of them, as
+        kept by the OGP fits, is given.
+        """
        
         self.set_zdok(zdok)
 
@@ -83,42 +93,48 @@ class INL:
         logger.debug("Clearing INL")
         #rww_tools.clear_inl()
         self.clear_inl()
-        logger.debug("sleeping for 1 secs")
-        time.sleep(1)
+        if self.settle:
+            logger.debug("sleeping for 1 secs")
+            time.sleep(1)
 
         #fit_cores.fit_inl(FNAME + ".res")
         # The .res file used here is a 256 by 4 (by cores?) list of residuals.  TBF: who writes this?
         # This is used to compute the INLs, which are stored in inl*.meas
-        self.inls = fit_cores.fit_inl(self.get_snapshot_res_filename(), outname = self.get_inl_meas_filename())
+        self.inls = fit_cores.fit_inl(self.get_snapshot_res_filename()
+                                    , outname = self.get_inl_meas_filename()
+                                    , residuals = residuals
+                                    , artifacts = self.artifacts)
 
         #rww_tools.update_inl(fname = 'inl%s.meas'%timestamp)
-        self.update_inl() #fname = self.get_inl_meas_filename())
+        # the corrections rounded as they are in the inl*.meas file
+        meas = np.array([['%7.4f' % v for v in core] for core in self.inls], dtype=float)
+        self.update_inl(inls = meas) #fname = self.get_inl_meas_filename())
         logger.debug('INL done')
 
     def clear_inl(self):
         "Clear the INL registers on the ADC"
-        offs = [0.0]*17
         #for chan in range(1,5):
-        for chan in self.cores:
-            self.spi.set_inl_registers(chan, offs)
+        self.spi.set_all_inl_registers(np.zeros((self.n_cores, 17)))
 
-    def update_inl(self, fname = None, set=True):
+    def update_inl(self, fname = None, set=True, inls = None):
         """
         Retreive the INL data from the ADC and add in the corrections from
-        the measured inl (in inl.meas).  Store in the file 'inl'
+        the measured inl (in inl.meas, or the 4x17 inls given).  Store in
+        the file 'inl', unless the artifact level is 'none'.
         """
-        fname = fname if fname is not None else self.get_inl_meas_filename()
+        if inls is None:
+            fname = fname if fname is not None else self.get_inl_meas_filename()
+            inls = np.genfromtxt(fname, usecols=(1,2,3,4), unpack=True)
 
         cur_inl = self.get_inl_array()
-        meas_inl = np.genfromtxt(fname)
-        for level in range(17):
-          cur_inl[level][1:] += meas_inl[level][1:]
+        cur_inl[:, 1:] += np.transpose(inls)
         #inlfn = "inl" + timestamp
-        inlfn = self.get_inl_filename()
-        logger.debug("savtxt to ..." + inlfn)
-        np.savetxt(inlfn, cur_inl, fmt=('%3d','%7.4f','%7.4f','%7.4f','%7.4f'))
+        if fit_cores.keep_artifacts(self.artifacts, 'summary'):
+            inlfn = self.get_inl_filename()
+            logger.debug("savtxt to ..." + inlfn)
+            np.savetxt(inlfn, cur_inl, fmt=('%3d','%7.4f','%7.4f','%7.4f','%7.4f'))
         if set:
-          self.set_inl(fname)
+          self.set_inls(inls)
 
     def get_inl_array(self):
         """
@@ -137,6 +153,5 @@ class INL:
         Columns 2-5 contain the inl correction for cores a-d
         """
         c = np.genfromtxt(fname, usecols=(1,2,3,4), unpack=True)
-        for i in range(self.n_cores):
-            self.spi.set_inl_registers(self.cores[i], c[i])
+        self.set_inls(c)
 
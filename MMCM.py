@@ -11,9 +11,11 @@ logger = logging.getLogger('adc5gLogging')
 
 class MMCM:
 
-    def __init__(self, zdok = 0, spi = None, adc = None,  test = False, file_label = None):
+    def __init__(self, zdok = 0, spi = None, adc = None,  test = False, file_label = None, archive = None):
 
         self.adc = adc
+        # an optional SnapshotArchive for the ramps of each phase step
+        self.archive = archive
         self.test = test
         self.spi = spi
         #self.file_label = file_label
@@ -68,7 +70,7 @@ class MMCM:
             for ps in range(optimal_ps):
                 self.spi.inc_mmcm_phase()
             # now just double check that there's no glitches here    
-            glitches = self.get_total_glitches(snap_names, man_trig, wait_period, ps)
+            glitches = self.get_total_glitches(snap_names, man_trig, wait_period, optimal_ps, purpose = 'mmcm_check')
             if glitches != 0:
                 tmsg = "MMCM Optimal Phase of %d should not produce any glitches of %d" % (optimal_ps, glitches)
                 logger.info(tmsg);
@@ -80,20 +82,25 @@ class MMCM:
         return optimal_ps, glitches_per_ps        
 
    
-    def get_total_glitches(self, snap_names, man_trig, wait_period, iteration):
-
+    def get_total_glitches(self, snap_names, man_trig, wait_period, iteration, purpose = 'mmcm'):
+        """
+        Counts the glitches in the test vector ramps of the current phase
+        step (iteration), archiving the ramps under purpose.
+        """
         cores = self.adc.get_test_vector(snap_names, man_trig=man_trig, wait_period=wait_period, iteration=iteration)
-        return sum([self.count_glitches(core, 8) for core in cores]) 
+        if self.archive is not None:
+            self.archive.append(cores, self.zdok, purpose, phase = iteration)
+        return int(self.count_glitches(cores, 8).sum())
 
     def count_glitches(self, core, bitwidth=8):
-        "Counts number of times the expected result is not found in the ramp."
+        """
+        Counts number of times the expected result is not found in the ramp.
+        Given a (cores, samples) array, counts the glitches of each core.
+        """
         ramp_max = 2**bitwidth - 1
-        glitches = 0
-        for i in range(len(core)-1):
-            diff = core[i+1] - core[i]
-            if (diff!=1) and (diff!=-ramp_max):
-                glitches += 1
-        return glitches        
+        # widen the codes; a uint8 difference would wrap around
+        diff = np.diff(np.asarray(core, dtype=int), axis=-1)
+        return ((diff != 1) & (diff != -ramp_max)).sum(axis=-1)
 
     def find_optimal_phase_old(self, glitches_per_ps):    
         "Historical method: has bugs concerning edge cases"
@@ -4,12 +4,13 @@ import numpy as np
 from datetime import datetime
 
 import fit_cores
+from AdcSnapshot import fixture_cache
 
 logger = logging.getLogger('adc5gLogging')
 
 class OGP:
 
-    def __init__(self, zdok = 0, dir = None, gpib = None, spi = None, adc = None, now = None, roach_name = None, test = False, clockrate = None):
+    def __init__(self, zdok = 0, dir = None, gpib = None, spi = None, adc = None, now = None, roach_name = None, test = False, clockrate = None, archive = None, prefetch = False, artifacts = 'full', settle = True, prescreen = True, prescreen_retries = 2, prescreen_limits = None):
 
         self.dir = dir
         self.test = test
@@ -19,6 +20,19 @@ class OGP:
         self.gpib = gpib
         self.spi = spi
         self.adc = adc
+        # an optional SnapshotArchive that takes the place of the raw snapshot files
+        self.archive = archive
+        # take the next snapshot while the last one is being fit
+        self.prefetch = prefetch
+        # check each live snapshot before fitting it, retaking bad ones;
+        # prescreen_limits are keyword arguments of fit_cores.prescreen_snapshot
+        self.prescreen = prescreen
+        self.prescreen_retries = prescreen_retries
+        self.prescreen_limits = dict(prescreen_limits) if prescreen_limits is not None else {}
+        # which files are written; see fit_cores.artifact_levels
+        self.artifacts = artifacts
+        # wait for the ADC to settle after changing it
+        self.settle = settle
 
         self.now = datetime.now() if now is None else now
 
@@ -34,7 +48,15 @@ class OGP:
         #self.samp_freq = 2*self.clockrate
         self.ogps = []
 
+        # the running averages of the snapshot fits
+        self.acc = fit_cores.FitAccumulator()
+        # the code residuals of the last do_ogp for each zdok, for the INLs
+        self.residuals = {}
+
     def set_clockrate(self, clockrate):
+        # the cached sin/cos basis of the fits depends on the sample rate
+        if clockrate != getattr(self, 'clockrate', clockrate):
+            fit_cores.basis_cache.clear()
         self.clockrate = clockrate
         self.samp_freq = self.clockrate * 2
 
@@ -57,23 +79,40 @@ class OGP:
     def get_snapshot_filename(self):
         return "%s/snapshot_raw%s.dat" % (self.dir, self.file_label)
 
+    def get_hist_filename(self):
+        return "%s/hist_cores%s" % (self.dir, self.file_label)
+
     def load_from_file(self, filename, zdok = None):
         """
          Clear the control register and then load the offset, gain and phase
          registers for each core.  These values are hard coded for now.
         """
-        if zdok is not None:
-            self.set_zdok(zdok)
-        self.spi.set_control() 
-        t = np.genfromtxt(filename)
+        self.load_ogp(np.genfromtxt(filename), zdok)
+
+    def load_ogp(self, t, zdok = None):
+        "Like load_from_file, but from the 12 values in memory."
         # split these up by type and channel
         offs   = [t[i] for i in range(0,10,3)]
         gains  = [t[i] for i in range(1,11,3)]
         phases = [t[i] for i in range(2,12,3)]
         # and send them down
-        self.set_offsets(offs)
-        self.set_gains(gains)
-        self.set_phases(phases)    
+        self.set_ogps(offs, gains, phases, zdok)
+
+    def set_ogps(self, offs, gains, phases, zdok = None):
+        """
+        Clear the control register and then load the offset, gain and phase
+        of each core in turn, in one SPI transaction so that each core is
+        selected only once.
+        """
+        if zdok is not None:
+            self.set_zdok(zdok)
+        assert (len(offs) == len(gains) == len(phases) == self.n_cores)
+        with self.spi.transaction():
+            self.spi.set_control() 
+            for i in range(self.n_cores):
+                self.spi.set_offset(self.cores[i], offs[i])
+                self.spi.set_gain(self.cores[i], gains[i])
+                self.spi.set_phase(self.cores[i], phases[i])
 
     def set_offsets(self, values):
         assert (len(values) == self.n_cores)
@@ -90,11 +129,12 @@ class OGP:
         for i in range(self.n_cores):
             self.spi.set_phase(self.cores[i], values[i])
 
-    def do_ogp(self, zdok, test_freq=18.3105, repeat=10): 
+    def do_ogp(self, zdok, test_freq=18.3105, repeat=10, batch=False): 
 
         self.set_zdok(zdok)
 
-        time.sleep(1)
+        if self.settle:
+            time.sleep(1)
       
         logger.debug('doing ogp calibration for zdok %d' % zdok)
         logger.debug('test_freq: ' + str(test_freq) + '  repeat: ' + str(repeat))
@@ -105,15 +145,22 @@ class OGP:
         logger.debug("Clearing OGP")
         #rww_tools.clear_ogp()
         self.clear_ogp()
-        logger.debug("sleeping for 1 secs")
-        time.sleep(1)
+        if self.settle:
+            logger.debug("sleeping for 1 secs")
+            time.sleep(1)
 
         #ogp, sinad = rww_tools.dosnap(fr=test_freq,name=FNAME,rpt=repeat,donot_clear=False)
         fname = self.get_snapshot_filename()
         ogp, sinad = self.do_snap(freq = test_freq
                                 , fname = fname
                                 , repeat = repeat
-                                , donot_clear = False)
+                                , donot_clear = False
+                                , batch = batch)
+        self.set_ogp(ogp, sinad)
+
+    def set_ogp(self, ogp, sinad):
+        "Save and load the OGP from the fit results of the current zdok."
+        self.residuals[self.zdok] = self.acc.get_residuals()
 
         #ogp = np.zeros(16)
         #sinad = np.zeros(10)
@@ -122,22 +169,101 @@ class OGP:
         logger.debug('OGP:' + str(self.ogps))
         logger.debug('SINAD:' + str(sinad))
     
-        np.savetxt(self.get_ogp_filename(), self.ogps, fmt='%8.4f')
+        if fit_cores.keep_artifacts(self.artifacts, 'summary'):
+            np.savetxt(self.get_ogp_filename(), self.ogps, fmt='%8.4f')
     
-        # TBF: just use what's in memory, instead of the file
+        # load what's in memory, rounded as it is in the file
         logger.debug('Setting ogp')
-        self.load_from_file(self.get_ogp_filename())
+        self.load_ogp(np.array(['%8.4f' % v for v in self.ogps], dtype=float))
         logger.debug('done')
 
+    def do_ogp_dual(self, test_freq=18.3105, repeat=10, batch=False, prefetch=None):
+        """
+        Does the OGP calibration of both zdoks at once: each repeat snaps
+        both together with AdcSnapshot.get_dual_snapshot, and each zdok's
+        snapshot is fit into its own accumulator (self.accs).  batch and
+        prefetch are as for do_snap.
+        Returns the OGP of each zdok, as a dict.
+        """
+        logger.debug('doing ogp calibration for both zdoks')
+        logger.debug('test_freq: ' + str(test_freq) + '  repeat: ' + str(repeat))
+
+        zdoks = (0, 1)
+        fnames = {}
+        for zdok in zdoks:
+            self.set_zdok(zdok)
+            logger.debug("Clearing OGP for zdok %d" % zdok)
+            self.clear_ogp()
+            fnames[zdok] = self.get_snapshot_filename()
+        if self.settle:
+            logger.debug("sleeping for 1 secs")
+            time.sleep(1)
+
+        self.accs = dict([(zdok, fit_cores.FitAccumulator()) for zdok in zdoks])
+        sinads = dict([(zdok, 0.0) for zdok in zdoks])
+        snaps = dict([(zdok, []) for zdok in zdoks])
+        ogps = {}
+        live = self.get_screened_snapshots(repeat, test_freq, prefetch, dual = True) if not self.test else None
+        try:
+          for i in range(repeat):
+            if not self.test:
+                dual = live.next()
+            for zdok in zdoks:
+                if not self.test:
+                    snap = dual[zdok]
+                    fname2 = "%s.%d" % (fnames[zdok], i) if batch else fnames[zdok]
+                    self.save_snapshot(fname2, snap, test_freq, repeat = i, zdok = zdok)
+                else:
+                    # if we're testing, use the intermediate files
+                    fname2 = "%s.%d" % (fnames[zdok], i)
+                    snap = fixture_cache.get(fname2) if batch else None
+                if batch:
+                    snaps[zdok].append(snap)
+                    continue
+                ogps[zdok], pwr_sinad = fit_cores.fit_snap(test_freq
+                                              , self.samp_freq
+                                              , fname2
+                                              , clear_avgs = i == 0
+                                              , prnt = i == repeat-1
+                                              , samples = snap
+                                              , acc = self.accs[zdok]
+                                              , artifacts = self.artifacts)
+                sinads[zdok] += pwr_sinad
+        finally:
+          if live is not None:
+              # stops and joins the prefetch thread
+              live.close()
+
+        if batch:
+            # name the output files the way do_snap_batch does
+            for zdok in zdoks:
+                fname2 = fnames[zdok] if not self.test else "%s.%d" % (fnames[zdok], repeat-1)
+                ogps[zdok], avg_sinad, _ = fit_cores.fit_snap_batch(test_freq
+                                                  , self.samp_freq
+                                                  , fname2
+                                                  , np.array(snaps[zdok])
+                                                  , acc = self.accs[zdok]
+                                                  , artifacts = self.artifacts)
+                sinads[zdok] = avg_sinad * repeat
+
+        results = {}
+        for zdok in zdoks:
+            self.set_zdok(zdok)
+            self.acc = self.accs[zdok]
+            self.set_ogp(ogps[zdok], sinads[zdok]/repeat)
+            results[zdok] = self.ogps
+        return results
+
     def clear_ogp(self):
         "Sets Offset, Gain, and Phase for all cores to zero."
 
-        for core in self.cores:
-            self.spi.set_gain(core, 0)
-            self.spi.set_offset(core, 0)
-            self.spi.set_phase(core, 0)
+        with self.spi.transaction():
+            for core in self.cores:
+                self.spi.set_gain(core, 0)
+                self.spi.set_offset(core, 0)
+                self.spi.set_phase(core, 0)
 
-    def do_snap(self, freq=0, fname="t", repeat = 1, donot_clear=False):
+    def do_snap(self, freq=0, fname="t", repeat = 1, donot_clear=False, batch=False, prefetch=None):
         """
         Takes a snapshot and uses fit_cores to fit a sine function to each
         core separately assuming a CW signal is connected to the input.  The
@@ -157,21 +283,183 @@ class OGP:
           rpt  The number of repeats.  Defaults to 1.  The c1 .. c4 files mentioned
                above are overwritten with each repeat, but new rows of data are added
            to the .fit file for each pass.
+          batch If True, all the repeats are collected first and then fit together
+               in one pass.  The per-repeat results are written to the .ogp file
+               and kept in self.snap_fit.
+          prefetch If True, the next snapshot is taken on a background thread
+               while the last one is fit.  Defaults to self.prefetch.
         """
+        if batch:
+            return self.do_snap_batch(freq, fname, repeat, donot_clear, prefetch)
         avg_pwr_sinad = 0
+        snaps = self.get_screened_snapshots(repeat, freq, prefetch) if not self.test else None
+        try:
+          for i in range(repeat):
+            # We skip this interaction with hardware if this is a test, use 
+            if not self.test:
+                snap = snaps.next()
+                self.save_snapshot(fname, snap, freq, repeat = i)
+                fname2 = fname
+            else:
+                # if we're testing, use the intermediate files
+                snap = None
+                fname2 = "%s.%d" % (fname, i)
+            # the snapshot is fit from memory; the file is only read back in tests
+            ogp, pwr_sinad = fit_cores.fit_snap(freq
+                                              , self.samp_freq
+                                              , fname2
+                                              , clear_avgs = i == 0 and not donot_clear
+                                              , prnt = i == repeat-1
+                                              , samples = snap
+                                              , acc = self.acc
+                                              , artifacts = self.artifacts)
+            avg_pwr_sinad += pwr_sinad
+        finally:
+          if snaps is not None:
+              # stops and joins the prefetch thread
+              snaps.close()
+        return ogp, avg_pwr_sinad/repeat        
+
+    def get_snapshot(self):
+        return self.adc.get_adc_snapshot(man_trig=True, wait_period=2)
+
+    def get_dual_snapshot(self):
+        return self.adc.get_dual_snapshot(man_trig=True, wait_period=2)
+
+    def screen_snapshot(self, snap, freq, capture):
+        """
+        Prescreen a live snapshot (or both of a dual one) with
+        fit_cores.prescreen_snapshot, within self.prescreen_limits (its
+        defaults for any not given), before it is fit, retaking it with
+        capture up to self.prescreen_retries times.  Raises an Exception
+        with the reasons if no good snapshot is found.
+        """
+        if not self.prescreen:
+            return snap
+        tries = self.prescreen_retries + 1
+        for attempt in range(tries):
+            if attempt > 0:
+                snap = capture()
+            snap = np.asarray(snap)
+            screens = [fit_cores.prescreen_snapshot(s, freq, self.samp_freq, **self.prescreen_limits)
+                       for s in snap.reshape(-1, snap.shape[-1])]
+            reasons = [s.get_reasons() for s in screens if not s.ok()]
+            if len(reasons) == 0:
+                return snap
+            logger.warning("Snapshot rejected (try %d of %d): %s" % (attempt + 1, tries, ' / '.join(reasons)))
+        msg = "No good snapshot in %d tries, check the test tone: %s" % (tries, ' / '.join(reasons))
+        logger.error(msg)
+        raise Exception(msg)
+
+    def get_snapshots(self, repeat, prefetch = None, dual = False):
+        """
+        An iterator over repeat live snapshots, prefetched on a thread if
+        asked.  If dual, each is of both zdoks, as from get_dual_snapshot.
+        """
+        prefetch = self.prefetch if prefetch is None else prefetch
+        if prefetch:
+            return self.adc.prefetch_snapshots(repeat, man_trig=True, wait_period=2, dual=dual)
+        capture = self.get_dual_snapshot if dual else self.get_snapshot
+        return (capture() for i in range(repeat))
+
+    def get_screened_snapshots(self, repeat, freq, prefetch = None, dual = False):
+        """
+        A generator of repeat live snapshots that have passed
+        screen_snapshot.  A rejected snapshot is retaken from the same
+        stream of snapshots, so with prefetching the retake is the prefetch
+        thread's next capture and never races it for the snap block.  When
+        the retakes have used up the stream, another is started (after the
+        last one's thread has finished) for the snapshots still needed.
+        Close the generator if it isn't run to the end.
+        """
+        accepted = [0]
+        stream = [self.get_snapshots(repeat, prefetch, dual)]
+
+        def take():
+            try:
+                return stream[0].next()
+            except StopIteration:
+                stream[0] = self.get_snapshots(repeat - accepted[0], prefetch, dual)
+                return stream[0].next()
+
+        try:
+            for i in range(repeat):
+                accepted[0] = i
+                yield self.screen_snapshot(take(), freq, take)
+        finally:
+            stream[0].close()
+
+    def save_snapshot(self, fname, snap, freq, repeat = 0, purpose = 'ogp', zdok = None):
+        """
+        Write a raw snapshot in the binary format, with its setup in the
+        header, or append it to the snapshot archive if there is one.
+        The snapshot is of the current zdok unless zdok is given.  Without
+        an archive, the file is only written at the 'full' artifact level.
+        """
+        zdok = self.zdok if zdok is None else zdok
+        if self.archive is not None:
+            self.archive.append(snap, zdok, purpose, repeat = repeat)
+            return
+        if not fit_cores.keep_artifacts(self.artifacts, 'full'):
+            return
+        fit_cores.write_snapshot(fname, snap
+                               , roach = self.roach_name
+                               , zdok = zdok
+                               , clockrate = self.clockrate
+                               , freq = freq
+                               , timestamp = datetime.now().strftime(self.time_frmt))
+
+    def do_hist(self, zdok, repeat=100, donot_clear=False, prefetch=None):
+        """
+        Streams repeat snapshots of a CW signal into a histogram of the codes
+        of each core (self.code_hist) and fits each core's cumulative
+        histogram; the histogram method of finding the INL corrections.
+        The histogram is written to the hist file, and the 256x4 array of
+        residuals, ready for INL.do_inl, is returned.
+        """
+        self.set_zdok(zdok)
+        if not donot_clear or not hasattr(self, 'code_hist'):
+            self.code_hist = fit_cores.CodeHistogram()
+        fname = self.get_snapshot_filename()
+        snaps = self.get_snapshots(repeat, prefetch) if not self.test else None
         for i in range(repeat):
-          # We skip this interaction with hardware if this is a test, use 
           if not self.test:
-              snap = self.adc.get_adc_snapshot(man_trig=True, wait_period=2)
-              np.savetxt(fname, snap,fmt='%d')
-              fname2 = fname
+              snap = snaps.next()
+              if self.archive is not None:
+                  self.archive.append(snap, self.zdok, 'hist', repeat = i)
           else:
               # if we're testing, use the intermediate files
-              fname2 = "%s.%d" % (fname, i)
-          ogp, pwr_sinad = fit_cores.fit_snap(freq
+              snap = fixture_cache.get("%s.%d" % (fname, i))
+          self.code_hist.add(snap)
+        if fit_cores.keep_artifacts(self.artifacts, 'full'):
+            self.code_hist.write(self.get_hist_filename())
+        params, residuals = self.code_hist.fit()
+        logger.debug('histogram fit amplitudes, offsets: ' + str(params))
+        return residuals
+
+    def do_snap_batch(self, freq, fname, repeat, donot_clear=False, prefetch=None):
+        "Collects all the repeated snapshots, then fits them in one pass."
+        snaps = []
+        live = self.get_screened_snapshots(repeat, freq, prefetch) if not self.test else None
+        try:
+          for i in range(repeat):
+            if not self.test:
+                snap = live.next()
+                self.save_snapshot("%s.%d" % (fname, i), snap, freq, repeat = i)
+            else:
+                # if we're testing, use the intermediate files
+                snap = fixture_cache.get("%s.%d" % (fname, i))
+            snaps.append(snap)
+        finally:
+          if live is not None:
+              live.close()
+        # name the output files the way do_snap does for the last repeat
+        fname2 = fname if not self.test else "%s.%d" % (fname, repeat-1)
+        ogp, avg_pwr_sinad, self.snap_fit = fit_cores.fit_snap_batch(freq
                                             , self.samp_freq
                                             , fname2
-                                            , clear_avgs = i == 0 and not donot_clear
-                                            , prnt = i == repeat-1)
-          avg_pwr_sinad += pwr_sinad
-        return ogp, avg_pwr_sinad/repeat        
+                                            , np.array(snaps)
+                                            , clear_avgs = not donot_clear
+                                            , acc = self.acc
+                                            , artifacts = self.artifacts)
+        return ogp, avg_pwr_sinad
@@ -1,6 +1,7 @@
 import numpy as np
 from struct import pack, unpack
 from math import floor
+from contextlib import contextmanager
 
 CONTROL_REG_ADDR = 0x01 + 0x80
 CHANSEL_REG_ADDR = 0x0f + 0x80
@@ -10,6 +11,31 @@ EXTPHAS_REG_ADDR = 0x24 + 0x80
 CALCTRL_REG_ADDR = 0x10 + 0x80
 FIRST_EXTINL_REG_ADDR = 0x30 + 0x80
 
+# the registers (without the write bit) that each channel has its own copy
+# of, selected by CHANSEL
+CHANNEL_REGS = [0x20, 0x22, 0x24] + range(0x30, 0x36)
+
+# the bits of CALCTRL, and the channel registers each one latches
+CALCTRL_LATCHES = [(2<<2, [0x20]), (2<<4, [0x22]), (2<<6, [0x24]), (2, range(0x30, 0x36))]
+
+# The INL levels (0, 16, ... 240, 255) are packed into the six INL
+# registers two bits at a time: the register (of the first three) and bit
+# of each level, and a (levels, registers) one hot table of the registers.
+INL_LEVEL_REGS = np.array([2]*4 + [1]*8 + [0]*5)
+INL_LEVEL_BITS = np.array(range(8, 16, 2) + range(0, 16, 2) + range(0, 10, 2))
+INL_LEVEL_ONEHOT = (INL_LEVEL_REGS[:, None] == np.arange(3)[None, :]).astype(int)
+# the 4 bit code of -4 ... 4 steps of 0.15 lsb, and back again
+INL_LEVEL_TO_BITS = np.array([5,4,6,1,0,2,9,8,10])
+INL_BITS_TO_OFF = np.array([0,1,-1,0,3,4,2,0,-3,-2,-4])
+
+# a record of read_calibration_state: the calibration of one core of a zdok
+CALIBRATION_STATE_DTYPE = np.dtype([('zdok', int)
+                                  , ('core', int)
+                                  , ('offset', float)
+                                  , ('gain', float)
+                                  , ('phase', float)
+                                  , ('inl', float, (17,))])
+
 OPB_CONTROLLER = 'adc5g_controller'
 OPB_DATA_FMT = '>H2B'
 
@@ -24,7 +50,7 @@ class SPI:
     This class is responsible for writing .... TBF
     """
 
-    def __init__(self, zdok = 0, roach = None, test = False):
+    def __init__(self, zdok = 0, roach = None, test = False, differential = False):
 
 
         if roach is None and not test:
@@ -50,6 +76,25 @@ class SPI:
   
         self.roach_original_control = {'0':None, '1':None}
 
+        # the writes collected by an open transaction, and the channel
+        # each zdok has selected in it
+        self.pending = None
+        self.selected = {}
+
+        # the shadow of each zdok's ADC registers: the values we have
+        # written or read, keyed by (register, channel); the channel is
+        # None for the registers that aren't per channel
+        self.shadow = {0 : {}, 1 : {}}
+
+        # in differential mode, writes of values the shadow already holds
+        # are left out.  A channel selection is held back (in wanted) until
+        # a register of that channel has to be written or read, and CALCTRL
+        # is only written if a register it latches was: dirty holds the
+        # (register, channel) keys of each zdok written since their latch.
+        self.differential = differential
+        self.wanted = {}
+        self.dirty = {}
+
         # for testing
         self.regs = []
         self.writes = []
@@ -65,6 +110,106 @@ class SPI:
         """
         return 0x04 + (self.zdok*0x04)
 
+    def get_shadow_key(self, reg_addr, zdok = None):
+        """
+        The shadow key of a register, or None if the register isn't
+        shadowed: CALCTRL starts a calibration rather than holding a value,
+        and a per channel register can't be placed until a channel is
+        selected.
+        """
+        zdok = self.zdok if zdok is None else zdok
+        reg_addr = int(reg_addr) & 0x7f
+        if reg_addr == CALCTRL_REG_ADDR - 0x80:
+            return None
+        if reg_addr not in CHANNEL_REGS:
+            return (reg_addr, None)
+        chan = self.get_channel(zdok)
+        if chan is None:
+            return None
+        return (reg_addr, chan)
+
+    def get_channel(self, zdok):
+        "The channel zdok has selected, or will have once it is needed."
+        return self.wanted.get(zdok, self.shadow[zdok].get((CHANSEL_REG_ADDR - 0x80, None)))
+
+    def get_shadow(self, reg_addr):
+        "The shadowed value of a register of the current zdok, or None."
+        key = self.get_shadow_key(reg_addr)
+        return self.shadow[self.zdok].get(key) if key is not None else None
+
+    def set_shadow(self, reg_addr, reg_val, zdok = None):
+        zdok = self.zdok if zdok is None else zdok
+        key = self.get_shadow_key(reg_addr, zdok)
+        if key is not None:
+            self.shadow[zdok][key] = int(reg_val)
+
+    def invalidate(self, zdok = None):
+        """
+        Forget the shadowed registers of zdok, or of both zdoks, so they
+        are read from the ADC again; eg. after the ADC has been reset or
+        written by someone else.  The channel selected, or held back, is
+        kept to be sent again before the next channel register, and the
+        written registers still waiting for their latch stay dirty.
+        """
+        for z in ([0, 1] if zdok is None else [zdok]):
+            chan = self.get_channel(z)
+            self.shadow[z] = {}
+            if chan is not None:
+                self.wanted[z] = chan
+
+    def refresh(self):
+        """
+        Read the control, test mode and all the per channel registers of
+        the current zdok from the ADC into its shadow.
+        """
+        self.invalidate(self.zdok)
+        self.get_spi_register(CONTROL_REG_ADDR - 0x80)
+        self.get_spi_register(0x05)
+        for chan in self.cores:
+            self.set_spi_register(CHANSEL_REG_ADDR, chan)
+            for reg_addr in CHANNEL_REGS:
+                self.get_spi_register(reg_addr)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Collects the writes made in a with block and sends them when it
+        ends, leaving out the CHANSEL writes that select a channel that is
+        already selected:
+
+            with spi.transaction():
+                spi.set_offset(1, off)
+                spi.set_gain(1, gain)
+
+        selects channel 1 once instead of twice.  Transactions nest, and the
+        writes are sent when the outermost one ends.  Reads send the writes
+        collected so far first.  The OPB controller takes one SPI word per
+        write, so each write is still its own blindwrite.
+        """
+        outer = self.pending is None
+        if outer:
+            self.pending = []
+            self.selected = {}
+        try:
+            yield self
+        finally:
+            if outer:
+                self.flush()
+                self.pending = None
+                self.selected = {}
+
+    def flush(self):
+        "Send the writes collected by the open transaction."
+        if self.pending is None:
+            return
+        pending, self.pending = self.pending, []
+        for offset, data, reg in pending:
+            if reg is not None and reg[0] == CHANSEL_REG_ADDR:
+                if self.selected.get(offset) == reg[1]:
+                    continue
+                self.selected[offset] = reg[1]
+            self.send(offset, data, reg)
+
     def set_offsets(self, values):
         assert (len(values) == self.n_cores)
         for i in range(self.n_cores):
@@ -140,17 +285,83 @@ class SPI:
         """
         Sets the value of an ADC's register over SPI
         """
-        #if self.test:
-        # record what our values are
-        self.regs.append((reg_addr, reg_val))
-
         spi_data = pack(OPB_DATA_FMT, reg_val, reg_addr, 0x01)
 
         zdok_offset = self.get_zdok_offset()
 
-        self.blindwrite(spi_data, zdok_offset)
+        self.blindwrite(spi_data, zdok_offset, reg = (reg_addr, reg_val))
 
-    def blindwrite(self, data, offset):
+    def blindwrite(self, data, offset, reg = None):
+        "Write to the OPB controller, or add the write to the open transaction."
+        if self.pending is not None:
+            self.pending.append((offset, data, reg))
+        else:
+            self.send(offset, data, reg)
+
+    def needs_write(self, offset, reg):
+        """
+        In differential mode, whether a register write changes anything on
+        the ADC.  Channel selections are held back until they are needed.
+        """
+        zdok = (offset - 0x04) // 0x04
+        reg_addr, reg_val = int(reg[0]) & 0x7f, int(reg[1])
+        if reg_addr == CHANSEL_REG_ADDR - 0x80:
+            self.wanted[zdok] = reg_val
+            return False
+        if reg_addr == CALCTRL_REG_ADDR - 0x80:
+            return self.needs_latch(zdok, reg_val)
+        key = self.get_shadow_key(reg_addr, zdok)
+        if key is not None and self.shadow[zdok].get(key) == reg_val:
+            return False
+        if reg_addr in CHANNEL_REGS:
+            self.select_channel(zdok)
+            if key is not None:
+                self.dirty.setdefault(zdok, set()).add(key)
+        return True
+
+    def needs_latch(self, zdok, calctrl):
+        """
+        Whether a CALCTRL write latches a register of the selected channel
+        that was written since its last latch.  If we can't tell which,
+        it is written.
+        """
+        chan = self.get_channel(zdok)
+        known = sum([bit for bit, regs in CALCTRL_LATCHES])
+        if chan is None or calctrl & ~known:
+            self.select_channel(zdok)
+            return True
+        latched = set([(reg_addr, chan) for bit, regs in CALCTRL_LATCHES
+                       if calctrl & bit for reg_addr in regs])
+        dirty = self.dirty.get(zdok, set())
+        if not dirty & latched:
+            return False
+        dirty -= latched
+        self.select_channel(zdok)
+        return True
+
+    def select_channel(self, zdok):
+        "Send the channel selection held back in differential mode, if any."
+        chan = self.wanted.pop(zdok, None)
+        if chan is not None and chan != self.shadow[zdok].get((CHANSEL_REG_ADDR - 0x80, None)):
+            reg = (CHANSEL_REG_ADDR, chan)
+            self.transmit(0x04 + zdok*0x04, pack(OPB_DATA_FMT, chan, CHANSEL_REG_ADDR, 0x01), reg)
+
+    def send(self, offset, data, reg = None):
+        if self.differential and reg is not None and not self.needs_write(offset, reg):
+            return
+        self.transmit(offset, data, reg)
+
+    def transmit(self, offset, data, reg = None):
+
+        #if self.test:
+        # record what our values are
+        if reg is not None:
+            zdok = (offset - 0x04) // 0x04
+            self.regs.append(reg)
+            if int(reg[0]) == CHANSEL_REG_ADDR:
+                # this selection supersedes any held back
+                self.wanted.pop(zdok, None)
+            self.set_shadow(reg[0], reg[1], zdok = zdok)
 
         # record what we do
         self.writes.append((offset, data))
@@ -161,8 +372,15 @@ class SPI:
 
     def get_spi_register(self, reg_addr):
         """
-        Gets the value of an ADC's register over SPI
+        Gets the value of an ADC's register over SPI, or from the shadow
+        if we already know it.
         """
+        # the read must see the writes before it
+        self.flush()
+        reg_val = self.get_shadow(reg_addr)
+        if reg_val is not None:
+            return reg_val
+        self.select_channel(self.zdok)
         spi_data = pack(OPB_DATA_FMT, 0x0, reg_addr, 0x01)
         offset = self.get_zdok_offset()
         if not self.test:
@@ -175,30 +393,25 @@ class SPI:
         if old_reg_addr is not reg_addr:
             raise ValueError("Could not read SPI register!")
         else:
+            if not self.test:
+                self.set_shadow(reg_addr, reg_val)
             return reg_val
 
     def inl_values_to_reg_values(self, offs):
-        level_to_bits = np.array([5,4,6,1,0,2,9,8,10])
-    
-        # create a array of 6 ints to hold the values for the registers
-        regs = np.zeros((6), dtype='int32')
-        r = 2	# r is the relative register number.  R = 2 for 0x32 and 0x35
-        regbit = 8 #  regbit is the bit in the register
-        for level in range(17):	# n is the bit number in the incoming bits aray
-            n = int(floor(0.5 + offs[level]/0.15))
-            if n > 4:
-                n = 4
-            if n < -4:
-                n = -4
-    	    i = level_to_bits[4-n]
-            regs[r] |= ((i >>2) & 3) << regbit
-            regs[r + 3] |= (i & 3)<< regbit
-            if regbit == 14:
-                r -= 1
-                regbit = 0
-            else:
-                regbit += 2
-        return regs
+        """
+        Pack the 17 INL offsets of a channel into the values of its six
+        INL registers, or a (channels, 17) array of them into a (channels, 6)
+        array.  Each level is rounded to a number of 0.15 lsb steps, which
+        is coded in 4 bits: the high two go in the register and bit given by
+        INL_LEVEL_REGS and INL_LEVEL_BITS, the low two in the register
+        three after it.
+        """
+        n = np.floor(0.5 + np.asarray(offs, dtype=float)/0.15).astype(int)
+        i = INL_LEVEL_TO_BITS[4 - np.clip(n, -4, 4)]
+        # the bits of the levels don't overlap, so summing them ors them
+        high = (((i >> 2) & 3) << INL_LEVEL_BITS).dot(INL_LEVEL_ONEHOT)
+        low = ((i & 3) << INL_LEVEL_BITS).dot(INL_LEVEL_ONEHOT)
+        return np.concatenate((high, low), axis=-1).astype('int32')
 
     def set_inl_registers(self, chan, offs):
         """
@@ -218,36 +431,85 @@ class SPI:
         See: http://www.e2v.com/e2v/assets/File/documents/broadband-data-converters/doc0846I.pdf,
          specifically section 8.7.19 through 8.8, for more details.
         """
-        regs = self.inl_values_to_reg_values(offs)
+        self.set_inl_reg_values(chan, self.inl_values_to_reg_values(offs))
+
+    def set_inl_reg_values(self, chan, regs):
+        "Write the six packed INL register values of a channel, and latch them."
         self.set_spi_register(CHANSEL_REG_ADDR, chan)
         for n in range(6):
     	    reg_val = float(regs[n])
             self.set_spi_register(FIRST_EXTINL_REG_ADDR+n, reg_val)
         self.set_spi_register(CALCTRL_REG_ADDR, 2)
 
+    def set_all_inl_registers(self, inls):
+        """
+        Set the INL bits of all four channels from a (4, 17) array of
+        offsets, packed at once and written in one transaction.
+        """
+        regs = self.inl_values_to_reg_values(inls)
+        assert regs.shape == (self.n_cores, 6)
+        with self.transaction():
+            for i in range(self.n_cores):
+                self.set_inl_reg_values(self.cores[i], regs[i])
+
     def get_inl_registers(self, chan):
         regs = np.zeros((6), dtype='int32')
         self.set_spi_register(CHANSEL_REG_ADDR, chan)
         for n in range(6):
-            if not self.test:
-                regs[n] = self.get_spi_register(FIRST_EXTINL_REG_ADDR-0x80+n)
+            reg_addr = FIRST_EXTINL_REG_ADDR-0x80+n
+            if not self.test or self.get_shadow(reg_addr) is not None:
+                regs[n] = self.get_spi_register(reg_addr)
         return self.inl_regs_to_inl_vals(regs)
 
 
     def inl_regs_to_inl_vals(self, regs):
-        bits_to_off = np.array([0,1,-1,0,3,4,2,0,-3,-2,-4])
-        offs = np.zeros((17), dtype = float)
-        r = 2	# r is the relative register number.  R = 2 for 0x32 and 0x35
-        regbit = 8	#  regbit is the bit in the register
-        for level in range(17):	# n is the bit number in the incoming bits aray
-            bits = 0xc & ((regs[r]>>regbit)<<2) | 3 & (regs[r+3]>>regbit)
-    	    offs[level] = 0.15 * bits_to_off[bits]
-    	    if regbit == 14:
-    	        regbit = 0
-    	        r -= 1
-    	    else:
-    	        regbit += 2
-        return offs
+        """
+        Unpack the six INL register values of a channel into its 17 INL
+        offsets, or a (channels, 6) array of them into (channels, 17).
+        """
+        regs = np.asarray(regs, dtype=int)
+        high = regs[..., INL_LEVEL_REGS] >> INL_LEVEL_BITS
+        low = regs[..., INL_LEVEL_REGS + 3] >> INL_LEVEL_BITS
+        bits = 0xc & (high << 2) | 3 & low
+        return 0.15 * INL_BITS_TO_OFF[bits]
+
+    def read_calibration_state(self, zdoks = None, fresh = True):
+        """
+        Read the offset, gain, phase and INL registers of every core of the
+        given zdoks (default both) and return them as a (zdoks, cores)
+        array of CALIBRATION_STATE_DTYPE records:
+
+            state = spi.read_calibration_state()
+            state[0]['gain']     # the gains of zdok 0's cores
+            state['inl'][1, 2]   # the 17 INL offsets of zdok 1's core 3
+
+        Each core is selected once and its 9 registers read, rather than
+        selecting the core again for every value.  Unless fresh is False,
+        the shadow is invalidated first, so that the values really are
+        read back from the ADC.  The current zdok is left unchanged.
+        """
+        zdoks = [0, 1] if zdoks is None else zdoks
+        state = np.zeros((len(zdoks), self.n_cores), dtype = CALIBRATION_STATE_DTYPE)
+        current_zdok = self.zdok
+        try:
+            for i, zdok in enumerate(zdoks):
+                self.set_zdok(zdok)
+                if fresh:
+                    self.invalidate(zdok)
+                regs = np.zeros((self.n_cores, len(CHANNEL_REGS)), dtype = int)
+                for j, chan in enumerate(self.cores):
+                    self.set_spi_register(CHANSEL_REG_ADDR, chan)
+                    for k, reg_addr in enumerate(CHANNEL_REGS):
+                        regs[j, k] = self.get_spi_register(reg_addr)
+                state['zdok'][i] = zdok
+                state['core'][i] = self.cores
+                state['offset'][i] = self.unscale_value(regs[:, 0], self.offset_scale)
+                state['gain'][i] = self.unscale_value(regs[:, 1], self.gain_scale)
+                state['phase'][i] = self.unscale_value(regs[:, 2], self.phase_scale)
+                state['inl'][i] = self.inl_regs_to_inl_vals(regs[:, 3:])
+        finally:
+            self.set_zdok(current_zdok)
+        return state
 
     def set_control(self, adcmode=8, stdby=0, dmux=1, bg=1, bdw=3, fs=0, test=0):
         """
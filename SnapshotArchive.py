@@ -0,0 +1,93 @@
+import os
+import logging
+import numpy as np
+
+logger = logging.getLogger('adc5gLogging')
+
+class SnapshotArchive:
+
+    """
+    An append-only archive of all the snapshots taken in a calibration run.
+    The samples are appended as raw bytes to one data file, and a text index
+    (the data file name + '.idx') has a line per snapshot giving its key,
+    ie. (zdok, purpose, repeat, phase step), and where to find it:
+
+        zdok purpose repeat phase offset dtype shape
+
+    Snapshots are read back with np.memmap, so only the ones used are read
+    from disk.  Appending a key again supersedes the earlier snapshot.
+    """
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        self.index_filename = filename + '.idx'
+        self.index = {}
+        self.keys = []
+        if os.path.isfile(self.index_filename):
+            self.read_index()
+
+    def read_index(self):
+        self.index = {}
+        self.keys = []
+        for line in open(self.index_filename, 'r'):
+            zdok, purpose, repeat, phase, offset, dtype, shape = line.split()
+            key = (int(zdok), purpose, int(repeat), int(phase))
+            shape = tuple([int(s) for s in shape.split('x')])
+            self.add_key(key, (int(offset), dtype, shape))
+
+    def add_key(self, key, entry):
+        if key in self.index:
+            self.keys.remove(key)
+        self.index[key] = entry
+        self.keys.append(key)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def append(self, samples, zdok, purpose, repeat = 0, phase = 0):
+        """
+        Append a snapshot (or any array of samples, eg. the decoded ramps of
+        all the cores) under the given key, and return its offset.
+        """
+        assert ' ' not in purpose
+        key = (zdok, purpose, repeat, phase)
+        samples = np.asarray(samples)
+        if samples.dtype == np.int64 or samples.dtype == np.int32:
+            # the raw snapshots are 8 bit
+            samples = samples.astype(np.int8)
+        f = open(self.filename, 'ab')
+        f.seek(0, os.SEEK_END)
+        offset = f.tell()
+        f.write(samples.tostring())
+        f.close()
+        shape = 'x'.join([str(s) for s in samples.shape])
+        f = open(self.index_filename, 'a')
+        f.write("%d %s %d %d %d %s %s\n" % (zdok, purpose, repeat, phase, offset
+                                           , samples.dtype.name, shape))
+        f.close()
+        self.add_key(key, (offset, samples.dtype.name, samples.shape))
+        logger.debug("archived %s at %d" % (str(key), offset))
+        return offset
+
+    def get(self, zdok, purpose, repeat = 0, phase = 0):
+        "Returns the snapshot as a read-only np.memmap of the archive."
+        offset, dtype, shape = self.index[(zdok, purpose, repeat, phase)]
+        return np.memmap(self.filename, dtype = dtype, mode = 'r'
+                       , offset = offset, shape = shape)
+
+    def find(self, zdok = None, purpose = None, repeat = None, phase = None):
+        "Returns the keys, in the order archived, that match those given."
+        return [k for k in self.keys
+                  if (zdok is None or k[0] == zdok)
+                 and (purpose is None or k[1] == purpose)
+                 and (repeat is None or k[2] == repeat)
+                 and (phase is None or k[3] == phase)]
+
+    def get_stack(self, zdok, purpose, phase = 0):
+        """
+        Returns all the repeats of a snapshot as one (repeats, samples)
+        array, eg. for fit_cores.fit_snapshot.
+        """
+        keys = sorted(self.find(zdok = zdok, purpose = purpose, phase = phase))
+        return np.array([self.get(*k) for k in keys])
@@ -42,6 +42,15 @@ def main():
         help='Don t do MMCMs, just OGPs. Default=False')
     p.add_option('-C', '--mmcm_only', dest='mmcm_only', action='store_true', default=False,
         help='Don t do OGPs, just MMCMs. Default=False')
+    p.add_option('-R', '--record', dest='record', action='store_true', default=False,
+        help='Record all the roach traffic to <data_dir>/<roach>.rec. Default=False')
+    p.add_option('-E', '--replay', dest='replay', action='store_true', default=False,
+        help='Replay the recordings in <data_dir> instead of using the roaches. Default=False')
+    p.add_option('-L', '--artifacts', dest='artifacts', type='choice', default='full',
+        choices=['none', 'summary', 'full'],
+        help='Which intermediate files to write: none, summary (results only) or full. Default=full')
+    p.add_option('-D', '--differential', dest='differential', action='store_true', default=False,
+        help='Only write the ADC registers whose values change. Default=False')
     opts, args = p.parse_args(sys.argv[1:])
 
     # setup log file name:
@@ -85,6 +94,10 @@ def main():
                      , manual = opts.manual
                      , do_ogps = not opts.mmcm_only
                      , do_mmcms = not opts.ogp_only
+                     , record = opts.record
+                     , replay = opts.replay
+                     , artifacts = opts.artifacts
+                     , differential = opts.differential
                          )
 
      # and use it                    
@@ -52,6 +52,8 @@ def main():
         help='Do OGP calibration? Default = 1')
     p.add_option('-i', '--inl', dest='do_inl', type='int', default=1,
         help='Do INL calibration (OGP must be completed first)? Default = 1')
+    p.add_option('-H', '--hist', dest='hist', type='int', default=0,
+        help='Find the INLs from a code histogram of this many snapshots instead of from the OGP fits. Default=0 (use the OGP fits)')
     p.add_option('-t', '--test', dest='test', type='int', default=1,
         help='Test after calibration is completed. Default=1')
     p.add_option('-m', '--manual', dest='manual', type='int', default=1,
@@ -62,7 +64,24 @@ def main():
         help='To show the plots interactively (will be forced to 0 if manual is off). Default=1 (show)')
     p.add_option('-u', '--update_conf', dest='update_conf', action='store_false', default=True,
         help='Update the <roach_name>-adc.conf file?')
-
+    p.add_option('-A', '--archive', dest='archive', action='store_true', default=False,
+        help='Keep all the snapshots in one archive file instead of a file per snapshot. Default: off')
+    p.add_option('-B', '--batch', dest='batch', action='store_true', default=False,
+        help='Collect all the OGP snapshots, then fit them together in one pass. Default: off')
+    p.add_option('-P', '--prefetch', dest='prefetch', action='store_true', default=False,
+        help='Take the next OGP snapshot while the last one is being fit. Default: off')
+    p.add_option('--min_unclipped', dest='min_unclipped', type='float', default=None,
+        help='Reject OGP snapshots with less than this fraction of any core\'s samples unclipped. Default: 0.75')
+    p.add_option('--min_rms', dest='min_rms', type='float', default=None,
+        help='Reject OGP snapshots with an rms below this, in lsb. Default: 4.0')
+    p.add_option('--max_dc', dest='max_dc', type='float', default=None,
+        help='Reject OGP snapshots with a dc level above this, in lsb. Default: 8.0')
+    p.add_option('--tone_tolerance', dest='tone_tolerance', type='int', default=None,
+        help='Reject OGP snapshots whose strongest tone is more than this many FFT bins from the test frequency. Default: 2')
+
+    p.add_option('-L', '--artifacts', dest='artifacts', type='choice', default='full',
+        choices=['none', 'summary', 'full'],
+        help='Which intermediate files to write: none, summary (results only) or full. Default=full')
     opts, args = p.parse_args(sys.argv[1:])
 
     # setup log file name:
@@ -97,6 +116,8 @@ def main():
     logger.info(tmsg)
 
     if opts.prog_fpga:
+        # before the ADCCalibrate below, so its SPI register shadow
+        # starts empty rather than out of date
         tmsg = 'Programming ROACH with boffile %s'%opts.boffile
         r.progdev(opts.boffile)
         time.sleep(0.5)
@@ -131,6 +152,10 @@ def main():
         tmsg = "Valon Synth changed to frequency: %f MHz" % current_clkrate
         logger.info(tmsg)
 
+    # the snapshot prescreen limits given, the rest are left at their defaults
+    limits = ['min_unclipped', 'min_rms', 'max_dc', 'tone_tolerance']
+    prescreen_limits = dict([(k, getattr(opts, k)) for k in limits if getattr(opts, k) is not None])
+
     # Time to make our worker class
     cal = ADCCalibrate(dir = opts.dir 
                      , roach_name = opts.roach
@@ -138,7 +163,11 @@ def main():
                      , clockrate = clkrate
                      , bof = opts.boffile
                      , config = opts.update_conf
-                     , roach = r)
+                     , roach = r
+                     , archive = opts.archive
+                     , prefetch = opts.prefetch
+                     , artifacts = opts.artifacts
+                     , prescreen_limits = prescreen_limits)
 
     cal.set_freq(opts.testfreq)
     cal.set_ampl(opts.ampl)
@@ -170,9 +199,9 @@ def main():
 
 
     if opts.do_ogp:
-        cal.do_ogp(opts.zdok, opts.testfreq, opts.n_trials)
+        cal.do_ogp(opts.zdok, opts.testfreq, opts.n_trials, batch = opts.batch)
         if opts.do_inl:
-            cal.do_inl(opts.zdok) 
+            cal.do_inl(opts.zdok, hist = opts.hist) 
 
     if opts.test:
         if opts.manual:
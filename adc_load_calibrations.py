@@ -81,6 +81,8 @@ def main():
     logger.info(tmsg)
 
     if opts.prog_fpga:
+        # before the ADCCalibrate below, so its SPI register shadow
+        # starts empty rather than out of date
         tmsg = 'Programming ROACH with boffile %s'%opts.boffile
         r.progdev(opts.boffile)
         time.sleep(0.5)
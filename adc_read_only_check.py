@@ -74,27 +74,22 @@ def main():
 
     zdoks = [opts.zdok] if opts.zdok != 2 else [0,1]
 
-    # What are the currently loaded OGP values in the Card?
-    chs = range(1,5)
+    # What are the currently loaded OGP and INL values in the Card?
+    if opts.read_ogp or opts.read_inl:
+        state = cal.spi.read_calibration_state(zdoks)
     if opts.read_ogp:
-        for z in zdoks:
-            cal.set_zdok(z)
-            os = [cal.spi.get_offset(c) for c in chs]
-            gs = [cal.spi.get_gain(c)   for c in chs]
-            ps = [cal.spi.get_phase(c)  for c in chs]
-            logger.info("OGPs for zdok %s" % z)
-            logger.info("Offsets: %s" % os)
-            logger.info("Gains: %s" % gs)
-            logger.info("Phases: %s" % ps)
+        for s in state:
+            logger.info("OGPs for zdok %s" % s['zdok'][0])
+            logger.info("Offsets: %s" % list(s['offset']))
+            logger.info("Gains: %s" % list(s['gain']))
+            logger.info("Phases: %s" % list(s['phase']))
 
     if opts.read_inl:
-        for z in zdoks:
-            cal.set_zdok(z)
-            logger.info("INLs for zdok %s" % z)
-            a = cal.inl.get_inl_array()
+        for s in state:
+            logger.info("INLs for zdok %s" % s['zdok'][0])
             logger.debug( "lvl  A     B     C     D")
             for level in range(17):
-                logger.debug( "%3d %5.2f %5.2f %5.2f %5.2f" % tuple(a[level]))
+                logger.debug( "%3d %5.2f %5.2f %5.2f %5.2f" % ((16*level,) + tuple(s['inl'][:, level])))
 
     i = 0
     while cal.user_input("Check ADC output?"):
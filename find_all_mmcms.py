@@ -161,6 +161,8 @@ def find_this_mmcm(valon, adcCal, roach, bof, freq):
 
     # switch to the given bof file
     roach.progdev(bof)
+    # don't trust what we knew of the ADC registers
+    adcCal.spi.invalidate()
     tmsg = "Roach BOF file set to: %s" % bof
     logger.info(tmsg)
     time.sleep(2)
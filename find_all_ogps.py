@@ -161,6 +161,8 @@ def find_this_ogp(valon, adcCal, roach, bof, freq):
 
     # switch to the given bof file
     roach.progdev(bof)
+    # don't trust what we knew of the ADC registers
+    adcCal.spi.invalidate()
     tmsg = "************** Roach BOF file set to: %s" % bof
     logger.info(tmsg)
     time.sleep(2)
@@ -201,18 +203,15 @@ def find_this_ogp(valon, adcCal, roach, bof, freq):
 
 
 
-    #adcCal.gpib_test(0, testfreq, amp, manual=False)
-    adcCal.set_zdok(0)
-    adcCal.ogp.do_ogp(0)  
-    adc0 = adcCal.ogp.ogps
-    adcCal.inl.do_inl(0)  
-    inl0 = adcCal.inl.inls
+    # both zdoks are snapped together
+    ogps = adcCal.do_ogp(2, testfreq, n_trails)
+    adc0 = ogps[0]
+    adc1 = ogps[1]
 
-    #adcCal.gpib_test(1, testfreq, amp, manual=False)
-    adcCal.set_zdok(1)
-    adcCal.ogp.do_ogp(1)  
-    adc1 = adcCal.ogp.ogps
-    adcCal.inl.do_inl(1)  
+    # the INLs from the residuals of those fits, kept in memory
+    adcCal.inl.do_inl(0, residuals = adcCal.ogp.residuals[0])
+    inl0 = adcCal.inl.inls
+    adcCal.inl.do_inl(1, residuals = adcCal.ogp.residuals[1])
     inl1 = adcCal.inl.inls
 
     return adc0, inl0, adc1, inl1
@@ -5,33 +5,209 @@ import sys
 import os
 import math
 import logging
+import threading
+import json
+from collections import OrderedDict
 #from scipy import *
 #import adc5g
 from numpy import array, zeros, savetxt, genfromtxt, shape, size
 from numpy import sum, cumsum, genfromtxt, max, min
 from scipy.optimize import leastsq
 from numpy import arccos, pi, empty, arange, array, absolute
+from numpy import asarray, ones, concatenate, einsum, bincount
+from numpy import sin, cos, hypot, arctan2, loadtxt, log10
+from numpy import savez, nan, isnan, dot, eye
+from numpy import where, diff, lexsort, clip, frombuffer
+from numpy import load as load_npz
+from numpy.linalg import solve
+from numpy.fft import rfft
 from matplotlib.pyplot import plot
 from scipy.special import erfc
 
 logger = logging.getLogger('adc5gLogging')
 
-sum_result = zeros((15), dtype=float)
-result_cnt = 0
-code_errors = zeros((256,4), dtype='float')
-ce_counts = zeros((256, 4), dtype='int32')
 timestamp = ''
 
+# How many files the fits leave behind: 'none', a 'summary' of just the
+# results (the .ogp and .meas files) or the 'full' set of intermediate
+# files (the .fit, .res, per core .a - .d files, raw snapshots and plots)
+artifact_levels = ('none', 'summary', 'full')
+
+def keep_artifacts(artifacts, level):
+  "True if files of the given level are written at the artifact level."
+  if artifacts not in artifact_levels:
+    raise Exception("Unknown artifact level %s, not one of %s" % (artifacts, str(artifact_levels)))
+  return artifact_levels.index(artifacts) >= artifact_levels.index(level)
+
 def fitsin(p, s, c):
   return p[0] +  p[1] * s + p[2] * c
 
-def sin_residuals(p, s, c, adc):
+def clip_mask(adc):
+  "Returns a boolean array that is True where the adc sample is clipped."
+  adc = asarray(adc)
+  return (adc == -128) | (adc == 127)
+
+def sin_residuals(p, s, c, adc, clipped=None):
+  """
+  Residuals of fitsin, zeroed at the clipped samples.  Pass in the mask from
+  clip_mask to avoid rebuilding it on every call.
+  """
   res = adc - fitsin(p, s, c)
-  for i in range(adc.size):
-    if adc[i] == -128 or adc[i] == 127:
-      res[i] = 0
+  if clipped is None:
+    clipped = clip_mask(adc)
+  res[clipped] = 0
   return res
 
+class SineFit:
+
+  """
+  The result of fit_sines.  params is a 5x3 array of fitsin parameters: row
+  0 is the fit to all the samples, rows 1-4 are the fits to cores 1-4 in
+  time sequence.  clipped is the clip mask of the snapshot that was shared
+  by all five fits.  For a stack of snapshots, both have the same leading
+  axes as the stack.
+  """
+
+  def __init__(self, params, clipped):
+    self.params = params
+    self.clipped = clipped
+
+  def clipped_fraction(self):
+    "The fraction of the snapshot's samples that were clipped."
+    if self.clipped.size == 0:
+      return 0.0
+    return float(self.clipped.sum()) / self.clipped.size
+
+def make_basis(sig_freq, samp_freq, length):
+  """
+  Returns the sin and cos of the signal phase at each of length samples,
+  followed by the same two arrays de-interleaved into 4 rows, one per core
+  in time sequence.
+  """
+  del_phi = 2 * math.pi * sig_freq / samp_freq
+  s = sin(del_phi * arange(length))
+  c = cos(del_phi * arange(length))
+  n = length/4
+  s4 = s[:4*n].reshape(n, 4).transpose().copy()
+  c4 = c[:4*n].reshape(n, 4).transpose().copy()
+  return s, c, s4, c4
+
+class BasisCache:
+
+  """
+  A least recently used cache of the arrays from make_basis, keyed by
+  (sig_freq, samp_freq, length).  The test tone, clock rate and snapshot
+  length rarely change during a calibration, so every snapshot fit can
+  share the same arrays.  At most maxsize sets of arrays are kept, and
+  they are read only since they are shared.
+  """
+
+  def __init__(self, maxsize=8):
+    self.maxsize = maxsize
+    self.cache = OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, sig_freq, samp_freq, length):
+    key = (sig_freq, samp_freq, length)
+    self.lock.acquire()
+    try:
+      if key in self.cache:
+        basis = self.cache.pop(key)
+      else:
+        basis = make_basis(sig_freq, samp_freq, length)
+        for b in basis:
+          b.setflags(write=False)
+        while len(self.cache) >= self.maxsize:
+          self.cache.popitem(last=False)
+      self.cache[key] = basis
+      return basis
+    finally:
+      self.lock.release()
+
+  def clear(self):
+    self.lock.acquire()
+    try:
+      self.cache.clear()
+    finally:
+      self.lock.release()
+
+basis_cache = BasisCache()
+
+def fit_sines(adc, s, c, clipped=None):
+  """
+  Fit fitsin to all of the samples and to each of the 4 cores at once.
+  fitsin is linear in its parameters, so rather than iterating with
+  leastsq the fits are solved in closed form from the normal equations of
+  the [1, sin, cos] design matrix.  The normal equations of the combined fit
+  are the sum of those of the cores, so all 5 fits are one batched solve.
+  Clipped samples (-128 or 127) get zero weight, which is what
+  sin_residuals does by zeroing their residuals.  The clip mask is built
+  once here, unless it is passed in, and is shared by all five fits.  A fit
+  left with fewer than 3 unclipped samples, eg. a core that is clipped
+  throughout, has nan parameters.
+
+  adc may also be a stack of snapshots, with the samples along the last
+  axis, in which case every snapshot is fit in the same solve.
+
+  Returns a SineFit.
+  """
+  if clipped is None:
+    clipped = clip_mask(adc)
+  adc = asarray(adc, dtype=float)
+  s = asarray(s, dtype=float)
+  c = asarray(c, dtype=float)
+  w = (~clipped).astype(float)
+  # pad with zero weight samples so the cores can be split with a reshape
+  pad = -adc.shape[-1] % 4
+  if pad:
+    adc, w = [concatenate((x, zeros(x.shape[:-1] + (pad,))), axis=-1)
+                for x in (adc, w)]
+    s, c = [concatenate((x, zeros(pad))) for x in (s, c)]
+  a = array([ones(s.size), s, c]).reshape(3, -1, 4)
+  w = w.reshape(w.shape[:-1] + (-1, 4))
+  y = adc.reshape(adc.shape[:-1] + (-1, 4))
+  ata = einsum('imk,...mk,jmk->...kij', a, w, a)
+  aty = einsum('imk,...mk,...mk->...ki', a, w, y)
+  ata = concatenate((ata.sum(axis=-3)[..., None, :, :], ata), axis=-3)
+  aty = concatenate((aty.sum(axis=-2)[..., None, :], aty), axis=-2)
+  # a fit with fewer than 3 unclipped samples is singular; solve an
+  # identity in its place and leave its parameters nan
+  n = w.sum(axis=-2)
+  bad = concatenate((n.sum(axis=-1)[..., None], n), axis=-1) < 3
+  ata[bad] = eye(3)
+  params = solve(ata, aty[..., None])[..., 0]
+  params[bad] = nan
+  return SineFit(params, clipped)
+
+def residual_histogram(codes, fits):
+  """
+  For each core (n), sum the residuals (code - fit) at each output code and
+  count the residuals summed.  codes and fits hold the measured codes and
+  the fitted values of the cores, one core per row in time sequence.
+  Returns the sums and counts as 256x4 arrays indexed by [code+128][n].
+  """
+  errors = zeros((256, 4), dtype='float')
+  counts = zeros((256, 4), dtype='int32')
+  for n in range(len(codes)):
+    code = asarray(codes[n], dtype=int)
+    resid = code - asarray(fits[n], dtype=float)
+    errors[:, n] = bincount(code + 128, weights=resid, minlength=256)
+    counts[:, n] = bincount(code + 128, minlength=256)
+  return errors, counts
+
+def write_core_files(fname, codes, fits):
+  """
+  Write the sample number, code and fitted value of each core's samples to
+  fname.a, fname.b, fname.c and fname.d.  codes and fits are in time
+  sequence, which is cores a, c, b, d.
+  """
+  for n, ext in enumerate(['.a', '.c', '.b', '.d']):
+    cfdfn = fname + ext
+    samples = 4 * arange(len(codes[n])) + n
+    savetxt(cfdfn, array([samples, codes[n], fits[n]]).transpose(),
+            fmt=('%d', '%d', '%.2f'))
+    logger.debug("written to file " + cfdfn)
+
 def test_fit_snap():
 
     # default values: from nrao_adc5g_test
@@ -67,7 +243,321 @@ def test_fit_snap():
     diffs = [(abs(x-y), (abs((x-y)/y))*100.) for x, y in zip(t,ogp)] 
     print diffs
     
-def fit_snap(sig_freq, samp_freq, fname, clear_avgs=True, prnt=True):
+class SnapshotFit(SineFit):
+
+  """
+  The result of fit_snapshot.  Along with the SineFit parameters and clip
+  mask this holds, for cores 1-4 in time sequence:
+    offsets  the dc offsets in mV
+    amps     the amplitudes in lsb
+    delays   the delays in ps
+  and for the snapshot as a whole:
+    pwr_sinad, sinad   the SINAD as a power ratio and in dB
+    fit                the fitted waveform of all the samples
+    codes, fits        the codes and fitted values of each core
+    code_errors, ce_counts   the residual histogram of the cores
+  When a stack of snapshots is fit, all but the residual histogram, which
+  is summed over the stack, have a leading axis for the repeats.
+  """
+
+  def __init__(self, sig_freq, samp_freq, sine_fit):
+    SineFit.__init__(self, sine_fit.params, sine_fit.clipped)
+    self.sig_freq = sig_freq
+    self.samp_freq = samp_freq
+
+  def get_results(self):
+    """
+    Returns the values that fit_snap accumulates and writes to the .ogp
+    file as an array of 15: signal freq, average zero and average
+    amplitude, followed by triplets of zero, amplitude and delay
+    differences for cores a, b, c and d.  For a stack of snapshots there is
+    a row of 15 for each repeat.
+    """
+    cols = [self.sig_freq + zeros(shape(self.avz)), self.avz, self.avamp]
+    # cores a, b, c and d are cores 1, 3, 2 and 4 in time sequence
+    for n in [0, 2, 1, 3]:
+      cols.extend([self.offsets[..., n], self.amp_diffs[..., n],
+                   self.delay_diffs[..., n]])
+    return array(cols, dtype=float).transpose()
+
+  def get_result(self):
+    "Returns the results of a single snapshot as a tuple."
+    return tuple(self.get_results())
+
+  def get_repeats(self):
+    "The number of snapshots that were fit."
+    return self.get_results().reshape(-1, 15).shape[0]
+
+  def get_mean(self):
+    "Returns the mean of the results over the stack of snapshots."
+    mean = self.get_results().reshape(-1, 15).mean(axis=0)
+    mean[0] = self.sig_freq
+    return tuple(mean)
+
+  def get_std_error(self):
+    """
+    Returns the standard error of the mean of the results over the stack
+    of snapshots, or NaNs if fewer than two were fit.
+    """
+    results = self.get_results().reshape(-1, 15)
+    n = results.shape[0]
+    if n < 2:
+      return tuple(zeros(15) + nan)
+    return tuple(results.std(axis=0, ddof=1) / math.sqrt(n))
+
+# the first line of a snapshot file in the binary format
+snapshot_magic = '#adc5g-snapshot 1\n'
+
+def write_snapshot(fname, samples, **header):
+  """
+  Write a snapshot in the binary format: the magic line, a one line JSON
+  header holding the keyword arguments (roach, zdok, clockrate, freq,
+  timestamp, ...) and then the samples as raw int8 bytes.
+  """
+  samples = asarray(samples).astype('int8')
+  header['length'] = len(samples)
+  f = open(fname, 'wb')
+  f.write(snapshot_magic)
+  f.write(json.dumps(header, sort_keys=True) + '\n')
+  f.write(samples.tostring())
+  f.close()
+
+def read_snapshot(fname):
+  """
+  Read a snapshot written by write_snapshot, or the older text format of one
+  code per line.  Returns the samples and the header, which is empty for a
+  text file.
+  """
+  f = open(fname, 'rb')
+  try:
+    if f.readline() != snapshot_magic:
+      f.seek(0)
+      return loadtxt(f, dtype=int, comments='#', ndmin=1), {}
+    header = json.loads(f.readline())
+    samples = frombuffer(f.read(), dtype='int8').astype(int)
+  finally:
+    f.close()
+  return samples, header
+
+def read_snap(fname):
+  "Read the samples of a snapshot file, binary or text."
+  return read_snapshot(fname)[0]
+
+class Prescreen:
+
+  """
+  The result of prescreen_snapshot: the clip fraction, the fraction of each
+  core's samples that are unclipped, the rms and dc level of a raw snapshot
+  and the frequency of its strongest tone, with the reasons, if any, to
+  reject the snapshot.
+  """
+
+  def __init__(self, clip_fraction, unclipped, rms, dc, tone_freq, reasons):
+    self.clip_fraction = clip_fraction
+    self.unclipped = unclipped
+    self.rms = rms
+    self.dc = dc
+    self.tone_freq = tone_freq
+    self.reasons = reasons
+
+  def ok(self):
+    return len(self.reasons) == 0
+
+  def get_reasons(self):
+    return '; '.join(self.reasons)
+
+def prescreen_snapshot(samples, sig_freq, samp_freq, min_unclipped=0.75, min_rms=4.0, max_dc=8.0, tone_tolerance=2):
+  """
+  A quick check of a raw snapshot before it is fit: is the test tone there,
+  at the right frequency, with enough amplitude and not clipped too much?
+  The fit leaves out the clipped samples, so some clipping is tolerated:
+  at least min_unclipped of each core's samples must be unclipped.  With
+  a quarter of a sine's samples clipped, the fitted offsets, gains and
+  phases stay within about a step of their registers.  The rms (at least
+  min_rms) and dc level (at most max_dc) are in lsb.  The tone is found
+  from the largest bin of the FFT, which must be within tone_tolerance
+  bins of sig_freq (aliased into the first Nyquist zone).  No check is
+  made of the frequency if sig_freq is not positive.
+  Returns a Prescreen.
+  """
+  adc = asarray(samples)
+  n = adc.shape[-1]
+  clipped = clip_mask(adc)
+  clip_fraction = clipped.mean()
+  unclipped = 1 - clipped[:n - n % 4].reshape(-1, 4).mean(axis=0)
+  adc = adc.astype(float)
+  dc = adc.mean()
+  rms = adc.std()
+  spec = absolute(rfft(adc - dc))
+  tone_bin = spec[1:].argmax() + 1
+  tone_freq = tone_bin * samp_freq / n
+
+  reasons = []
+  if unclipped.min() < min_unclipped:
+    reasons.append("%.1f%% of the samples are clipped, the test tone is too strong" % (100*clip_fraction))
+  if rms < min_rms:
+    reasons.append("rms of %.2f lsb, the test tone is missing or too weak" % rms)
+  if absolute(dc) > max_dc:
+    reasons.append("dc level of %.2f lsb" % dc)
+  if sig_freq > 0 and rms >= min_rms:
+    alias = sig_freq % samp_freq
+    if alias > samp_freq / 2:
+      alias = samp_freq - alias
+    if absolute(tone_freq - alias) > tone_tolerance * samp_freq / n:
+      reasons.append("strongest tone is at %.4f MHz, not %.4f MHz" % (tone_freq, alias))
+  return Prescreen(clip_fraction, unclipped, rms, dc, tone_freq, reasons)
+
+def fit_snapshot(samples, sig_freq, samp_freq):
+  """
+  Separate the samples of a snapshot into the 4 cores and fit a separate
+  sine wave to each.  Nothing is read from or written to files; the fits,
+  SINAD and residual histogram are returned as a SnapshotFit.
+
+  samples may also be a stack of repeated snapshots, either as (repeats,
+  samples) or already de-interleaved as (repeats, 4, samples per core),
+  which are all fit in one vectorized pass.
+  """
+  adc = asarray(samples, dtype=int)
+  if adc.ndim == 3:
+    # (repeats, cores, samples) back to time order
+    adc = adc.swapaxes(-1, -2).reshape(adc.shape[0], -1)
+  data_cnt = adc.shape[-1]
+  s, c, s4, c4 = basis_cache.get(sig_freq, samp_freq, data_cnt)
+
+# express offsets as mV.  1 lsb = 500mV/256. z_fact converts from lsb to mV
+# negate z_fact for negative feedback
+  z_fact = -500.0/256.0
+# Express delay in ps.  d_fact converts from angle at sig_freq(MHz) to ps
+  d_fact = 1e12/(2*math.pi*sig_freq*1e6)
+
+  snap = SnapshotFit(sig_freq, samp_freq, fit_sines(adc, s, c))
+  p = snap.params
+  z = z_fact * p[..., 0]
+  amp = hypot(p[..., 1], p[..., 2])
+  dly = d_fact * arctan2(p[..., 1], p[..., 2])
+
+  p0 = p[..., 0, :, None]
+  snap.fit = p0[..., 0, :] + p0[..., 1, :] * s + p0[..., 2, :] * c
+  ssq0 = ((adc - snap.fit)**2).sum(axis=-1)
+  snap.pwr_sinad = (amp[..., 0]**2)/(2*ssq0/data_cnt)
+  snap.sinad = 10.0*log10(snap.pwr_sinad)
+
+  snap.offsets = z[..., 1:]
+  snap.amps = amp[..., 1:]
+  snap.delays = dly[..., 1:]
+  snap.avz = snap.offsets.mean(axis=-1)
+  snap.avamp = snap.amps.mean(axis=-1)
+  snap.avdly = snap.delays.mean(axis=-1)
+  # Reverse the amplitude and zero differences so they can be applied to the
+  # offset and gain registers directly.  The phase registers don't need the
+  # reversal
+  snap.amp_diffs = 100*(snap.avamp[..., None] - snap.amps)/snap.avamp[..., None]
+  snap.delay_diffs = snap.delays - snap.avdly[..., None]
+
+  # for each core (n), the sum of the residuals at each output code is in
+  # code_errors[code][n] and the count of residuals in ce_counts[code][n]
+  n = data_cnt/4
+  snap.codes = adc[..., :4*n].reshape(adc.shape[:-1] + (n, 4)).swapaxes(-1, -2)
+  snap.fits = p[..., 1:, 0:1] + p[..., 1:, 1:2] * s4 + p[..., 1:, 2:3] * c4
+  snap.code_errors, snap.ce_counts = residual_histogram(
+      snap.codes.swapaxes(0, -2).reshape(4, -1),
+      snap.fits.swapaxes(0, -2).reshape(4, -1))
+  return snap
+
+class FitAccumulator:
+
+  """
+  Accumulates the results of fit_snap over a series of snapshots: the sum
+  and count of the fit results, and the per-core sums (code_errors) and
+  counts (ce_counts) of the residuals at each output code.  Each
+  calibration owns its own accumulator, so several can run in one process.
+  Partial accumulations from several workers can be combined with merge,
+  and an accumulation can be saved to and loaded from a file.
+  """
+
+  def __init__(self):
+    self.clear()
+
+  def clear(self):
+    self.sig_freq = None
+    self.sum_result = zeros((15), dtype=float)
+    self.result_cnt = 0
+    self.code_errors = zeros((256,4), dtype='float')
+    self.ce_counts = zeros((256, 4), dtype='int32')
+
+  def add(self, snap):
+    "Add in the results of a SnapshotFit, or of each snapshot in a stack."
+    results = snap.get_results().reshape(-1, 15)
+    self.sig_freq = snap.sig_freq
+    self.sum_result += results.sum(axis=0)
+    self.result_cnt += results.shape[0]
+    self.code_errors += snap.code_errors
+    self.ce_counts += snap.ce_counts
+
+  def merge(self, other):
+    "Add in the sums of another FitAccumulator."
+    if other.result_cnt == 0:
+      return
+    self.sig_freq = other.sig_freq
+    self.sum_result += other.sum_result
+    self.result_cnt += other.result_cnt
+    self.code_errors += other.code_errors
+    self.ce_counts += other.ce_counts
+
+  def get_average(self):
+    "Returns the average of the fit results as a tuple."
+    avg_result = self.sum_result/self.result_cnt
+    avg_result[0] = self.sig_freq
+    return tuple(avg_result)
+
+  def get_residuals(self):
+    """
+    Returns the average residual at each output code as a 256x4 array in
+    core order, ie. a,b,c,d.  Codes seen no more than once in any core are
+    left at zero.
+    """
+    res = zeros((256, 4), dtype='float')
+    good = self.ce_counts.min(axis=1) > 1
+    res[good] = self.code_errors[good]/self.ce_counts[good]
+    return res[:, [0, 2, 1, 3]]
+
+  def save(self, fname):
+    savez(fname
+        , sig_freq = array(self.sig_freq if self.sig_freq is not None else nan)
+        , sum_result = self.sum_result
+        , result_cnt = array(self.result_cnt)
+        , code_errors = self.code_errors
+        , ce_counts = self.ce_counts)
+
+  @classmethod
+  def load(cls, fname):
+    "Returns the FitAccumulator saved in fname."
+    f = load_npz(fname)
+    try:
+      acc = cls()
+      acc.sig_freq = None if isnan(f['sig_freq']) else float(f['sig_freq'])
+      acc.sum_result = f['sum_result']
+      acc.result_cnt = int(f['result_cnt'])
+      acc.code_errors = f['code_errors']
+      acc.ce_counts = f['ce_counts']
+    finally:
+      f.close()
+    return acc
+
+# used by fit_snap when no accumulator is given
+default_accumulator = FitAccumulator()
+
+def write_res(fname, residuals):
+  """
+  Write the 256x4 array of average residuals from
+  FitAccumulator.get_residuals to the file fname.
+  """
+  # Since the INL registers are addressed as offset binary, generate the
+  # .res file that way
+  savetxt(fname, concatenate((arange(256)[:, None], residuals), axis=1),
+          fmt=('%3d', '%5.3f', '%5.3f', '%5.3f', '%5.3f'))
+
+def fit_snap(sig_freq, samp_freq, fname, clear_avgs=True, prnt=True, samples=None, acc=None, artifacts='full'):
   """
   Given a file containing a snapshot of data, separate the data from the
   4 cores and fit a separate sine wave to each.  From the dc offset, gain
@@ -77,163 +567,53 @@ def fit_snap(sig_freq, samp_freq, fname, clear_avgs=True, prnt=True):
   for each level of each core averaged over the samples (the raw data for
   INL corrections) and write to fname.res.
 
+  If samples is given it is fit instead of reading the snapshot from fname,
+  and fname is only used to name the files that are written.  The results
+  are accumulated in the FitAccumulator acc, or in default_accumulator.
+  The .ogp line is written unless artifacts is 'none', the other files only
+  if it is 'full'.
+
   Internally, cores 1-4 are in time sequence, but when the data is
   written out, write in teh sequence 1324 for cores abcd.
   """
-  global sum_result, result_cnt, code_errors, ce_counts
-  p0 = [128.0, 90.0, 90.0]
+  acc = acc if acc is not None else default_accumulator
   ogp = ()
-  
-  # Create lists to hold parameters at sample rate
-  adc = []    # adc value
-  s = []        # sin of signal freq
-  c = []        # cos of signal freq
-  
-  del_phi = 2 * math.pi * sig_freq / samp_freq
-  ifn = fname 
-  ifd=open(ifn, 'r')
-  ofn = fname  + ".ogp"
-  ofd = open(ofn, 'a')
-  if prnt:
-    cfd1fn = fname  + ".a"
-    cfd1 = open(cfd1fn, 'w')
-    cfd2fn = fname  + ".b"
-    cfd2 = open(cfd2fn, 'w')
-    cfd3fn = fname  + ".c"
-    cfd3 = open(cfd3fn, 'w')
-    cfd4fn = fname  + ".d"
-    cfd4 = open(cfd4fn, 'w')
-  data_cnt = 0
-  for line in ifd:
-    if line[0] == "#":
-      continue
-    adc += [int(line)]
-    s += [math.sin(del_phi * data_cnt)]
-    c += [math.cos(del_phi * data_cnt)]
-    data_cnt += 1
-  
-  core1 = adc[0:: 4]
-  core2 = adc[1:: 4]
-  core3 = adc[2:: 4]
-  core4 = adc[3:: 4]
-  s1 = s[0:: 4]
-  s2 = s[1:: 4]
-  s3 = s[2:: 4]
-  s4 = s[3:: 4]
-  c1 = c[0:: 4]
-  c2 = c[1:: 4]
-  c3 = c[2:: 4]
-  c4 = c[3:: 4]
-  
-  ifd.close()
 
+  if samples is None:
+    samples = read_snap(fname)
+  snap = fit_snapshot(samples, sig_freq, samp_freq)
 
-# express offsets as mV.  1 lsb = 500mV/256. z_fact converts from lsb to mV
-# negate z_fact for negative feedback
-  z_fact = -500.0/256.0
-  true_zero = 0.0 * z_fact
-#  z_fact = 1.0
-# Express delay in ps.  d_fact converts from angle at sig_freq(MHz) to ps
-  d_fact = 1e12/(2*math.pi*sig_freq*1e6)
-# This d_fact converts dly from angle at sig_freq to fraction of sample period.
-#  d_fact = samp_freq/(2*math.pi*sig_freq)
-#  d_fact = 1
-
-  args0 = (array(s), array(c), array(adc))
-  plsq0 = leastsq(sin_residuals, p0, args0)
-  #if plsq1[1] != 1:
-  #  print "Fit failed to converge"
-  z0 = z_fact * plsq0[0][0]
-  s0a = plsq0[0][1]
-  c0a = plsq0[0][2]
-  amp0 = math.sqrt(s0a**2 + c0a**2)
-  dly0 = d_fact*math.atan2(s0a, c0a)
-  Fit0 = fitsin(plsq0[0], args0[0], args0[1])
+  ofn = fname  + ".ogp"
   tmpfn = fname  + ".fit"
-  logger.debug("savetxt to ..." + tmpfn)
-  savetxt(tmpfn, Fit0)
-  ssq0 = 0.0
-  for i in range(data_cnt):
-    ssq0 += (adc[i] - Fit0[i])**2
-  pwr_sinad = (amp0**2)/(2*ssq0/data_cnt)
-
-  args1 = (array(s1), array(c1), array(core1))
-  plsq1 = leastsq(sin_residuals, p0, args1)
-  #if plsq1[1] != 1:
-  #  print "Fit failed to converge"
-  z1 = z_fact * plsq1[0][0]
-  s1a = plsq1[0][1]
-  c1a = plsq1[0][2]
-  amp1 = math.sqrt(s1a**2 + c1a**2)
-  dly1 = d_fact*math.atan2(s1a, c1a)
-  
-  args2 = (array(s2), array(c2), array(core2))
-  plsq2 = leastsq(sin_residuals, p0, args2)
-  z2 = z_fact * plsq2[0][0]
-  s2a = plsq2[0][1]
-  c2a = plsq2[0][2]
-  amp2 = math.sqrt(s2a**2 + c2a**2)
-  dly2 = d_fact*math.atan2(s2a, c2a)
-  
-  args3 = (array(s3), array(c3), array(core3))
-  plsq3 = leastsq(sin_residuals, p0, args3)
-  z3 = z_fact * plsq3[0][0]
-  s3a = plsq3[0][1]
-  c3a = plsq3[0][2]
-  amp3 = math.sqrt(s3a**2 + c3a**2)
-  dly3 = d_fact*math.atan2(s3a, c3a)
-  
-  args4 = (array(s4), array(c4), array(core4))
-  plsq4 = leastsq(sin_residuals, p0, args4)
-  z4 = z_fact * plsq4[0][0]
-  s4a = plsq4[0][1]
-  c4a = plsq4[0][2]
-  amp4 = math.sqrt(s4a**2 + c4a**2)
-  dly4 = d_fact*math.atan2(s4a, c4a)
-
-  avz = (z1+z2+z3+z4)/4.0
-  avamp = (amp1+amp2+amp3+amp4)/4.0
-  # Reverse the amplitude and zero differences so they can be applied to the
-  # offset and gain registers directly.  The phase registers don't need the
-  # reversal
-  a1p = 100*(avamp -amp1)/avamp
-  a2p = 100*(avamp -amp2)/avamp
-  a3p = 100*(avamp -amp3)/avamp
-  a4p = 100*(avamp -amp4)/avamp
-  avdly = (dly1+dly2+dly3+dly4)/4.0
-#  print s1a, c1a, s2a, c2a, s3a, c3a, s4a, c4a
+  if keep_artifacts(artifacts, 'full'):
+    logger.debug("savetxt to ..." + tmpfn)
+    savetxt(tmpfn, snap.fit)
+
+  result = snap.get_result()
   if prnt:
     logger.debug( "#%6.2f  zero(mV) amp(%%)  dly(ps) (adj by .4, .14, .11)" % (sig_freq))
-    logger.debug( "#avg    %7.4f %7.4f %8.4f" %  (avz, avamp, avdly))
-    logger.debug( "core A  %7.4f %7.4f %8.4f" %  (z1 -true_zero, a1p, dly1-avdly))
-    logger.debug( "core B  %7.4f %7.4f %8.4f" %  (z3 -true_zero, a3p, dly3-avdly))
-    logger.debug( "core C  %7.4f %7.4f %8.4f" %  (z2 -true_zero, a2p, dly2-avdly))
-    logger.debug( "core D  %7.4f %7.4f %8.4f" %  (z4 -true_zero, a4p, dly4-avdly))
-    logger.debug( "\nsinad = %.2f" % (10.0*math.log10(pwr_sinad)))
+    logger.debug( "#avg    %7.4f %7.4f %8.4f" %  (snap.avz, snap.avamp, snap.avdly))
+    logger.debug( "core A  %7.4f %7.4f %8.4f" %  result[3:6])
+    logger.debug( "core B  %7.4f %7.4f %8.4f" %  result[6:9])
+    logger.debug( "core C  %7.4f %7.4f %8.4f" %  result[9:12])
+    logger.debug( "core D  %7.4f %7.4f %8.4f" %  result[12:15])
+    logger.debug( "\nsinad = %.2f" % (snap.sinad))
+    logger.debug( "clipped = %.4f%%" % (100.0*snap.clipped_fraction()))
 
   if clear_avgs:
-    sum_result = zeros((15), dtype=float)
-    result_cnt = 0
-    code_errors = zeros((256,4), dtype='float')
-    ce_counts = zeros((256, 4), dtype='int32')
-
-  result = (sig_freq, avz, avamp,\
-      z1-true_zero, a1p, dly1-avdly, z3-true_zero, a3p, dly3-avdly, \
-      z2-true_zero, a2p, dly2-avdly, z4-true_zero, a4p, dly4-avdly)
+    acc.clear()
+  acc.add(snap)
+
   result_fmt = "%8.4f "*15
-  sum_result += array(result)
-  result_cnt += 1
-#  print "%.3f %.3f %.3f %.3f %d" % (sum_result[5]/result_cnt,\
-#     sum_result[8]/result_cnt,\
-#     sum_result[11]/result_cnt, sum_result[14]/result_cnt, result_cnt)
-  if prnt and result_cnt > 1:
-    avg_result = sum_result/result_cnt
-    avg_result[0] = sig_freq
-    ogp = tuple(avg_result)
-    logstr = str( result_cnt) + " " + result_fmt % ogp
-    logger.debug("Writing to file " + ofn + ": " + logstr)
-    ofd.write(logstr)
-    logger.debug( "average of %d measurements" % (result_cnt))
+  if prnt and acc.result_cnt > 1:
+    ogp = acc.get_average()
+    logstr = str( acc.result_cnt) + " " + result_fmt % ogp
+    if keep_artifacts(artifacts, 'summary'):
+      logger.debug("Writing to file " + ofn + ": " + logstr)
+      ofd = open(ofn, 'a')
+      ofd.write(logstr + "\n")
+      ofd.close()
+    logger.debug( "average of %d measurements" % (acc.result_cnt))
     logger.debug( "#avg    %7.4f %7.4f %8.4f" %  (ogp[1], ogp[2], 0))
     logger.debug( "core A  %7.4f %7.4f %8.4f" %  ogp[3:6])
     logger.debug( "core B  %7.4f %7.4f %8.4f" %  ogp[6:9])
@@ -241,71 +621,101 @@ def fit_snap(sig_freq, samp_freq, fname, clear_avgs=True, prnt=True):
     logger.debug( "core D  %7.4f %7.4f %8.4f" %  ogp[12:15])
     logger.debug("")
 
-  # for each core (n), accumulate the sum of the residuals at each output code
-  # in code_errors[code][n]
-  # and the count of residuals added in ce_counts[code][n]
-  Fit1 = fitsin(plsq1[0], args1[0], args1[1])
-  for i in range(data_cnt/4):
-    code = core1[i]
-    if prnt:
-      logstr = "%d %d %.2f\n" % (4 * i, code, Fit1[i])
-      cfd1.write(logstr)
-    code_errors[code+128][0] += code - Fit1[i]
-    ce_counts[code+128][0] += 1
-  if prnt:
-    logger.debug("written to file " + cfd1fn)
-  Fit2 = fitsin(plsq2[0], args2[0], args2[1])
-  for i in range(data_cnt/4):
-    code = core2[i]
-    if prnt:
-      logstr =  "%d %d %.2f\n" % (4 * i + 1, code, Fit2[i])
-      cfd3.write(logstr)
-    code_errors[code+128][1] += code - Fit2[i]
-    ce_counts[code+128][1] += 1
-  if prnt:
-    logger.debug("written to file " + cfd3fn)
-  Fit3 = fitsin(plsq3[0], args3[0], args3[1])
-  for i in range(data_cnt/4):
-    code = core3[i]
-    if prnt:
-      logstr = "%d %d %.2f\n" % (4 * i + 2, code, Fit3[i])
-      cfd2.write(logstr)
-    code_errors[code+128][2] += code - Fit3[i]
-    ce_counts[code+128][2] += 1
-  if prnt:
-    logger.debug("written to file " + cfd2fn)
-  Fit4 = fitsin(plsq4[0], args4[0], args4[1])
-  for i in range(data_cnt/4):
-    code = core4[i]
-    if prnt:
-      logstr = "%d %d %.2f\n" % (4 * i + 3, code, Fit4[i])
-      cfd4.write(logstr)
-    code_errors[code+128][3] += code - Fit4[i]
-    ce_counts[code+128][3] += 1
-  if prnt:
-    logger.debug("written to file " + cfd4fn)
-  if prnt:
+  if prnt and keep_artifacts(artifacts, 'full'):
+    write_core_files(fname, snap.codes, snap.fits)
     rfdfn = fname + '.res'
-    rfd = open(rfdfn, "w")
-    # Since the INL registers are addressed as offset binary, generate the
-    # .res file that way
-    for code in range(256):
-      if ce_counts[code].min() > 1:
-        e = code_errors[code]/ce_counts[code]
-        logstr = "%3d %5.3f %5.3f %5.3f %5.3f\n" % \
-                 (code, e[0], e[2], e[1], e[3])
-        rfd.write(logstr)
-      else:
-        logstr = "%3d %5.3f %5.3f %5.3f %5.3f\n" % (code,0,0,0,0)
-        rfd.write(logstr)
-  if prnt:
+    write_res(rfdfn, acc.get_residuals())
+    logger.debug("written to file " + rfdfn)
+  return ogp, snap.pwr_sinad
+
+def fit_snap_batch(sig_freq, samp_freq, fname, samples, clear_avgs=True, acc=None, artifacts='full'):
+  """
+  Like fit_snap, but for a stack of repeated snapshots that are fit in one
+  vectorized pass.  samples is (repeats, samples) or (repeats, 4, samples
+  per core).  The result of every repeat is written to fname.ogp as a
+  comment line, followed by the average as fit_snap writes it and its
+  standard error.  The .fit, .a, .b, .c and .d files are written for the
+  last repeat.  Which files are written depends on artifacts, as in fit_snap.
+
+  Returns the average, the average SINAD power ratio and the SnapshotFit.
+  """
+  acc = acc if acc is not None else default_accumulator
+  snap = fit_snapshot(samples, sig_freq, samp_freq)
+  repeats = snap.get_repeats()
+
+  if clear_avgs:
+    acc.clear()
+  acc.add(snap)
+  ogp = acc.get_average()
+
+  result_fmt = "%8.4f "*15
+  ofn = fname  + ".ogp"
+  logstr = str( acc.result_cnt) + " " + result_fmt % ogp
+  if keep_artifacts(artifacts, 'summary'):
+    ofd = open(ofn, 'a')
+    for i, result in enumerate(snap.get_results()):
+      ofd.write("#%d " % (i+1) + result_fmt % tuple(result) + "\n")
+    logger.debug("Writing to file " + ofn + ": " + logstr)
+    ofd.write(logstr + "\n")
+    ofd.write("#err " + result_fmt % snap.get_std_error() + "\n")
+    ofd.close()
+  logger.debug( "average of %d measurements" % (acc.result_cnt))
+  logger.debug( "#avg    %7.4f %7.4f %8.4f" %  (ogp[1], ogp[2], 0))
+  logger.debug( "core A  %7.4f %7.4f %8.4f" %  ogp[3:6])
+  logger.debug( "core B  %7.4f %7.4f %8.4f" %  ogp[6:9])
+  logger.debug( "core C  %7.4f %7.4f %8.4f" %  ogp[9:12])
+  logger.debug( "core D  %7.4f %7.4f %8.4f" %  ogp[12:15])
+  logger.debug( "clipped = %.4f%%" % (100.0*snap.clipped_fraction()))
+
+  if keep_artifacts(artifacts, 'full'):
+    tmpfn = fname  + ".fit"
+    logger.debug("savetxt to ..." + tmpfn)
+    savetxt(tmpfn, snap.fit[-1])
+    write_core_files(fname, snap.codes[-1], snap.fits[-1])
+    rfdfn = fname + '.res'
+    write_res(rfdfn, acc.get_residuals())
     logger.debug("written to file " + rfdfn)
-  return ogp, pwr_sinad
+  return ogp, snap.pwr_sinad.mean(), snap
+
+# Triangular weights for the INL corrections.  Row n weights the codes
+# within 15 of correction level 16*n, peaking at 16 on the level itself.
+inl_weights = 16 - absolute(16 * arange(17)[:, None] - arange(256)[None, :])
+inl_weights[inl_weights < 0] = 0
+
+def inl_corrections(residuals, start_code=0):
+  """
+  Compute the INL corrections at the 17 levels 0, 16, ... 256 from an array
+  of the average residual at each code, one column per core (as from
+  FitAccumulator.get_residuals), starting at start_code.  Each correction is
+  the triangular weighted average of the residuals within 15 codes of the
+  level, done for all the cores at once as one normalized convolution with
+  the weights in inl_weights.  The end codes 0 and 255 are not used, and the
+  weights are renormalized over the codes that remain.
 
-def fit_inl(fname='t.res', outname = None):
+  Returns a 17x5 array: the level followed by the correction for each core.
+  Levels with no residuals to average are left as zeros.
+  """
+  residuals = asarray(residuals, dtype=float)
+  ncodes = residuals.shape[0]
+  data = zeros((256, residuals.shape[1]), dtype='float')
+  data[start_code:start_code + ncodes] = residuals
+  present = zeros(256, dtype='float')
+  present[start_code:start_code + ncodes] = 1
+  present[0] = present[255] = 0
+  wt = dot(inl_weights, present)
+  sums = dot(inl_weights, data * present[:, None])
+  good = wt > 0
+  corrections = zeros((17, residuals.shape[1] + 1), dtype='float')
+  corrections[good, 0] = 16 * arange(17)[good]
+  corrections[good, 1:] = sums[good] / wt[good, None]
+  return corrections
+
+def fit_inl(fname='t.res', outname = None, residuals = None, artifacts = 'full'):
   """
   Read the raw residuals from fname.res and compute the INL corrections
   Assume that the residuals file in in core order ie. a,b,c,d.
+  If a 256x4 array of residuals is given, it is used instead of the file.
+  The corrections are written to outname unless artifacts is 'none'.
   """
   
   if outname is None:
@@ -314,118 +724,123 @@ def fit_inl(fname='t.res', outname = None):
       else:
           outname = 'inl%s.meas'%timestamp
 
-  corrections = zeros((17,5), dtype='float')
-  wts = array([1.,2.,3.,4.,5.,6.,7.,8.,9.,10.,11.,12.,13.,14.,15,16,\
-        15.,14.,13.,12.,11.,10.,9.,8.,7.,6.,5.,4.,3.,2.,1.])
-
-  data = genfromtxt(fname, unpack=True)
-  start_data = int(data[0][0])
-  file_limit = len(data[0])
-  data_limit = start_data + file_limit
-  logger.debug("%d %d"%(start_data, data_limit))
-  if data[0][data_limit - start_data - 1] != data_limit - 1:
-    logger.debug( "there are holes in the data file")
-    return
-  for corr_level in range(17):
-    # a and b are positions in the file
-    a = corr_level*16 - 15 - start_data
-    b = a + 31
-    if a < 0:
-      a = 0
-    if a == 0 and start_data == 0:
-      a = 1
-    if b > file_limit:
-      b = file_limit
-    if b == file_limit and data_limit == 256:
-      b -= 1
-    if a > b:
-      continue
-    wt_a = a - corr_level*16 + 15 + start_data
-    wt_b = wt_a -a + b
-    wt = sum(wts[wt_a:wt_b])
-    av1 = sum(data[1][a:b]*wts[wt_a:wt_b])/wt
-    av2 = sum(data[2][a:b]*wts[wt_a:wt_b])/wt
-    av3 = sum(data[3][a:b]*wts[wt_a:wt_b])/wt
-    av4 = sum(data[4][a:b]*wts[wt_a:wt_b])/wt
-    logger.debug("%d %7.5f %7.5f %7.5f %7.5f" %  (16*corr_level,av1,av2,av3,av4))
-    corrections[corr_level][0] = 16*corr_level
-    corrections[corr_level][1] = av1
-    corrections[corr_level][2] = av2
-    corrections[corr_level][3] = av3
-    corrections[corr_level][4] = av4
-  #if fname[:4] == 'hist':
-  #  outname = 'hist_inl%s.meas'%timestamp
-  #else:
-  #  outname = 'inl%s.meas'%timestamp
-  logger.debug("savetxt to ..." + outname)
-  savetxt(outname, corrections, fmt=('%3d','%7.4f','%7.4f','%7.4f','%7.4f'))
+  if residuals is not None:
+    corrections = inl_corrections(residuals)
+  else:
+    data = genfromtxt(fname)
+    start_data = int(data[0][0])
+    file_limit = len(data)
+    data_limit = start_data + file_limit
+    logger.debug("%d %d"%(start_data, data_limit))
+    if data[data_limit - start_data - 1][0] != data_limit - 1:
+      logger.debug( "there are holes in the data file")
+      return
+    corrections = inl_corrections(data[:, 1:5], start_data)
+  for c in corrections:
+    logger.debug("%d %7.5f %7.5f %7.5f %7.5f" %  tuple(c))
+  if keep_artifacts(artifacts, 'summary'):
+    logger.debug("savetxt to ..." + outname)
+    savetxt(outname, corrections, fmt=('%3d','%7.4f','%7.4f','%7.4f','%7.4f'))
   return corrections.transpose()[1:5]
 
 
+class SpectralMetrics:
+  """
+  The figures of merit of a power spectrum with a test tone: the signal
+  and worst spur peaks, SFDR, SINAD and ENOB.
+  """
+
+  def __init__(self, sig_freq, sig_db, sfdr, sinad, spur_freq, spur_db):
+    self.sig_freq = sig_freq
+    self.sig_db = sig_db
+    self.sfdr = sfdr
+    self.sinad = sinad
+    self.enob = (sinad - 1.76) / 6.02
+    self.spur_freq = spur_freq
+    self.spur_db = spur_db
+
+  def get_result(self):
+    return self.sig_freq, self.sig_db, self.sfdr, self.sinad, self.spur_freq
+
+def spectral_metrics(freqs, pwr, sig_freq):
+  """
+  Find the peaks in the power spectrum pwr (linear, at the frequencies
+  freqs) and calculate the SFDR, SINAD and ENOB for a test tone at sig_freq.
+  A peak is a run of channels above -70 dB within 4 MHz of the signal, or
+  above -90 dB elsewhere.  The signal is the strongest peak within 1 MHz of
+  sig_freq and the worst spur the strongest of the others, both measured by
+  the total power in the peak.  A peak is at the frequency of its strongest
+  channel.
+
+  This differs from the channel by channel scan that dosfdr used to do in
+  four ways:
+    - a peak's frequency was that of its last channel, not its strongest;
+    - of several peaks near sig_freq, the last was the signal, not the
+      strongest;
+    - a channel exactly at the threshold continued a peak; it now ends it;
+    - a peak still open at the end of the spectrum was dropped; it is now
+      counted.
+
+  Returns a SpectralMetrics; its values are NaN if no signal is found.
+  """
+  freqs = asarray(freqs, dtype=float)
+  pwr = asarray(pwr, dtype=float)
+  db = 10.0*log10(pwr)
+  test = where(absolute(freqs - sig_freq) < 4, -70.0, -90.0)
+  above = concatenate(([0], (db > test).astype(int), [0]))
+  edges = diff(above)
+  starts = where(edges == 1)[0]
+  ends = where(edges == -1)[0]
+  tot_pwr = pwr.sum()
+  if len(starts) == 0:
+    logger.warning("no peaks found in the spectrum")
+    return SpectralMetrics(sig_freq, nan, nan, nan, nan, nan)
+  # total power in each peak, and the channel of its maximum
+  cum_pwr = concatenate(([0.0], cumsum(pwr)))
+  peak_pwr = cum_pwr[ends] - cum_pwr[starts]
+  label = cumsum(edges[:-1] == 1) - 1
+  chans = where(above[1:-1] == 1)[0]
+  order = chans[lexsort((db[chans], label[chans]))]
+  peak_chan = order[cumsum(ends - starts) - 1]
+  peak_freq = freqs[peak_chan]
+  is_sig = absolute(peak_freq - sig_freq) < 1
+  if not is_sig.any():
+    logger.warning("no signal found near %.4f MHz" % sig_freq)
+    return SpectralMetrics(sig_freq, nan, nan, nan, nan, nan)
+  sig = where(is_sig)[0][peak_pwr[is_sig].argmax()]
+  sig_pwr = peak_pwr[sig]
+  sinad = 10.0*log10(sig_pwr / (tot_pwr - sig_pwr))
+  if is_sig.all():
+    return SpectralMetrics(peak_freq[sig], db[peak_chan[sig]], nan, sinad,
+                           nan, nan)
+  spur = where(~is_sig)[0][peak_pwr[~is_sig].argmax()]
+  sfdr = 10.0*log10(sig_pwr / peak_pwr[spur])
+  return SpectralMetrics(peak_freq[sig], db[peak_chan[sig]], sfdr, sinad,
+                         peak_freq[spur], db[peak_chan[spur]])
+
 def dosfdr(sig_freq, fname = 'psd'):
   """
   Read the psd data from a file and calculate the SFDR and SINAD.  Write the
   results in a file named sfdr
   """
   
-  tot_pwr = 0.0
-  in_peak = False
-  spur_pwr = 0.0
-  for line in open(fname , 'r'):
-    f, d = line.split()
-    freq = float(f)
-    if abs(freq - sig_freq) < 4:
-      test = -70
-    else:
-      test = -90
-    db = float(d)
-    pwr = 10**(float(db)/10.)
-    tot_pwr += pwr
-    if in_peak:
-      if db < test:
-        in_peak = False
-        if abs(peak_freq - sig_freq) < 1:
-          sig_pwr = pwr_in_peak
-          sig_db = peak_db
-          peak_sig_freq = peak_freq
-        else:
-          if pwr_in_peak > spur_pwr:
-            spur_pwr = pwr_in_peak
-            spur_db = peak_db
-            spur_freq = peak_freq
-      else:
-        pwr_in_peak += 10**(float(db)/10.)
-        if db > peak_db:
-          peak_db = db
-        peak_freq = freq
-    elif db > test:
-      pwr_in_peak = 10**(float(db)/10.)
-      peak_freq = freq
-      peak_db = db
-      in_peak = True
+  freqs, db = loadtxt(fname, unpack=True, ndmin=2)
+  m = spectral_metrics(freqs, 10**(db/10.), sig_freq)
   outfdfn = 'sfdr' + timestamp
   outfd = open(outfdfn, 'a')
-  sfdr = 10.0*math.log10(sig_pwr / spur_pwr)
-  sinad = 10.0*math.log10(sig_pwr/(tot_pwr - sig_pwr))
   logstr = "%8.3f %6.2f %6.2f %6.2f %7.2f" %\
-        (sig_freq, sig_db, sfdr, sinad, spur_freq)
+        (sig_freq, m.sig_db, m.sfdr, m.sinad, m.spur_freq)
   logger.debug("writing to file " + outfdfn + ": " + logstr)
   outfd.write(logstr)
+  outfd.close()
+  return m
 
 # Start of code for histograms
 def cumsin(p, codes):
+  "The cumulative distribution of a sine wave of amplitude p[0] and offset p[1]."
   amp = p[0]
-  arg=(codes-127.5+p[1])/amp
-  for i in range(size(arg)):
-    a = arg[i]
-    if a > 1.0:
-      arg[i] = 1.0
-    elif a < -1.0:
-      arg[i] = 0.0
-    else:
-      arg[i] = 1-arccos(a)/pi
-  return arg
-#  return array([(sign(a)+1)/2 if abs(a) > 1.0 else 1-arccos(a)/pi for a in arg])
+  arg=(asarray(codes, dtype=float)-127.5+p[1])/amp
+  return 1-arccos(clip(arg, -1.0, 1.0))/pi
 
 def pltcumsin(p):
   codes = array(range(0,256), dtype=float)
@@ -447,10 +862,102 @@ def pltcumgaussian(p):
 def hist_residuals(p, codes, cumhist, fit_function):
   return cumhist - fit_function(p, codes)
 
+def code_residuals(cumhist, cumresid):
+  """
+  Convert the residuals of the fit to a cumulative histogram into residuals
+  in codes by dividing by the slope of the fitted curve.  The sign is
+  inverted so the INL corrections will be correct.
+  Returns the code residuals and the fit extended by one code at each end.
+  """
+  extended_fit = empty(258, dtype=float)
+  extended_fit[1:257] = cumhist-cumresid
+  extended_fit[0] = 2 * extended_fit[1] - extended_fit[2]
+  extended_fit[257] = 2 * extended_fit[256] - extended_fit[255]
+  up = extended_fit[2:] - extended_fit[1:257]
+  down = extended_fit[1:257] - extended_fit[:256]
+  use_up = (cumresid > 0) & (up > 0)
+  use_down = ~use_up & (down > 0)
+  coderesid = zeros(256, dtype=float)
+  coderesid[use_up] = -cumresid[use_up] / up[use_up]
+  coderesid[use_down] = -cumresid[use_down] / down[use_down]
+  return coderesid, extended_fit
+
+def fit_cumhist(counts, type='sin'):
+  """
+  Fit the cumulative distribution of a sine wave (or a gaussian) to the
+  histogram counts of the 256 codes of one core.
+  Returns the fit parameters and the residual at each code.
+  """
+  if type == "sin":
+    fit_function = cumsin
+  else:
+    fit_function = cumgaussian
+  codes = arange(0,256, dtype=float)
+  counts = asarray(counts, dtype=float)
+  cumhist = cumsum(counts)/counts.sum()
+  args = (codes[0:255], cumhist[0:255], fit_function)
+  p = leastsq(hist_residuals, [135,0], args)[0]
+  cumresid = hist_residuals(p, codes, cumhist, fit_function)
+  coderesid, extended_fit = code_residuals(cumhist, cumresid)
+  return p, coderesid
+
+class CodeHistogram:
+
+  """
+  Accumulates a histogram of the output codes of each core over a stream of
+  raw snapshots, for the histogram method of finding the INL corrections.
+  The counts are kept as a 256x4 array indexed by [code+128][n] with the
+  cores in time sequence.
+  """
+
+  def __init__(self):
+    self.clear()
+
+  def clear(self):
+    self.counts = zeros((256, 4), dtype='int64')
+
+  def add(self, samples):
+    "Add in the codes of a snapshot, or of each snapshot in a stack."
+    adc = asarray(samples, dtype=int)
+    n = adc.shape[-1] // 4
+    adc = adc[..., :4*n].reshape(-1, 4)
+    # one bincount for all the cores, binned by 256*core + code
+    bins = (adc + 128) + 256*arange(4)
+    self.counts += bincount(bins.ravel(), minlength=1024).reshape(4, 256).transpose()
+
+  def merge(self, other):
+    "Add in the counts of another CodeHistogram."
+    self.counts += other.counts
+
+  def get_samples(self):
+    "The number of samples counted in each core."
+    return self.counts.sum(axis=0)
+
+  def get_hist(self):
+    "Returns the counts as a 256x4 array in core order, ie. a,b,c,d."
+    return self.counts[:, [0, 2, 1, 3]]
+
+  def write(self, fname):
+    "Write the histogram in the format read by fit_hist."
+    savetxt(fname, concatenate((arange(256)[:, None], self.get_hist()), axis=1),
+            fmt='%d')
+
+  def fit(self, type='sin'):
+    """
+    Fit each core's cumulative histogram.  Returns the fit parameters as
+    a 4x2 array and the residuals as a 256x4 array, both in core order, ie.
+    a,b,c,d.  The residuals can be given to fit_inl.
+    """
+    hist = self.get_hist()
+    params = zeros((4, 2), dtype=float)
+    residuals = zeros((256, 4), dtype=float)
+    for core in range(4):
+      params[core], residuals[:, core] = fit_cumhist(hist[:, core], type)
+    return params, residuals
+
 def fit_hist(core=1, type='sin', fname='hist_cores'):
   global cumhist, hist, plsq, cumresid, extended_fit
 
-  coderesid=empty(256,dtype=float)
   if type == "sin":
     fit_function = cumsin
   else:
@@ -462,17 +969,6 @@ def fit_hist(core=1, type='sin', fname='hist_cores'):
   cumhist=cumsum(hist[core])/t
   args = (codes[0:255], cumhist[0:255], fit_function)
   plsq = leastsq(hist_residuals, [135,0], args)
-  extended_fit = empty(258, dtype=float)
   cumresid = hist_residuals(plsq[0],codes, cumhist, fit_function)
-  extended_fit[1:257] = cumhist-cumresid
-  extended_fit[0] = 2 * extended_fit[1] - extended_fit[2]
-  extended_fit[257] = 2 * extended_fit[256] - extended_fit[255]
-  # invert the sign of cumresid so inl corrections will be correct
-  for i in range(256):
-    if(cumresid[i] > 0 and extended_fit[i+2] > extended_fit[i+1]):
-      coderesid[i] = -cumresid[i] / (extended_fit[i+2] - extended_fit[i+1])
-    elif(extended_fit[i+1] > extended_fit[i]):
-      coderesid[i] = -cumresid[i] / (extended_fit[i+1] - extended_fit[i])
-    else:
-      coderesid[i]=0
+  coderesid, extended_fit = code_residuals(cumhist, cumresid)
   return plsq[0], coderesid
@@ -5,6 +5,7 @@ import numpy as np
 from datetime import datetime
 
 from ADCCalibrate import ADCCalibrate
+import fit_cores
 
 class ADCCalibrateTest(unittest.TestCase):
     'Unit tests for .'
@@ -52,7 +53,7 @@ class ADCCalibrateTest(unittest.TestCase):
         self.assertEquals(exp, self.adc.loaded_files)
 
         # probe the lower level objects to make sure commands were sent
-        self.assertEqual(138, len(self.adc.spi.regs))
+        self.assertEqual(122, len(self.adc.spi.regs))
 
         # test filters
         self.adc.load_calibrations(indir = indir, zdoks = 1, types = ['ogp'])
@@ -67,7 +68,43 @@ class ADCCalibrateTest(unittest.TestCase):
         self.assertEquals([], self.adc.loaded_files)
 
         # probe the lower level objects to make sure commands were sent
-        self.assertEqual(138, len(self.adc.spi.regs))
+        self.assertEqual(122, len(self.adc.spi.regs))
+
+    def test_do_ogp_batch(self):
+
+        # fit the intermediate snapshot files, and don't write over
+        # the OGP files in testdata
+        self.adc.ogp.test = True
+        self.adc.ogp.artifacts = 'none'
+        fns = ['testdata/ogp_noroach_z%d_2014-04-24-090838' % i for i in range(2)]
+        exp = [np.genfromtxt(fn) for fn in fns]
+
+        self.adc.do_ogp(0, 18.3105, 10, batch = True)
+        self.assertEquals(10, self.adc.ogp.snap_fit.get_repeats())
+        for e, o in zip(exp[0], self.adc.ogp.ogps):
+            self.assertAlmostEquals(e, o, 4)
+
+        ogps = self.adc.do_ogp(2, 18.3105, 10, batch = True)
+        for zdok in range(2):
+            for e, o in zip(exp[zdok], ogps[zdok]):
+                self.assertAlmostEquals(e, o, 4)
+
+    def test_do_inl_hist(self):
+
+        # don't write over the INL files in testdata
+        self.adc.ogp.artifacts = 'none'
+        self.adc.inl.artifacts = 'none'
+
+        # the INLs from the histogram of 10 snapshots
+        self.adc.do_inl(0, hist = 10)
+        self.assertEquals(10*16384, self.adc.ogp.code_hist.get_hist().sum())
+        residuals = self.adc.ogp.code_hist.fit()[1]
+        exp = fit_cores.fit_inl(residuals = residuals, artifacts = 'none')
+        self.assertTrue((np.abs(exp - self.adc.inl.inls) < 1e-12).all())
+
+        # not from the OGP fits
+        self.adc.do_inl(0)
+        self.assertFalse((np.abs(exp - self.adc.inl.inls) < 1e-12).all())
 
     # *************** The below tests are using dummy input data, so checking their
     # results is of limited value.  Here we basically make sure theres no failures.
@@ -1,10 +1,22 @@
 import unittest
 import logging
 import os
+import time
 import numpy as np
 from datetime import datetime
 
 from ADCCalibrations import ADCCalibrations
+from FpgaRecording import RecordingFpgaClient
+
+class Reply:
+    "A katcp reply, as far as ValonKATCP looks at one."
+    def __init__(self, arguments):
+        self.arguments = arguments
+
+class ValonRoach:
+    "Answers the Valon's katcp requests."
+    def _request(self, name, *args):
+        return Reply(['ok']), []
 
 class ADCCalibrationsTest(unittest.TestCase):
     'Unit tests for .'
@@ -53,3 +65,30 @@ class ADCCalibrationsTest(unittest.TestCase):
     def test_find_all_mmcms(self):
 
         self.adc.find_all_mmcms()
+
+    def test_replay(self):
+
+        # a recording of the roach setting up the Valon
+        fn = 'testdata/noroach.rec'
+        rec = RecordingFpgaClient(ValonRoach(), fn)
+        rec._request("valon-new-port", "/dev/ttyS1")
+        rec.close()
+
+        adc = ADCCalibrations(data_dir = 'testdata'
+                            , conf_dir = 'testdata'
+                            , roaches = ['noroach']
+                            , now = self.adc.now
+                            , replay = True)
+        adc.init_for_roach('noroach')
+        # the synthesizer is never connected to
+        self.assertTrue(adc.cal.gpib.test)
+        self.assertEquals(None, adc.cal.gpib.sock)
+        self.assertFalse(adc.cal.settle)
+        self.assertFalse(adc.cal.ogp.settle)
+
+        # nor waited on
+        start = time.time()
+        adc.change_bof('test.bof')
+        self.assertTrue(time.time() - start < 1.0)
+        self.assertEquals([('progdev', ('test.bof',), {})], adc.roach.writes)
+        os.remove(fn)
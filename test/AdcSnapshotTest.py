@@ -0,0 +1,161 @@
+import unittest
+import os
+import numpy as np
+from struct import pack
+
+from AdcSnapshot import AdcSnapshot, FixtureCache
+import fit_cores
+
+class FakeRoach:
+    """
+    Returns canned katcp snapshots, the way corr's snapshot_get does.
+    Given a list of payloads, returns each in turn.
+    """
+
+    def __init__(self, data = None, brams = None, busy = 0):
+        self.data = data if type(data) == list else [data]
+        self.snap_names = []
+        # the registers of each snap block, for the arm/poll/read path
+        self.brams = brams if brams is not None else {}
+        self.busy = busy
+        self.writes = []
+        self.reads = []
+
+    def snapshot_get(self, snap_name, man_trig=True, wait_period=2):
+        data = self.data[len(self.snap_names) % len(self.data)]
+        self.snap_names.append(snap_name)
+        if data is None:
+            raise RuntimeError("snapshot timed out")
+        return {'length' : len(data), 'offset' : 0, 'data' : data}
+
+    def write_int(self, name, value):
+        self.writes.append((name, value))
+
+    def read_uint(self, name):
+        self.reads.append(name)
+        length = len(self.brams[name[:-len('_status')]])
+        if self.busy > 0:
+            # still capturing
+            self.busy -= 1
+            return 0x80000000
+        return length
+
+    def read(self, name, size):
+        self.reads.append(name)
+        return self.brams[name[:-len('_bram')]][:size]
+
+def pack_snap(samples):
+    return pack('%ib' % len(samples), *samples)
+
+class AdcSnapshotTest(unittest.TestCase):
+    'Unit tests for AdcSnapshot.'
+
+    def test_get_adc_snapshot(self):
+
+        samples = [-128, -1, 0, 1, 127] * 4
+        roach = FakeRoach(pack_snap(samples))
+        adc = AdcSnapshot(zdok = 1, roach = roach, clockrate = 1500.)
+
+        snap = adc.get_adc_snapshot()
+        self.assertEquals(['adcsnap1'], roach.snap_names)
+        self.assertEquals(np.int8, snap.dtype)
+        self.assertEquals(samples, snap.tolist())
+
+        # the test vector decoding must not overflow the int8 samples
+        cores = adc.get_test_vector(['adcsnap1'])
+        codes = [((s + 128) >> 1) ^ (s + 128) for s in samples]
+        for n in range(4):
+            self.assertEquals(codes[n::4], [int(c) for c in cores[n]])
+
+    def test_prefetch_snapshots(self):
+
+        snaps = [[i]*8 for i in range(5)]
+        roach = FakeRoach([pack_snap(s) for s in snaps])
+        adc = AdcSnapshot(zdok = 0, roach = roach, clockrate = 1500.)
+
+        got = [s.tolist() for s in adc.prefetch_snapshots(5, depth = 1)]
+        self.assertEquals(snaps, got)
+        self.assertEquals(['adcsnap0']*5, roach.snap_names)
+
+        # the caller may stop early
+        roach.snap_names = []
+        for s in adc.prefetch_snapshots(5, depth = 1):
+            break
+        self.assertEquals(snaps[0], s.tolist())
+        self.assertTrue(len(roach.snap_names) <= 3)
+
+        # a failed capture is raised in the caller
+        roach = FakeRoach([pack_snap(snaps[0]), None])
+        adc = AdcSnapshot(zdok = 1, roach = roach, clockrate = 1500.)
+        prefetch = adc.prefetch_snapshots(3)
+        self.assertEquals(snaps[0], prefetch.next().tolist())
+        self.assertRaises(RuntimeError, prefetch.next)
+
+    def test_get_dual_snapshot(self):
+
+        snaps = [[-128, 0, 1, 127]*4, [5, -5, 6, -6]*4]
+        brams = dict([("adcsnap%d" % i, pack_snap(snaps[i])) for i in range(2)])
+        roach = FakeRoach(brams = brams, busy = 3)
+        adc = AdcSnapshot(zdok = 0, roach = roach, clockrate = 1500.)
+
+        dual = adc.get_dual_snapshot()
+        self.assertEquals((2, 16), dual.shape)
+        self.assertEquals(np.int8, dual.dtype)
+        self.assertEquals(snaps, dual.tolist())
+        # both are armed, then both triggered, before waiting on either
+        exp = [('adcsnap0_ctrl', 2), ('adcsnap1_ctrl', 2)
+             , ('adcsnap0_ctrl', 3), ('adcsnap1_ctrl', 3)]
+        self.assertEquals(exp, roach.writes)
+        self.assertEquals(['adcsnap0_bram', 'adcsnap1_bram'], roach.reads[-2:])
+
+        # the spectra of both
+        spec = adc.get_dual_spec()
+        self.assertEquals((2, 8), spec.shape)
+        for i in range(2):
+            self.assertTrue((adc.calc_spec(np.array(snaps[i])) == spec[i]).all())
+
+        # a snap block that never finishes
+        roach = FakeRoach(brams = brams, busy = 1000)
+        adc = AdcSnapshot(zdok = 0, roach = roach, clockrate = 1500.)
+        self.assertRaises(RuntimeError, adc.get_dual_snapshot, wait_period = 0.2)
+
+        # test mode reads the canned data of each zdok
+        adc = AdcSnapshot(zdok = 0, test = True, clockrate = 1500.)
+        dual = adc.get_dual_raw()
+        for i in range(2):
+            self.assertTrue((adc.get_raw(i) == dual[i]).all())
+
+    def test_get_adc_snapshot_test(self):
+
+        adc = AdcSnapshot(zdok = 0, test = True, clockrate = 1500.)
+        snap = adc.get_adc_snapshot()
+        self.assertEquals(np.int8, snap.dtype)
+        exp = np.genfromtxt("testdata/adc_snapshots/snapshot_adcsnap0_1", dtype=int)
+        self.assertTrue((exp == snap).all())
+
+    def test_fixture_cache(self):
+
+        fname = 'testdata/snapshot_raw_noroach_z0_2014-04-24-090838.dat.0'
+        cache = FixtureCache()
+        snap = cache.get(fname)
+        self.assertTrue((fit_cores.read_snap(fname) == snap).all())
+        self.assertFalse(snap.flags.writeable)
+        # parsed once, then served from the cache
+        self.assertTrue(snap is cache.get(fname))
+        small = cache.get(fname, np.int8)
+        self.assertEquals(np.int8, small.dtype)
+        self.assertTrue((snap == small).all())
+        self.assertTrue(small is cache.get(fname, 'int8'))
+
+        # a changed file is read again
+        tname = 'testdata/fixture_cache_test'
+        fit_cores.write_snapshot(tname, snap[:8])
+        self.assertEquals(snap[:8].tolist(), cache.get(tname).tolist())
+        os.utime(tname, (0, 0))
+        fit_cores.write_snapshot(tname, snap[8:24])
+        os.utime(tname, (1, 1))
+        self.assertEquals(snap[8:24].tolist(), cache.get(tname).tolist())
+        os.remove(tname)
+
+if __name__ == '__main__':
+    unittest.main()
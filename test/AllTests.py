@@ -9,6 +9,10 @@ from OGPTest import OGPTest
 from INLTest import INLTest
 from MMCMTest import MMCMTest
 from ADCCalibrationsTest import ADCCalibrationsTest
+from FitCoresTest import FitCoresTest
+from AdcSnapshotTest import AdcSnapshotTest
+from SnapshotArchiveTest import SnapshotArchiveTest
+from FpgaRecordingTest import FpgaRecordingTest
 import unittest
 
 if __name__ == "__main__":
@@ -0,0 +1,383 @@
+import unittest
+import os
+import math
+import numpy as np
+from scipy.optimize import leastsq
+
+import fit_cores
+
+class FitCoresTest(unittest.TestCase):
+    'Unit tests for fit_cores.'
+
+    def get_snapshot(self, n = 4096, clip = False):
+        "A sine wave with a different offset and amplitude for each core."
+        del_phi = 2 * math.pi * 18.3105 / 3000.0
+        s = np.sin(del_phi * np.arange(n))
+        c = np.cos(del_phi * np.arange(n))
+        offs = np.tile([1.0, -2.0, 0.5, 3.0], n/4)
+        amps = np.tile([100.0, 101.0, 99.0, 100.5], n/4)
+        if clip:
+            amps = amps * 1.5
+        noise = np.random.RandomState(0).normal(0, 1.0, n)
+        adc = np.round(offs + amps * (0.8 * s + 0.6 * c) + noise)
+        adc = np.clip(adc, -128, 127)
+        return adc, s, c
+
+    def test_fit_sines(self):
+
+        for clip in [False, True]:
+            adc, s, c = self.get_snapshot(clip = clip)
+            fit = fit_cores.fit_sines(adc, s, c)
+            p = fit.params
+            self.assertEquals((5, 3), p.shape)
+            self.assertEquals(clip, fit.clipped_fraction() > 0)
+            # compare against the iterative fit that this replaces
+            for i in range(5):
+                sl = slice(None) if i == 0 else slice(i-1, None, 4)
+                args = (s[sl], c[sl], adc[sl])
+                exp = leastsq(fit_cores.sin_residuals, [128.0, 90.0, 90.0], args)[0]
+                for j in range(3):
+                    self.assertAlmostEquals(exp[j], p[i][j], 4)
+
+    def test_fit_sines_clipped_core(self):
+
+        # core 2 is clipped throughout, so only its fit is left nan
+        adc, s, c = self.get_snapshot()
+        adc[1::4] = 127
+        fit = fit_cores.fit_sines(adc, s, c)
+        self.assertTrue(np.isnan(fit.params[2]).all())
+        self.assertTrue(np.isfinite(fit.params[[0, 1, 3, 4]]).all())
+        exp = fit_cores.fit_sines(adc[::4], s[::4], c[::4]).params[0]
+        for j in range(3):
+            self.assertAlmostEquals(exp[j], fit.params[1][j], 8)
+
+        # all clipped, in one snapshot of a stack
+        stack = np.array([adc, np.where(adc > 0, 127, -128)])
+        fit = fit_cores.fit_sines(stack, s, c)
+        self.assertEquals((2, 5, 3), fit.params.shape)
+        self.assertTrue(np.isnan(fit.params[1]).all())
+        self.assertTrue(np.isfinite(fit.params[0][[0, 1, 3, 4]]).all())
+
+    def test_sin_residuals(self):
+
+        adc = np.array([-128, 0, 5, 127, -3], dtype=float)
+        s = np.zeros(5)
+        c = np.ones(5)
+        p = [1.0, 0.0, 2.0]
+        exp = [0.0, -3.0, 2.0, 0.0, -6.0]
+        self.assertEquals(exp, list(fit_cores.sin_residuals(p, s, c, adc)))
+        clipped = fit_cores.clip_mask(adc)
+        self.assertEquals([True, False, False, True, False], list(clipped))
+        self.assertEquals(exp, list(fit_cores.sin_residuals(p, s, c, adc, clipped)))
+
+    def test_residual_histogram(self):
+
+        codes = [[-128, 0, 0, 127], [1, 1, 2, 2], [0, 0, 0, 0], [5, 6, 7, 8]]
+        fits = [[-127.5, 0.5, -0.25, 126.0], [1, 1, 2, 2], [0, 1, 2, 3], [5, 6, 7, 8]]
+        errors, counts = fit_cores.residual_histogram(codes, fits)
+        self.assertEquals((256, 4), errors.shape)
+        self.assertEquals((256, 4), counts.shape)
+        self.assertEquals(16, counts.sum())
+        self.assertEquals([1, 0, 0, 0], list(counts[0]))
+        self.assertEquals([2, 0, 4, 0], list(counts[128]))
+        self.assertEquals([1, 0, 0, 0], list(counts[255]))
+        self.assertAlmostEquals(-0.5, errors[0][0])
+        self.assertAlmostEquals(-0.25, errors[128][0])
+        self.assertAlmostEquals(1.0, errors[255][0])
+        self.assertAlmostEquals(-6.0, errors[128][2])
+        self.assertEquals(0.0, errors[:, 1].sum())
+
+    def test_fit_snapshot(self):
+
+        fname = 'testdata/snapshot_raw_noroach_z0_2014-04-24-090838.dat.0'
+        samples = fit_cores.read_snap(fname)
+        self.assertEquals(16384, len(samples))
+        snap = fit_cores.fit_snapshot(samples, 18.3105, 3000.0)
+
+        self.assertEquals(4, len(snap.offsets))
+        self.assertEquals(4, len(snap.amps))
+        self.assertEquals(4, len(snap.delays))
+        self.assertAlmostEquals(snap.amps.mean(), snap.avamp)
+        self.assertAlmostEquals(10.0*np.log10(snap.pwr_sinad), snap.sinad)
+        self.assertEquals((4, 4096), snap.codes.shape)
+        self.assertEquals((4, 4096), snap.fits.shape)
+        self.assertEquals(16384, snap.ce_counts.sum())
+
+        # the offsets of cores a, b, c & d are in the result tuple
+        result = snap.get_result()
+        self.assertEquals(15, len(result))
+        self.assertEquals(18.3105, result[0])
+        self.assertEquals([snap.offsets[i] for i in [0, 2, 1, 3]]
+                        , [result[i] for i in [3, 6, 9, 12]])
+
+    def test_fit_accumulator(self):
+
+        fname = 'testdata/snapshot_raw_noroach_z0_2014-04-24-090838.dat.%d'
+        snaps = [fit_cores.fit_snapshot(fit_cores.read_snap(fname % i), 18.3105, 3000.0)
+                     for i in range(4)]
+
+        # all at once
+        acc = fit_cores.FitAccumulator()
+        for snap in snaps:
+            acc.add(snap)
+        self.assertEquals(4, acc.result_cnt)
+
+        # split across two workers, then merged
+        acc1 = fit_cores.FitAccumulator()
+        acc2 = fit_cores.FitAccumulator()
+        for snap in snaps[:2]:
+            acc1.add(snap)
+        for snap in snaps[2:]:
+            acc2.add(snap)
+        acc1.merge(acc2)
+        self.assertEquals(4, acc1.result_cnt)
+        for e, a in zip(acc.get_average(), acc1.get_average()):
+            self.assertAlmostEquals(e, a, 10)
+        self.assertTrue((acc.ce_counts == acc1.ce_counts).all())
+        self.assertTrue(np.allclose(acc.get_residuals(), acc1.get_residuals()))
+        self.assertEquals((256, 4), acc.get_residuals().shape)
+
+        # save and load
+        fn = 'testdata/fit_accumulator.npz'
+        acc.save(fn)
+        acc3 = fit_cores.FitAccumulator.load(fn)
+        os.remove(fn)
+        self.assertEquals(acc.get_average(), acc3.get_average())
+        self.assertTrue((acc.code_errors == acc3.code_errors).all())
+
+        acc.clear()
+        self.assertEquals(0, acc.result_cnt)
+        self.assertEquals(0, acc.ce_counts.sum())
+
+    def test_basis_cache(self):
+
+        cache = fit_cores.BasisCache(maxsize = 2)
+        s, c, s4, c4 = cache.get(18.3105, 3000.0, 16)
+        self.assertEquals((16,), s.shape)
+        self.assertEquals((4, 4), c4.shape)
+        self.assertEquals(list(s[1::4]), list(s4[1]))
+        self.assertEquals(list(c[3::4]), list(c4[3]))
+        self.assertFalse(s.flags.writeable)
+
+        # the same arrays are handed back
+        self.assertTrue(s is cache.get(18.3105, 3000.0, 16)[0])
+
+        # the least recently used entry is dropped
+        cache.get(18.3105, 3200.0, 16)
+        cache.get(18.3105, 3000.0, 16)
+        cache.get(10.0, 3000.0, 16)
+        self.assertEquals(2, len(cache.cache))
+        self.assertTrue(s is cache.get(18.3105, 3000.0, 16)[0])
+        self.assertFalse((18.3105, 3200.0, 16) in cache.cache)
+
+        cache.clear()
+        self.assertEquals(0, len(cache.cache))
+        self.assertFalse(s is cache.get(18.3105, 3000.0, 16)[0])
+
+    def test_fit_snapshot_stack(self):
+
+        fname = 'testdata/snapshot_raw_noroach_z0_2014-04-24-090838.dat.%d'
+        samples = np.array([fit_cores.read_snap(fname % i) for i in range(3)])
+        snaps = [fit_cores.fit_snapshot(s, 18.3105, 3000.0) for s in samples]
+
+        # the repeats can be given in time order or split up by core
+        cores = samples.reshape(3, -1, 4).swapaxes(1, 2)
+        for stack in [samples, cores]:
+            snap = fit_cores.fit_snapshot(stack, 18.3105, 3000.0)
+            self.assertEquals(3, snap.get_repeats())
+            self.assertEquals((3, 15), snap.get_results().shape)
+            self.assertEquals((3, 4, 4096), snap.codes.shape)
+            for i in range(3):
+                for e, r in zip(snaps[i].get_result(), snap.get_results()[i]):
+                    self.assertAlmostEquals(e, r, 8)
+            self.assertEquals(3*16384, snap.ce_counts.sum())
+
+        # mean and standard error over the repeats
+        results = np.array([s.get_result() for s in snaps])
+        mean = snap.get_mean()
+        err = snap.get_std_error()
+        for i in range(1, 15):
+            self.assertAlmostEquals(results[:, i].mean(), mean[i], 8)
+            self.assertAlmostEquals(results[:, i].std(ddof=1)/np.sqrt(3), err[i], 8)
+        self.assertTrue(np.isnan(snaps[0].get_std_error()).all())
+
+    def test_inl_corrections(self):
+
+        fname = 'testdata/snapshot_raw_noroach_z0_2014-04-24-090838.dat.res'
+        data = np.genfromtxt(fname)
+        res = data[:, 1:5]
+
+        # the triangular weighted average around each level by hand,
+        # leaving out the end codes
+        wts = 16.0 - np.abs(np.arange(-15, 16))
+        exp = np.zeros((17, 4))
+        for level in range(17):
+            codes = np.arange(16*level - 15, 16*level + 16)
+            ok = (codes > 0) & (codes < 255)
+            w = wts[ok]
+            exp[level] = np.dot(w, res[codes[ok]])/w.sum()
+
+        corr = fit_cores.inl_corrections(res)
+        self.assertEquals((17, 5), corr.shape)
+        self.assertEquals(range(0, 257, 16), list(corr[:, 0]))
+        for e, c in zip(exp.flat, corr[:, 1:].flat):
+            self.assertAlmostEquals(e, c, 12)
+
+        # residuals for only part of the codes
+        part = fit_cores.inl_corrections(res[40:200], start_code=40)
+        self.assertTrue((part[[0, 1, 14, 15, 16]] == 0).all())
+        self.assertAlmostEquals(corr[5, 1], part[5, 1], 12)
+
+        # from the file, or from the residuals in memory
+        outname = 'testdata/inl_corrections.meas'
+        inls = fit_cores.fit_inl(fname, outname = outname)
+        inls2 = fit_cores.fit_inl(fname, outname = outname, residuals = res)
+        os.remove(outname)
+        self.assertEquals((4, 17), inls.shape)
+        for i1, i2 in zip(inls.flat, inls2.flat):
+            self.assertAlmostEquals(i1, i2, 12)
+
+    def test_spectral_metrics(self):
+
+        # a floor at -120 dB, a two channel tone and two spurs
+        freqs = np.arange(1024)*1500.0/1024
+        pwr = np.ones(1024)*1e-12
+        pwr[200:202] = [1.0, 0.5]
+        pwr[500] = 1e-6
+        pwr[700:703] = 1e-7
+        sig_freq = freqs[200] + 0.5
+
+        m = fit_cores.spectral_metrics(freqs, pwr, sig_freq)
+        self.assertEquals(freqs[200], m.sig_freq)
+        self.assertAlmostEquals(0.0, m.sig_db, 8)
+        self.assertEquals(freqs[500], m.spur_freq)
+        self.assertAlmostEquals(-60.0, m.spur_db, 8)
+        self.assertAlmostEquals(10*np.log10(1.5/1e-6), m.sfdr, 8)
+        noise = pwr.sum() - 1.5
+        self.assertAlmostEquals(10*np.log10(1.5/noise), m.sinad, 8)
+        self.assertAlmostEquals((m.sinad - 1.76)/6.02, m.enob, 8)
+
+        # no tone where we expect it
+        m = fit_cores.spectral_metrics(freqs, pwr, 1000.0)
+        self.assertTrue(np.isnan(m.sfdr))
+        self.assertTrue(np.isnan(m.sinad))
+
+        # the file version
+        fname = 'testdata/psd_test'
+        np.savetxt(fname, np.c_[freqs, 10*np.log10(pwr)])
+        fit_cores.timestamp = '_test'
+        m2 = fit_cores.dosfdr(sig_freq, fname)
+        sfdr = open('sfdr_test').read().split()
+        os.remove(fname)
+        os.remove('sfdr_test')
+        fit_cores.timestamp = ''
+        self.assertAlmostEquals(m2.sfdr, float(sfdr[2]), 2)
+        self.assertAlmostEquals(10*np.log10(1.5/1e-6), m2.sfdr, 6)
+
+    def test_spectral_metrics_peaks(self):
+
+        # where the peaks differ from those of the old channel by channel
+        # dosfdr; a -120 dB floor with 0.25 MHz channels
+        freqs = np.arange(1024)*0.25
+        floor = np.ones(1024)*1e-12
+
+        # a peak is at its strongest channel, not its last
+        pwr = floor.copy()
+        pwr[400:403] = [0.5, 1.0, 0.25]
+        m = fit_cores.spectral_metrics(freqs, pwr, freqs[401])
+        self.assertEquals(freqs[401], m.sig_freq)
+
+        # the strongest peak near the tone is the signal, not the last
+        pwr = floor.copy()
+        pwr[400] = 1.0
+        pwr[402] = 0.01
+        m = fit_cores.spectral_metrics(freqs, pwr, freqs[401])
+        self.assertEquals(freqs[400], m.sig_freq)
+        self.assertAlmostEquals(0.0, m.sig_db, 8)
+        self.assertAlmostEquals(10*np.log10(1.0/(pwr.sum() - 1.0)), m.sinad, 8)
+
+        # a channel right at the threshold (-90 dB away from the tone)
+        # ends a peak
+        pwr = floor.copy()
+        pwr[400] = 1.0
+        pwr[800:803] = [1e-7, 1e-9, 1e-7]
+        m = fit_cores.spectral_metrics(freqs, pwr, freqs[400])
+        self.assertEquals(freqs[800], m.spur_freq)
+        self.assertAlmostEquals(70.0, m.sfdr, 8)
+
+        # and a peak still open at the end of the spectrum is counted
+        pwr = floor.copy()
+        pwr[400] = 1.0
+        pwr[800] = 1e-8
+        pwr[-1] = 1e-6
+        m = fit_cores.spectral_metrics(freqs, pwr, freqs[400])
+        self.assertEquals(freqs[-1], m.spur_freq)
+        self.assertAlmostEquals(60.0, m.sfdr, 8)
+
+    def test_snapshot_files(self):
+
+        fname = 'testdata/snapshot_raw_noroach_z0_2014-04-24-090838.dat.0'
+        text, header = fit_cores.read_snapshot(fname)
+        self.assertEquals({}, header)
+        self.assertEquals(16384, len(text))
+
+        bname = 'testdata/snapshot_binary_test'
+        fit_cores.write_snapshot(bname, text, roach = 'noroach', zdok = 0
+                               , clockrate = 1500., freq = 18.3105
+                               , timestamp = '2014-04-24-090838')
+        size = os.path.getsize(bname)
+        samples, header = fit_cores.read_snapshot(bname)
+        binary = fit_cores.read_snap(bname)
+        os.remove(bname)
+        self.assertTrue(size < os.path.getsize(fname)/3)
+        self.assertTrue((text == samples).all())
+        self.assertTrue((text == binary).all())
+        self.assertEquals('noroach', header['roach'])
+        self.assertEquals(0, header['zdok'])
+        self.assertEquals(1500., header['clockrate'])
+        self.assertEquals(18.3105, header['freq'])
+        self.assertEquals('2014-04-24-090838', header['timestamp'])
+        self.assertEquals(16384, header['length'])
+
+    def test_prescreen_snapshot(self):
+
+        fname = 'testdata/snapshot_raw_noroach_z0_2014-04-24-090838.dat.0'
+        snap = fit_cores.read_snap(fname)
+        p = fit_cores.prescreen_snapshot(snap, 18.3105, 3000.0)
+        self.assertTrue(p.ok())
+        self.assertEquals('', p.get_reasons())
+        self.assertEquals(0.0, p.clip_fraction)
+        self.assertAlmostEquals(snap.std(), p.rms, 8)
+        self.assertAlmostEquals(snap.mean(), p.dc, 8)
+        self.assertAlmostEquals(18.3105, p.tone_freq, 3)
+
+        # the tone aliased from the second Nyquist zone
+        self.assertTrue(fit_cores.prescreen_snapshot(snap, 3000.0 - 18.3105, 3000.0).ok())
+
+        # each problem is reported
+        reasons = [(np.clip(snap*3, -128, 127), 18.3105, 'clipped')
+                 , (snap/20, 18.3105, 'too weak')
+                 , (snap + 20, 18.3105, 'dc level')
+                 , (snap, 100.0, 'strongest tone')]
+        for s, freq, reason in reasons:
+            p = fit_cores.prescreen_snapshot(s, freq, 3000.0)
+            self.assertFalse(p.ok())
+            self.assertEquals(1, len(p.reasons))
+            self.assertTrue(reason in p.get_reasons())
+
+        # the fit leaves out clipped samples, so some clipping is fine
+        clipped = np.clip(np.round(snap*1.2), -128, 127)
+        p = fit_cores.prescreen_snapshot(clipped, 18.3105, 3000.0)
+        self.assertTrue(p.ok())
+        self.assertTrue(p.clip_fraction > 0.03)
+        self.assertEquals(4, len(p.unclipped))
+        self.assertTrue((p.unclipped > 0.9).all())
+
+        # the limits can be changed
+        self.assertFalse(fit_cores.prescreen_snapshot(clipped, 18.3105, 3000.0, min_unclipped = 0.95).ok())
+        self.assertTrue(fit_cores.prescreen_snapshot(snap + 20, 18.3105, 3000.0, max_dc = 25.0).ok())
+        self.assertFalse(fit_cores.prescreen_snapshot(snap, 18.3105, 3000.0, min_rms = 100.0).ok())
+        self.assertTrue(fit_cores.prescreen_snapshot(snap, 18.3105 + 3, 3000.0, tone_tolerance = 20).ok())
+
+if __name__ == '__main__':
+    unittest.main()
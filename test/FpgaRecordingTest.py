@@ -0,0 +1,55 @@
+import unittest
+import os
+import numpy as np
+
+from AdcSnapshot import AdcSnapshot
+from AdcSnapshotTest import FakeRoach, pack_snap
+from FpgaRecording import RecordingFpgaClient, ReplayFpgaClient, read_recording
+
+class FpgaRecordingTest(unittest.TestCase):
+    'Unit tests for RecordingFpgaClient and ReplayFpgaClient.'
+
+    def setUp(self):
+        self.fn = 'testdata/fpga_recording_test.rec'
+        self.tearDown()
+
+    def tearDown(self):
+        if os.path.isfile(self.fn):
+            os.remove(self.fn)
+
+    def test_record_replay(self):
+
+        snaps = [[i, -i]*8 for i in range(3)]
+        brams = dict([("adcsnap%d" % i, pack_snap(snaps[i])) for i in range(2)])
+        roach = FakeRoach([pack_snap(s) for s in snaps], brams = brams, busy = 2)
+
+        # record some captures
+        rec = RecordingFpgaClient(roach, self.fn)
+        adc = AdcSnapshot(zdok = 0, roach = rec, clockrate = 1500.)
+        recorded = [adc.get_adc_snapshot() for i in range(3)]
+        dual = adc.get_dual_snapshot()
+        rec.close()
+        calls = read_recording(self.fn)
+        self.assertEquals(rec.n_calls, len(calls))
+        self.assertEquals(['snapshot_get']*3, [c[0] for c in calls[:3]])
+
+        # and play them back without the roach
+        play = ReplayFpgaClient(self.fn)
+        adc = AdcSnapshot(zdok = 0, roach = play, clockrate = 1500.)
+        for snap in recorded:
+            self.assertTrue((snap == adc.get_adc_snapshot()).all())
+        # the run can't go past its recording
+        self.assertRaises(Exception, adc.get_adc_snapshot)
+        self.assertTrue((dual == adc.get_dual_snapshot()).all())
+        exp = [('write_int', ('adcsnap0_ctrl', 2), {})
+             , ('write_int', ('adcsnap1_ctrl', 2), {})
+             , ('write_int', ('adcsnap0_ctrl', 3), {})
+             , ('write_int', ('adcsnap1_ctrl', 3), {})]
+        self.assertEquals(exp, play.writes)
+
+        # reads that were never recorded
+        self.assertRaises(KeyError, play.read_uint, 'adcsnap2_status')
+        self.assertRaises(AttributeError, getattr, play, 'listdev')
+
+if __name__ == '__main__':
+    unittest.main()
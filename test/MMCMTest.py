@@ -8,6 +8,7 @@ from datetime import datetime
 from SPI import SPI
 from AdcSnapshot import AdcSnapshot
 from MMCM import MMCM
+from SnapshotArchive import SnapshotArchive
 
 class MMCMTest(unittest.TestCase):
     'Unit tests for MMCM.'
@@ -56,6 +57,21 @@ class MMCMTest(unittest.TestCase):
         expGl.extend([0]*39)
         self.assertEquals(expGl, gl)
 
+    def test_archive_ramps(self):
+
+        fn = 'testdata/mmcm_archive_test.arc'
+        self.mmcm.archive = SnapshotArchive(fn)
+        gl = self.mmcm.get_total_glitches([self.mmcm.snap_name], True, 2, 3)
+        ramps = self.mmcm.archive.get(0, 'mmcm', phase = 3)
+        self.assertEquals(gl, self.mmcm.count_glitches(ramps).sum())
+
+        # the check of the optimal phase is kept apart from the sweep
+        op, gls = self.mmcm.calibrate_mmcm_phase()
+        self.assertEquals(range(56), sorted([k[3] for k in self.mmcm.archive.find(purpose = 'mmcm')]))
+        self.assertEquals([(0, 'mmcm_check', 0, op)], self.mmcm.archive.find(purpose = 'mmcm_check'))
+        os.remove(fn)
+        os.remove(fn + '.idx')
+
     def test_count_glitches(self):
 
         phases = [(0,0), (26, 2472)]
@@ -67,6 +83,18 @@ class MMCMTest(unittest.TestCase):
             glitches = self.mmcm.count_glitches(core_a)
             self.assertEquals(exp, glitches)
 
+    def test_count_glitches_cores(self):
+
+        cores = np.array([np.genfromtxt("test_core_a_%d" % ph) for ph in (0, 26)]
+                       , dtype=np.uint8)
+        self.assertEquals([0, 2472], list(self.mmcm.count_glitches(cores)))
+
+        # the ramp wraps from 255 back to 0 without a glitch
+        ramp = np.arange(1000) % 256
+        self.assertEquals(0, self.mmcm.count_glitches(ramp.astype(np.uint8)))
+        ramp[500] = 3
+        self.assertEquals(2, self.mmcm.count_glitches(ramp.astype(np.uint8)))
+
     def test_find_optimal_phase(self):
 
         # from actual results
@@ -2,11 +2,15 @@
 import unittest
 import logging
 import os
+import threading
 import numpy as np
 from datetime import datetime
 
 from SPI import SPI
 from OGP import OGP
+from AdcSnapshot import AdcSnapshot
+from AdcSnapshotTest import FakeRoach, pack_snap
+import fit_cores
 
 class OGPTest(unittest.TestCase):
     'Unit tests for OGP.'
@@ -73,6 +77,54 @@ class OGPTest(unittest.TestCase):
         #     , ':FREQ:CW 18.3105E6\r']
         #self.assertEquals(exp, self.adc.gpib.cmds)     
 
+    def test_do_ogp_dual(self):
+
+        self.adc.do_ogp(0)
+        self.adc.do_ogp(1)
+        fns = ['testdata/ogp_noroach_z%d_2014-04-24-090838' % i for i in range(2)]
+        exp = [np.genfromtxt(fn) for fn in fns]
+        exp_res = dict(self.adc.residuals)
+
+        ogps = self.adc.do_ogp_dual()
+        for zdok in range(2):
+            self.assertEquals(list(exp[zdok]), list(np.genfromtxt(fns[zdok])))
+            for e, o in zip(exp[zdok], ogps[zdok]):
+                self.assertAlmostEquals(e, o, 4)
+            self.assertTrue((exp_res[zdok] == self.adc.residuals[zdok]).all())
+            self.assertEquals(10, self.adc.accs[zdok].result_cnt)
+
+        # fitting all the repeats together gives the same OGPs
+        ogps = self.adc.do_ogp_dual(batch = True)
+        for zdok in range(2):
+            for e, o in zip(exp[zdok], ogps[zdok]):
+                self.assertAlmostEquals(e, o, 4)
+            self.assertEquals(10, self.adc.accs[zdok].result_cnt)
+
+    def test_do_ogp_dual_prefetch(self):
+
+        # serve both zdoks' snap blocks through a fake roach
+        fname = 'testdata/snapshot_raw_noroach_z%d_2014-04-24-090838.dat.0'
+        snaps = [np.loadtxt(fname % zdok, dtype=int) for zdok in range(2)]
+        brams = dict([("adcsnap%d" % zdok, pack_snap(snaps[zdok])) for zdok in range(2)])
+        roach = FakeRoach(brams = brams)
+        adc = OGP(dir = 'testdata'
+                , spi = self.adc.spi
+                , adc = AdcSnapshot(zdok = 0, roach = roach, clockrate = 1500.)
+                , now = self.adc.now
+                , clockrate = 1500.
+                , artifacts = 'none')
+
+        exp = [fit_cores.fit_snapshot(s, 18.3105, 3000.).get_result() for s in snaps]
+        for batch in [False, True]:
+            roach.writes = []
+            ogps = adc.do_ogp_dual(repeat = 3, batch = batch, prefetch = True)
+            # both snap blocks are armed together for each repeat
+            self.assertEquals(3*4, len(roach.writes))
+            for zdok in range(2):
+                for e, o in zip(exp[zdok][3:], ogps[zdok]):
+                    self.assertAlmostEquals(e, o, 4)
+            self.assertEquals(['MainThread'], [th.name for th in threading.enumerate()])
+
     def test_do_snap(self):
 
         # This is the base filename that will be used as input: each iteration
@@ -82,12 +134,214 @@ class OGPTest(unittest.TestCase):
         repeat = 10
         ogp, _ = self.adc.do_snap(freq = freq, fname = fname, repeat = repeat) 
         exp = (18.310500000000001, 2.4986150065254478, 104.76788603357048, 0.32043225809828751, 1.517175579119834, -5.4003278273111848, 5.6399198917743325, -1.2362778942176573, -4.3598573041576856, 0.018731282665579486, 0.57301410206433001, 4.1970603858473625, 4.0153765935635928, -0.85391178696651227, 5.5631247456218258)
-        self.assertEquals(ogp, exp)                         
+        # the closed form fit agrees with the old iterative one to within
+        # leastsq's convergence tolerance
+        self.assertEquals(len(exp), len(ogp))
+        for e, o in zip(exp, ogp):
+            self.assertAlmostEquals(e, o, 5)
+
+    def test_do_snap_batch(self):
+
+        fname = 'testdata/snapshot_raw_noroach_z0_2014-04-24-090838.dat'
+        freq = 18.3105
+        repeat = 10
+        if os.path.exists(fname + '.9.ogp'):
+            os.remove(fname + '.9.ogp')
+        exp, exp_sinad = self.adc.do_snap(freq = freq, fname = fname, repeat = repeat) 
+        ogp, sinad = self.adc.do_snap(freq = freq, fname = fname, repeat = repeat, batch = True) 
+        self.assertEquals(len(exp), len(ogp))
+        for e, o in zip(exp, ogp):
+            self.assertAlmostEquals(e, o, 8)
+        self.assertAlmostEquals(exp_sinad, sinad, 6)
+        self.assertEquals(repeat, self.adc.snap_fit.get_repeats())
+
+        # both writers end their lines, so the batch lines follow the
+        # average written by do_snap: per repeat results, the average
+        # and its error
+        lines = open(fname + '.9.ogp').readlines()
+        os.remove(fname + '.9.ogp')
+        self.assertEquals(repeat + 3, len(lines))
+        self.assertEquals("10 ", lines[0][:3])
+        self.assertEquals("#1 ", lines[1][:3])
+        self.assertEquals("10 ", lines[-2][:3])
+        self.assertEquals("#err ", lines[-1][:5])
+
+    def test_do_hist(self):
+
+        fname = 'testdata/snapshot_raw_noroach_z0_2014-04-24-090838.dat.%d'
+        exp = np.zeros((256, 4), dtype=int)
+        for i in range(10):
+            snap = np.loadtxt(fname % i, dtype=int)
+            for n, core in enumerate([0, 2, 1, 3]):
+                exp[:, core] += np.bincount(snap[n::4] + 128, minlength=256)
+
+        residuals = self.adc.do_hist(0, repeat = 10)
+        self.assertEquals((256, 4), residuals.shape)
+        self.assertTrue((exp == self.adc.code_hist.get_hist()).all())
+        hist = np.loadtxt(self.adc.get_hist_filename(), dtype=int)
+        os.remove(self.adc.get_hist_filename())
+        self.assertTrue((np.arange(256) == hist[:, 0]).all())
+        self.assertTrue((exp == hist[:, 1:]).all())
+
+        # the file based fit gives the same residuals
+        np.savetxt('testdata/hist_cores_test', hist, fmt='%d')
+        for core in range(4):
+            p, coderesid = fit_cores.fit_hist(core + 1, fname = 'testdata/hist_cores_test')
+            for e, r in zip(coderesid, residuals[:, core]):
+                self.assertAlmostEquals(e, r, 8)
+        os.remove('testdata/hist_cores_test')
+
+    def test_do_snap_prefetch(self):
+
+        # serve the test snapshots through a fake roach
+        fname = 'testdata/snapshot_raw_noroach_z0_2014-04-24-090838.dat'
+        snaps = [np.loadtxt("%s.%d" % (fname, i), dtype=int) for i in range(10)]
+        roach = FakeRoach([pack_snap(s) for s in snaps])
+        adc = OGP(dir = 'testdata'
+                , spi = self.adc.spi
+                , adc = AdcSnapshot(zdok = 0, roach = roach, clockrate = 1500.)
+                , now = self.adc.now
+                , clockrate = 1500.)
+
+        fn = 'testdata/snapshot_prefetch_test'
+        exp, exp_sinad = self.adc.do_snap(freq = 18.3105, fname = fname, repeat = 10)
+        ogp, sinad = adc.do_snap(freq = 18.3105, fname = fn, repeat = 10, prefetch = True)
+        self.assertEquals(10, len(roach.snap_names))
+        self.assertTrue((snaps[9] == fit_cores.read_snap(fn)).all())
+        for ext in ["", ".fit", ".ogp", ".a", ".b", ".c", ".d", ".res"]:
+            os.remove(fn + ext)
+        for e, o in zip(exp, ogp):
+            self.assertAlmostEquals(e, o, 8)
+        self.assertAlmostEquals(exp_sinad, sinad, 8)
+
+    def test_do_snap_prescreen(self):
+
+        fname = 'testdata/snapshot_raw_noroach_z0_2014-04-24-090838.dat.0'
+        good = np.loadtxt(fname, dtype=int)
+        silent = np.zeros(len(good), dtype=int)
+        clipped = np.clip(good*3, -128, 127)
+        roach = FakeRoach([pack_snap(s) for s in [silent, clipped, good, good]])
+        adc = OGP(dir = 'testdata'
+                , spi = self.adc.spi
+                , adc = AdcSnapshot(zdok = 0, roach = roach, clockrate = 1500.)
+                , now = self.adc.now
+                , clockrate = 1500.)
+
+        # the bad snapshots are retaken before any fitting
+        fn = 'testdata/snapshot_prescreen_test'
+        exp = fit_cores.fit_snapshot(good, 18.3105, 3000.).get_result()
+        ogp, sinad = adc.do_snap(freq = 18.3105, fname = fn, repeat = 2)
+        self.assertEquals(4, len(roach.snap_names))
+        self.assertEquals(len(exp), len(ogp))
+        for e, o in zip(exp, ogp):
+            self.assertAlmostEquals(e, o, 8)
+
+        # give up when they are all bad
+        roach.data = [pack_snap(silent), pack_snap(clipped)]
+        self.assertRaises(Exception, adc.do_snap, freq = 18.3105, fname = fn, repeat = 1)
+        self.assertEquals(7, len(roach.snap_names))
+
+        # unless the limits allow them
+        roach.snap_names = []
+        adc = OGP(dir = 'testdata'
+                , spi = self.adc.spi
+                , adc = AdcSnapshot(zdok = 0, roach = roach, clockrate = 1500.)
+                , now = self.adc.now
+                , clockrate = 1500.
+                , prescreen_limits = {'min_unclipped' : 0.2})
+        adc.do_snap(freq = 18.3105, fname = fn, repeat = 1)
+        self.assertEquals(2, len(roach.snap_names))
+        for ext in ["", ".fit", ".ogp", ".a", ".b", ".c", ".d", ".res"]:
+            os.remove(fn + ext)
+
+    def test_do_snap_prescreen_prefetch(self):
+
+        fname = 'testdata/snapshot_raw_noroach_z0_2014-04-24-090838.dat.0'
+        good = np.loadtxt(fname, dtype=int)
+        silent = np.zeros(len(good), dtype=int)
+
+        class ThreadRoach(FakeRoach):
+            "Notes the thread each snapshot is taken on."
+            def snapshot_get(self, snap_name, man_trig=True, wait_period=2):
+                this = threading.current_thread()
+                others = [th.name for th in threading.enumerate()
+                          if th is not this and th.name.startswith('prefetch')]
+                self.threads.append((this.name, others))
+                return FakeRoach.snapshot_get(self, snap_name, man_trig, wait_period)
+
+        roach = ThreadRoach([pack_snap(s) for s in [silent, good, good]])
+        roach.threads = []
+        adc = OGP(dir = 'testdata'
+                , spi = self.adc.spi
+                , adc = AdcSnapshot(zdok = 0, roach = roach, clockrate = 1500.)
+                , now = self.adc.now
+                , clockrate = 1500.
+                , prefetch = True)
+
+        # the rejected snapshot is retaken by the prefetch thread, and the
+        # next prefetch thread only starts once the last one is done, so no
+        # two captures ever overlap
+        fn = 'testdata/snapshot_prescreen_test'
+        exp = fit_cores.fit_snapshot(good, 18.3105, 3000.).get_result()
+        for batch in [False, True]:
+            roach.threads = []
+            roach.snap_names = []
+            ogp, sinad = adc.do_snap(freq = 18.3105, fname = fn, repeat = 2, batch = batch)
+            for e, o in zip(exp, ogp):
+                self.assertAlmostEquals(e, o, 8)
+            # one more than the repeats, for the retake
+            self.assertEquals(3, len(roach.snap_names))
+            for th in roach.threads:
+                self.assertEquals(('prefetch adcsnap0', []), th)
+            self.assertEquals(['MainThread'], [th.name for th in threading.enumerate()])
+        for f in os.listdir('testdata'):
+            if f.startswith('snapshot_prescreen_test'):
+                os.remove('testdata/' + f)
+
+    def test_artifacts(self):
+
+        fname = 'testdata/snapshot_raw_noroach_z0_2014-04-24-090838.dat'
+        freq = 18.3105
+        exists = lambda ext: os.path.isfile(fname + '.1' + ext)
+
+        exp, _ = self.adc.do_snap(freq = freq, fname = fname, repeat = 2)
+        for ext in ['.fit', '.ogp', '.a', '.d', '.res']:
+            self.assertTrue(exists(ext))
+        self.tearDown()
+
+        # just the results
+        self.adc.artifacts = 'summary'
+        ogp, _ = self.adc.do_snap(freq = freq, fname = fname, repeat = 2)
+        self.assertEquals(exp, ogp)
+        self.assertTrue(exists('.ogp'))
+        for ext in ['.fit', '.a', '.d', '.res']:
+            self.assertFalse(exists(ext))
+        self.tearDown()
+
+        # nothing, but the registers are still loaded the same
+        self.adc.artifacts = 'none'
+        ogp, _ = self.adc.do_snap(freq = freq, fname = fname, repeat = 2)
+        self.assertEquals(exp, ogp)
+        for ext in ['.fit', '.ogp', '.a', '.d', '.res']:
+            self.assertFalse(exists(ext))
+        self.adc.set_ogp(ogp, 0.0)
+        regs = self.adc.spi.regs
+        # as they were loaded from the ogp file
+        ogpfn = 'testdata/ogp_artifacts_test'
+        np.savetxt(ogpfn, ogp[3:], fmt='%8.4f')
+        self.adc.spi.regs = []
+        self.adc.load_from_file(ogpfn)
+        os.remove(ogpfn)
+        self.assertEquals(self.adc.spi.regs, regs[-len(self.adc.spi.regs):])
+
+        self.adc.artifacts = 'some'
+        self.assertRaises(Exception, self.adc.do_snap, freq = freq, fname = fname, repeat = 2)
 
     def test_load_from_file(self):
 
         file = 'testdata/ogp'
         self.adc.load_from_file(file, zdok = 0)
-        exp = [('0x81', '0x3c8'), ('0x8f', '0x1'), ('0xa0', '0x7a'), ('0x90', '0x8'), ('0x8f', '0x2'), ('0xa0', '0x73'), ('0x90', '0x8'), ('0x8f', '0x3'), ('0xa0', '0x6f'), ('0x90', '0x8'), ('0x8f', '0x4'), ('0xa0', '0x79'), ('0x90', '0x8'), ('0x8f', '0x1'), ('0xa2', '0x6d'), ('0x90', '0x20'), ('0x8f', '0x2'), ('0xa2', '0x84'), ('0x90', '0x20'), ('0x8f', '0x3'), ('0xa2', '0x84'), ('0x90', '0x20'), ('0x8f', '0x4'), ('0xa2', '0x8b'), ('0x90', '0x20'), ('0x8f', '0x1'), ('0xa4', '0x4a'), ('0x90', '0x80'), ('0x8f', '0x2'), ('0xa4', '0x45'), ('0x90', '0x80'), ('0x8f', '0x3'), ('0xa4', '0xb6'), ('0x90', '0x80'), ('0x8f', '0x4'), ('0xa4', '0xbb'), ('0x90', '0x80')]
+        # each core is selected once, and its offset, gain and phase loaded
+        exp = [('0x81', '0x3c8'), ('0x8f', '0x1'), ('0xa0', '0x7a'), ('0x90', '0x8'), ('0xa2', '0x6d'), ('0x90', '0x20'), ('0xa4', '0x4a'), ('0x90', '0x80'), ('0x8f', '0x2'), ('0xa0', '0x73'), ('0x90', '0x8'), ('0xa2', '0x84'), ('0x90', '0x20'), ('0xa4', '0x45'), ('0x90', '0x80'), ('0x8f', '0x3'), ('0xa0', '0x6f'), ('0x90', '0x8'), ('0xa2', '0x84'), ('0x90', '0x20'), ('0xa4', '0xb6'), ('0x90', '0x80'), ('0x8f', '0x4'), ('0xa0', '0x79'), ('0x90', '0x8'), ('0xa2', '0x8b'), ('0x90', '0x20'), ('0xa4', '0xbb'), ('0x90', '0x80')]
         regs = [(hex(int(x)), hex(int(y))) for x, y in self.adc.spi.regs]
         self.assertEquals(exp, regs)
@@ -2,9 +2,37 @@ import unittest
 import logging
 import numpy as np
 from datetime import datetime
-from struct import unpack
-
-from SPI import SPI
+from struct import pack, unpack
+
+from SPI import SPI, OPB_DATA_FMT, CHANSEL_REG_ADDR, EXTOFFS_REG_ADDR, CALCTRL_REG_ADDR
+
+class FakeAdc:
+    """
+    Stands in for the roach's adc5g_controller: keeps the registers that
+    are written, per zdok and channel, and answers the reads.
+    """
+
+    def __init__(self):
+        self.regs = {}
+        self.chansel = {}
+        self.last = {}
+        self.blindwrites = 0
+        self.reads = 0
+
+    def blindwrite(self, device, data, offset=0):
+        self.blindwrites += 1
+        reg_val, reg_addr, done = unpack(OPB_DATA_FMT, data)
+        self.last[offset] = reg_addr
+        if reg_addr & 0x80:
+            if reg_addr == 0x8f:
+                self.chansel[offset] = reg_val
+            self.regs[(offset, reg_addr & 0x7f, self.chansel.get(offset))] = reg_val
+
+    def read(self, device, size, offset=0):
+        self.reads += 1
+        reg_addr = self.last[offset]
+        reg_val = self.regs.get((offset, reg_addr, self.chansel.get(offset)), 0)
+        return pack(OPB_DATA_FMT, reg_val, reg_addr, 0x01)
 
 class SPITest(unittest.TestCase):
     'Unit tests for SPI.'
@@ -111,6 +139,225 @@ class SPITest(unittest.TestCase):
 
         self.assertEqual(exp, regs)
 
+    def test_transaction(self):
+
+        spi = SPI(zdok = 0, test = True)
+        with spi.transaction():
+            spi.set_offset(1, 1.0)
+            spi.set_gain(1, 1.0)
+            with spi.transaction():
+                spi.set_phase(1, 1.0)
+            # nothing is sent until the outermost transaction ends
+            self.assertEqual([], spi.writes)
+            spi.set_zdok(1)
+            spi.set_offset(1, 1.0)
+            spi.set_zdok(0)
+            spi.set_offset(2, 1.0)
+        exp = [('0x8f', '0x1'), ('0xa0', '0x83'), ('0x90', '0x8')
+                              , ('0xa2', '0x87'), ('0x90', '0x20')
+                              , ('0xa4', '0x89'), ('0x90', '0x80')
+             , ('0x8f', '0x1'), ('0xa0', '0x83'), ('0x90', '0x8')
+             , ('0x8f', '0x2'), ('0xa0', '0x83'), ('0x90', '0x8')]
+        self.assertEqual(exp, spi.get_hex_regs())
+        self.assertEqual([4]*7 + [8]*3 + [4]*3, [offset for offset, data in spi.writes])
+
+        # reads send what has been collected first
+        spi = SPI(zdok = 0, test = True)
+        with spi.transaction():
+            spi.set_offset(1, 1.0)
+            spi.get_offset(1)
+            self.assertEqual(3, len(spi.writes))
+            spi.set_gain(1, 1.0)
+        self.assertEqual(5, len(spi.writes))
+
+        # without a transaction every write is sent
+        spi = SPI(zdok = 0, test = True)
+        spi.set_offset(1, 1.0)
+        spi.set_gain(1, 1.0)
+        self.assertEqual(6, len(spi.writes))
+
+    def test_shadow(self):
+
+        roach = FakeAdc()
+        spi = SPI(zdok = 0, roach = roach)
+        spi.set_offset(1, 1.0)
+        spi.set_offset(2, -1.0)
+        spi.set_control()
+        writes = roach.blindwrites
+
+        # what we wrote is served from the shadow
+        self.assertAlmostEquals(-1.1765, spi.get_offset(2), 3)
+        self.assertAlmostEquals(1.1765, spi.get_offset(1), 3)
+        self.assertEqual(8, spi.get_control()['adcmode'])
+        self.assertEqual(0, roach.reads)
+        # only the channel selections were sent
+        self.assertEqual(writes + 2, roach.blindwrites)
+
+        # what we don't know is read, once
+        spi.get_gain(1)
+        spi.get_gain(1)
+        self.assertEqual(1, roach.reads)
+
+        # each zdok has its own
+        spi.set_zdok(1)
+        spi.get_offset(1)
+        self.assertEqual(2, roach.reads)
+
+        # after invalidating, everything is read again
+        spi.set_zdok(0)
+        spi.invalidate()
+        self.assertAlmostEquals(1.1765, spi.get_offset(1), 3)
+        self.assertEqual(3, roach.reads)
+
+        # refresh reads it all
+        spi.refresh()
+        reads = roach.reads
+        for chan in spi.cores:
+            spi.get_offset(chan)
+            spi.get_gain(chan)
+            spi.get_phase(chan)
+            spi.get_inl_registers(chan)
+        spi.get_control()
+        self.assertEqual(reads, roach.reads)
+        self.assertEqual(2 + 4*9 + 3, reads)
+
+    def test_differential(self):
+
+        roach = FakeAdc()
+        spi = SPI(zdok = 0, roach = roach, differential = True)
+        offs = [1.0, -1.0, 2.0, 0.0]
+        inls = [0.0, 0.15, -0.3] + [0.0]*14
+        spi.set_control()
+        spi.set_offsets(offs)
+        spi.set_inl_registers(2, inls)
+        state = dict(roach.regs)
+        writes = roach.blindwrites
+        # nothing is known the first time, so everything is written
+        self.assertEqual(1 + 4*3 + 1 + 6 + 1, writes)
+
+        # the same values again change nothing
+        spi.set_control()
+        spi.set_offsets(offs)
+        spi.set_inl_registers(2, inls)
+        self.assertEqual(writes, roach.blindwrites)
+
+        # only what changes is written, with its channel and latch
+        spi.set_offset(3, -2.0)
+        regs = [(hex(int(x)), hex(int(y))) for x, y in spi.regs[-3:]]
+        self.assertEqual([('0x8f', '0x3'), ('0xa0', '0x7b'), ('0x90', '0x8')], regs)
+        self.assertEqual(writes + 3, roach.blindwrites)
+        self.assertNotEqual(state, roach.regs)
+
+        # the held back channel selections still reach the reads
+        spi.invalidate()
+        self.assertAlmostEquals(-1.1765, spi.get_offset(2), 3)
+        self.assertEqual(list(spi.inl_regs_to_inl_vals(spi.inl_values_to_reg_values(inls)))
+                       , list(spi.get_inl_registers(2)))
+        self.assertAlmostEquals(-1.9608, spi.get_offset(3), 3)
+
+    def test_differential_latches(self):
+
+        roach = FakeAdc()
+        spi = SPI(zdok = 0, roach = roach, differential = True)
+        spi.set_offsets([1.0, -1.0, 2.0, 0.0])
+        spi.set_gains([0.5]*4)
+        writes = roach.blindwrites
+
+        # a latch is only skipped if what it latches is unchanged: the
+        # offset written here is still latched after an unchanged gain
+        spi.set_spi_register(CHANSEL_REG_ADDR, 1)
+        spi.set_spi_register(EXTOFFS_REG_ADDR, 0x90)
+        spi.set_gain(1, 0.5)
+        self.assertEqual(writes + 2, roach.blindwrites)
+        spi.set_spi_register(CALCTRL_REG_ADDR, spi.offset_calctrl)
+        regs = [(hex(int(x)), hex(int(y))) for x, y in spi.regs[-3:]]
+        self.assertEqual([('0x8f', '0x1'), ('0xa0', '0x90'), ('0x90', '0x8')], regs)
+        self.assertEqual(writes + 3, roach.blindwrites)
+
+        # and each channel's registers are latched on their own
+        spi.set_spi_register(CHANSEL_REG_ADDR, 2)
+        spi.set_spi_register(EXTOFFS_REG_ADDR, 0x90)
+        spi.set_spi_register(CHANSEL_REG_ADDR, 3)
+        spi.set_spi_register(CALCTRL_REG_ADDR, spi.offset_calctrl)
+        self.assertEqual(writes + 5, roach.blindwrites)
+        # (channel 2 is still selected, as 3 was never needed)
+        spi.set_spi_register(CHANSEL_REG_ADDR, 2)
+        spi.set_spi_register(CALCTRL_REG_ADDR, spi.offset_calctrl)
+        self.assertEqual(writes + 6, roach.blindwrites)
+        self.assertEqual(('0x90', '0x8'), tuple(hex(int(v)) for v in spi.regs[-1]))
+
+    def test_differential_invalidate(self):
+
+        roach = FakeAdc()
+        spi = SPI(zdok = 0, roach = roach, differential = True)
+        spi.set_offsets([1.0, -1.0, 2.0, 0.0])
+
+        # the channel selection held back over the invalidate still
+        # reaches the ADC before the register it is for
+        spi.set_spi_register(CHANSEL_REG_ADDR, 2)
+        spi.invalidate()
+        spi.set_spi_register(EXTOFFS_REG_ADDR, 0x90)
+        self.assertEqual(2, roach.chansel[4])
+        self.assertEqual(0x90, roach.regs[(4, 0x20, 2)])
+
+        # and so is the latch of what was written before it, with the
+        # selection sent again as the ADC may have lost it
+        writes = roach.blindwrites
+        spi.invalidate()
+        spi.set_spi_register(CALCTRL_REG_ADDR, spi.offset_calctrl)
+        self.assertEqual(writes + 2, roach.blindwrites)
+        self.assertEqual(spi.offset_calctrl, roach.regs[(4, 0x10, 2)])
+
+        # what was written is read back from the ADC
+        spi.invalidate()
+        self.assertEqual(spi.unscale_value(0x90, spi.offset_scale), spi.get_offset(2))
+        self.assertEqual(1, roach.reads)
+
+    def test_read_calibration_state(self):
+
+        roach = FakeAdc()
+        spi = SPI(zdok = 1, roach = roach)
+        ogps = {0 : [[1.0, -1.0, 2.0, 0.0], [2.0, 3.0, -4.0, 0.5], [-3.0, 0.0, 1.0, 2.0]]
+              , 1 : [[-0.4]*4, [0.0, 1.0, 2.0, 3.0], [4.0, 0.0, 0.0, -4.0]]}
+        inls = {0 : np.array([[0.15*(i%9 - 4) for i in range(17)]]*4)
+              , 1 : np.zeros((4, 17))}
+        inls[1][2, 5] = -0.3
+        for zdok in [0, 1]:
+            spi.set_zdok(zdok)
+            spi.set_offsets(ogps[zdok][0])
+            spi.set_gains(ogps[zdok][1])
+            spi.set_phases(ogps[zdok][2])
+            spi.set_all_inl_registers(inls[zdok])
+        writes = roach.blindwrites
+
+        state = spi.read_calibration_state()
+        self.assertEqual((2, 4), state.shape)
+        self.assertEqual(1, spi.zdok)
+        # a channel selection and 9 reads per core
+        self.assertEqual(2*4*9, roach.reads)
+        self.assertEqual(writes + 2*4*(1 + 9), roach.blindwrites)
+        for zdok in [0, 1]:
+            s = state[zdok]
+            self.assertEqual([zdok]*4, list(s['zdok']))
+            self.assertEqual([1, 2, 3, 4], list(s['core']))
+            spi.set_zdok(zdok)
+            for c in range(4):
+                self.assertEqual(spi.get_offset(c+1), s['offset'][c])
+                self.assertEqual(spi.get_gain(c+1), s['gain'][c])
+                self.assertEqual(spi.get_phase(c+1), s['phase'][c])
+                self.assertEqual(list(spi.get_inl_registers(c+1)), list(s['inl'][c]))
+            self.assertTrue(np.allclose(ogps[zdok][0], s['offset'], atol = 0.2))
+            self.assertTrue(np.allclose(ogps[zdok][1], s['gain'], atol = 0.08))
+            self.assertTrue(np.allclose(ogps[zdok][2], s['phase'], atol = 0.06))
+            self.assertTrue(np.allclose(inls[zdok], s['inl']))
+        # those were all served from the shadow
+        self.assertEqual(2*4*9, roach.reads)
+
+        # just one zdok, from the shadow
+        state = spi.read_calibration_state([1], fresh = False)
+        self.assertEqual((1, 4), state.shape)
+        self.assertEqual(2*4*9, roach.reads)
+
     def test_set_gains(self):
 
         spi = SPI(zdok = 0, test = True)
@@ -176,6 +423,33 @@ class SPITest(unittest.TestCase):
         self.assertEqual(exp, list(regs))
 
 
+    def test_inl_values_all_cores(self):
+
+        spi = SPI(zdok = 0, test = True)
+        values = np.array([[ 0., -0.0049, -0.158,  -0.0952,  0.0614,  0.0008, -0.0537,  0.161,   0.1902, 0.5033,  0.327,   0.2102,  0.1048, -0.0875, -0.2342, -0.0445,  0.    ]
+                         , [0.15*(i%9 - 4) for i in range(17)]
+                         , [0.0]*17
+                         , [-1.0]*8 + [1.0]*9])
+        regs = spi.inl_values_to_reg_values(values)
+        self.assertEqual((4, 6), regs.shape)
+        self.assertEqual([32, 5120, 0, 25, 24896, 40960], list(regs[0]))
+        vals = spi.inl_regs_to_inl_vals(regs)
+        self.assertEqual((4, 17), vals.shape)
+        for i in range(4):
+            self.assertEqual(list(regs[i]), list(spi.inl_values_to_reg_values(values[i])))
+            self.assertEqual(list(vals[i]), list(spi.inl_regs_to_inl_vals(regs[i])))
+        # the steps are coded exactly, and the ends clipped to +-0.6
+        self.assertTrue(np.allclose(values[1], vals[1]))
+        self.assertTrue(np.allclose(np.clip(values[3], -0.6, 0.6), vals[3]))
+
+        # all four channels in one transaction
+        spi.set_all_inl_registers(values)
+        self.assertEqual(4*8, len(spi.regs))
+        for i in range(4):
+            self.assertEqual(list(spi.regs[i*8][:2]), [0x8f, i+1])
+            self.assertEqual(list(regs[i]), [int(v) for a, v in spi.regs[i*8+1:i*8+7]])
+            self.assertEqual(list(vals[i]), list(spi.get_inl_registers(i+1)))
+
     def test_get_inl_registers(self):
 
         spi = SPI(zdok = 0, test = True)
@@ -0,0 +1,56 @@
+import unittest
+import os
+import numpy as np
+
+from SnapshotArchive import SnapshotArchive
+import fit_cores
+
+class SnapshotArchiveTest(unittest.TestCase):
+    'Unit tests for SnapshotArchive.'
+
+    def setUp(self):
+        self.fn = 'testdata/snapshot_archive_test.arc'
+        self.tearDown()
+
+    def tearDown(self):
+        for f in [self.fn, self.fn + '.idx']:
+            if os.path.isfile(f):
+                os.remove(f)
+
+    def test_archive(self):
+
+        fname = 'testdata/snapshot_raw_noroach_z0_2014-04-24-090838.dat.%d'
+        snaps = [fit_cores.read_snap(fname % i) for i in range(3)]
+        ramp = np.arange(64, dtype=np.uint8).reshape(4, 16)
+
+        arc = SnapshotArchive(self.fn)
+        for i, snap in enumerate(snaps):
+            arc.append(snap, 0, 'ogp', repeat = i)
+        arc.append(ramp, 1, 'mmcm', phase = 5)
+        self.assertEquals(4, len(arc))
+        self.assertEquals(3*16384 + 64, os.path.getsize(self.fn))
+
+        # read back through a fresh index
+        arc = SnapshotArchive(self.fn)
+        self.assertEquals(4, len(arc))
+        self.assertEquals([(0, 'ogp', 2, 0)], arc.find(zdok = 0, repeat = 2))
+        snap = arc.get(0, 'ogp', repeat = 1)
+        self.assertTrue(isinstance(snap, np.memmap))
+        self.assertEquals(np.int8, snap.dtype)
+        self.assertTrue((snaps[1] == snap).all())
+        r = arc.get(1, 'mmcm', phase = 5)
+        self.assertEquals((4, 16), r.shape)
+        self.assertTrue((ramp == r).all())
+        stack = arc.get_stack(0, 'ogp')
+        self.assertEquals((3, 16384), stack.shape)
+        self.assertTrue((np.array(snaps) == stack).all())
+
+        # a snapshot taken again replaces the old one
+        arc.append(snaps[0], 1, 'mmcm', phase = 5)
+        arc = SnapshotArchive(self.fn)
+        self.assertEquals(4, len(arc))
+        self.assertEquals((1, 'mmcm', 0, 5), arc.find(purpose = 'mmcm')[0])
+        self.assertTrue((snaps[0] == arc.get(1, 'mmcm', phase = 5)).all())
+
+if __name__ == '__main__':
+    unittest.main()